@@ -0,0 +1,95 @@
+"""Disk writes and CPU time of a single anvil under each of the state persistence modes.
+
+Usage: python -m benchmarks.anvil_persistence
+
+note: requires `anvil` on the PATH (or ANVIL_PATH) and linux procfs. The tmpfs mode is benchmarked in /dev/shm, this
+is what the memory backed docker tmpfs and kubernetes emptyDir mounts are.
+"""
+
+import os
+import signal
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from web3 import Web3
+
+from ctf_server.types import AnvilPersistence, LaunchAnvilInstanceArgs, format_anvil_args
+
+
+ANVIL_PATH = os.getenv('ANVIL_PATH', 'anvil')
+PORT = int(os.getenv('BENCH_PORT', '18545'))
+# Number of the accounts with code and balances that are making up the chain state
+ACCOUNTS = int(os.getenv('BENCH_ACCOUNTS', '2000'))
+DURATION = float(os.getenv('BENCH_DURATION', '60'))
+MODES: tuple[AnvilPersistence, ...] = ('off', 'interval', 'exit', 'tmpfs')
+
+
+def _proc_stats(pid: int) -> tuple[int, float]:
+    # Bytes that have actually reached the storage layer and the cpu seconds spent by the process
+    write_bytes = 0
+    for line in Path(f'/proc/{pid}/io').read_text().splitlines():
+        if line.startswith('write_bytes:'):
+            write_bytes = int(line.split()[1])
+
+    fields = Path(f'/proc/{pid}/stat').read_text().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return write_bytes, cpu
+
+
+def _populate(web3: Web3) -> None:
+    code = '0x' + '60006000f3' * 64
+    for i in range(ACCOUNTS):
+        address = f'0x{i + 1:040x}'
+        web3.provider.make_request('anvil_setBalance', [address, hex(10**18)])  # type: ignore[arg-type]
+        web3.provider.make_request('anvil_setCode', [address, code])  # type: ignore[arg-type]
+    web3.provider.make_request('anvil_mine', ['0x10'])  # type: ignore[arg-type]
+
+
+def _bench(mode: AnvilPersistence, data_dir: str) -> tuple[float, float, float, int]:
+    args = LaunchAnvilInstanceArgs(persistence=mode)
+    process = subprocess.Popen(  # noqa: S603
+        [ANVIL_PATH, *format_anvil_args(args, 'bench', PORT, host='127.0.0.1', data_dir=data_dir)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        web3 = Web3(Web3.HTTPProvider(f'http://127.0.0.1:{PORT}'))
+        while not web3.is_connected():
+            time.sleep(0.1)
+        _populate(web3)
+
+        written_before, cpu_before = _proc_stats(process.pid)
+        time.sleep(DURATION)
+        written_after, cpu_after = _proc_stats(process.pid)
+
+        stopped_at = time.perf_counter()
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+        stop_s = time.perf_counter() - stopped_at
+    finally:
+        process.kill()
+        process.wait()
+
+    state_file = Path(data_dir) / 'bench-state.json'
+    return (
+        (written_after - written_before) / 2**20 / DURATION * 60,
+        (cpu_after - cpu_before) / DURATION * 100,
+        stop_s,
+        state_file.stat().st_size if state_file.exists() else 0,
+    )
+
+
+def main() -> None:
+    print(f'{ACCOUNTS} accounts, {DURATION:.0f}s per mode')
+    print(f'{"mode":<10} {"disk MiB/min":>14} {"cpu %":>8} {"stop s":>8} {"state KiB":>11}')
+    for mode in MODES:
+        parent = '/dev/shm' if mode == 'tmpfs' else None  # noqa: S108
+        with tempfile.TemporaryDirectory(dir=parent) as data_dir:
+            disk, cpu, stop_s, state_size = _bench(mode, data_dir)
+        print(f'{mode:<10} {disk:>14.2f} {cpu:>8.2f} {stop_s:>8.2f} {state_size / 1024:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
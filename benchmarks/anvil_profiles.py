@@ -0,0 +1,88 @@
+"""Steady state RSS of a single anvil under each of the memory profiles.
+
+Usage: python -m benchmarks.anvil_profiles
+
+note: requires `anvil` on the PATH (or ANVIL_PATH) and linux procfs. Forked chains are only benchmarked when
+BENCH_FORK_URL is set, the profile memory limits are container limits and aren't applied here.
+"""
+
+import os
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from web3 import Web3
+
+from ctf_server.types import ANVIL_PROFILES, LaunchAnvilInstanceArgs, format_anvil_args
+
+
+ANVIL_PATH = os.getenv('ANVIL_PATH', 'anvil')
+PORT = int(os.getenv('BENCH_PORT', '18545'))
+FORK_URL = os.getenv('BENCH_FORK_URL')
+# Blocks with transactions that are mined before the RSS is sampled
+BLOCKS = int(os.getenv('BENCH_BLOCKS', '2000'))
+TRANSACTIONS_PER_BLOCK = int(os.getenv('BENCH_TRANSACTIONS_PER_BLOCK', '10'))
+SAMPLES = int(os.getenv('BENCH_SAMPLES', '10'))
+
+_SENDER = '0x' + '11' * 20
+
+
+def _rss_mib(pid: int) -> float:
+    for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _load(web3: Web3) -> None:
+    web3.provider.make_request('anvil_setBalance', [_SENDER, hex(10**24)])  # type: ignore[arg-type]
+    web3.provider.make_request('anvil_impersonateAccount', [_SENDER])  # type: ignore[arg-type]
+    web3.provider.make_request('evm_setAutomine', [False])  # type: ignore[arg-type]
+    for block in range(BLOCKS):
+        for i in range(TRANSACTIONS_PER_BLOCK):
+            recipient = f'0x{block * TRANSACTIONS_PER_BLOCK + i + 1:040x}'
+            web3.provider.make_request('eth_sendTransaction', [{'from': _SENDER, 'to': recipient, 'value': '0x1'}])  # type: ignore[arg-type]
+        web3.provider.make_request('anvil_mine', ['0x1'])  # type: ignore[arg-type]
+
+
+def _bench(args: LaunchAnvilInstanceArgs, data_dir: str) -> tuple[float, float]:
+    process = subprocess.Popen(  # noqa: S603
+        [ANVIL_PATH, *format_anvil_args(args, 'bench', PORT, host='127.0.0.1', data_dir=data_dir)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        web3 = Web3(Web3.HTTPProvider(f'http://127.0.0.1:{PORT}'))
+        while not web3.is_connected():
+            time.sleep(0.1)
+        idle = _rss_mib(process.pid)
+
+        _load(web3)
+        samples = []
+        for _ in range(SAMPLES):
+            time.sleep(1)
+            samples.append(_rss_mib(process.pid))
+    finally:
+        process.kill()
+        process.wait()
+
+    return idle, max(samples)
+
+
+def main() -> None:
+    print(f'{BLOCKS} blocks with {TRANSACTIONS_PER_BLOCK} transactions each')
+    print(f'{"profile":<12} {"fork":<6} {"idle MiB":>10} {"loaded MiB":>12} {"limit MiB":>11}')
+    for profile, profile_args in [('none', LaunchAnvilInstanceArgs()), *ANVIL_PROFILES.items()]:
+        for fork_url in [None, FORK_URL] if FORK_URL else [None]:
+            args = LaunchAnvilInstanceArgs(**profile_args, fork_url=fork_url, persistence='off')
+            with tempfile.TemporaryDirectory() as data_dir:
+                idle, loaded = _bench(args, data_dir)
+
+            limit = profile_args.get('memory_limit')
+            limit_mib = f'{limit / 2**20:.0f}' if limit else '-'
+            print(f'{profile:<12} {"yes" if fork_url else "no":<6} {idle:>10.1f} {loaded:>12.1f} {limit_mib:>11}')
+
+
+if __name__ == '__main__':
+    main()
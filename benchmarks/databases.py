@@ -0,0 +1,78 @@
+"""Per-operation latency of the database backends.
+
+Usage: python -m benchmarks.databases
+
+Redis is only benchmarked when REDIS_URL is set, and the selected redis database is flushed, so do not point it at a
+database that is in use.
+"""
+
+import os
+import tempfile
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import redis
+
+from ctf_server.databases import Database, MemoryDatabase, RedisDatabase, SQLiteDatabase
+from ctf_server.types import UserData
+
+
+REDIS_URL = os.getenv('REDIS_URL')
+INSTANCES = int(os.getenv('BENCH_INSTANCES', '1000'))
+
+
+def _user_data(i: int) -> UserData:
+    now = time.time()
+    return UserData(
+        instance_id=f'bench-{i}',
+        external_id=f'bench-external-{i}',
+        created_at=now,
+        expires_at=now + 3600,
+        anvil_instances={'main': {'id': 'main', 'ip': '10.0.0.1', 'port': 8545}},
+        daemon_instances={},
+        metadata={},
+    )
+
+
+def _measure(fn: Callable[[int], object]) -> float:
+    started_at = time.perf_counter()
+    for i in range(INSTANCES):
+        fn(i)
+    return (time.perf_counter() - started_at) / INSTANCES * 1e6
+
+
+def _bench(database: Database) -> list[float]:
+    return [
+        _measure(lambda i: database.register_instance(f'bench-{i}', _user_data(i))),
+        _measure(lambda i: database.get_instance(f'bench-{i}')),
+        _measure(lambda i: database.get_instance_by_external_id(f'bench-external-{i}')),
+        _measure(lambda i: database.update_metadata(f'bench-{i}', {'mnemonic': 'test test test'})),
+        _measure(lambda _: database.claim_expired_instances(128, 300)),
+        _measure(lambda i: database.unregister_instance(f'bench-{i}')),
+    ]
+
+
+def main() -> None:
+    workdir = Path(tempfile.mkdtemp(prefix='paradigmctf-bench-'))
+    backends: list[tuple[str, Callable[[], Database]]] = [
+        ('memory', MemoryDatabase),
+        ('memory (snapshot)', lambda: MemoryDatabase(str(workdir / 'memory.db'))),
+        ('sqlite', lambda: SQLiteDatabase(str(workdir / 'sqlite.db'))),
+    ]
+    if REDIS_URL:
+        redis.Redis.from_url(REDIS_URL).flushdb()
+        backends.append(('redis', lambda: RedisDatabase(REDIS_URL)))
+
+    print(f'{INSTANCES} instances, microseconds per operation')
+    header = ['register', 'get', 'get_by_external_id', 'update_metadata', 'claim_expired', 'unregister']
+    print(f'{"backend":<20}' + ''.join(f'{name:>20}' for name in header))
+    for name, factory in backends:
+        print(f'{name:<20}' + ''.join(f'{us:>20.1f}' for us in _bench(factory())))
+
+    if REDIS_URL:
+        redis.Redis.from_url(REDIS_URL).flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Memory footprint and read latency of the RedisDatabase instance encodings.
+
+Usage: REDIS_URL=redis://127.0.0.1:6379/15 python -m benchmarks.redis_encoding
+
+note: the selected redis database is flushed, so do not point it at a database that is in use. The json encoding
+requires the RedisJSON module, the hash encoding works on any redis compatible server.
+"""
+
+import os
+import time
+from typing import Any
+
+import redis
+
+from ctf_server.databases import RedisDatabase
+from ctf_server.databases.redis_encoding import ENCODINGS, decode_instance_hash, encode_instance_hash
+from ctf_server.types import UserData
+
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/15')
+INSTANCES = int(os.getenv('BENCH_INSTANCES', '1000'))
+ITERATIONS = int(os.getenv('BENCH_ITERATIONS', '1000'))
+
+
+def _user_data(i: int) -> UserData:
+    now = time.time()
+    return UserData(
+        instance_id=f'bench-{i}',
+        external_id=f'bench-external-{i}',
+        created_at=now,
+        expires_at=now + 3600,
+        anvil_instances={
+            'main': {'id': f'bench-{i}-main', 'ip': '10.0.0.1', 'port': 8545},
+            'l2': {'id': f'bench-{i}-l2', 'ip': '10.0.0.2', 'port': 8546},
+        },
+        daemon_instances={'daemon': {'id': f'bench-{i}-daemon'}},
+        metadata={},
+    )
+
+
+def _codec_us() -> tuple[float, float]:
+    instance = _user_data(0)
+    started_at = time.perf_counter()
+    for _ in range(ITERATIONS):
+        fields = encode_instance_hash(instance)
+    encoded_at = time.perf_counter()
+    for _ in range(ITERATIONS):
+        decode_instance_hash(fields)
+    decoded_at = time.perf_counter()
+    return (encoded_at - started_at) / ITERATIONS * 1e6, (decoded_at - encoded_at) / ITERATIONS * 1e6
+
+
+def main() -> None:
+    client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+
+    encode_us, decode_us = _codec_us()
+    print(f'hash codec: encode {encode_us:.1f} us, decode {decode_us:.1f} us')
+
+    print(f'{INSTANCES} instances, {REDIS_URL}')
+    print(f'{"encoding":<10} {"bytes/instance":>16} {"get_instance us":>16} {"get_all_instances ms":>22}')
+    for encoding in ENCODINGS:
+        client.flushdb()
+        database = RedisDatabase(REDIS_URL, encoding=encoding)
+        for i in range(INSTANCES):
+            database.register_instance(f'bench-{i}', _user_data(i))
+
+        usage: Any = sum(client.memory_usage(f'instance/bench-{i}') or 0 for i in range(INSTANCES))
+
+        database.get_instance('bench-1')  # warm up, loads the scripts
+        started_at = time.perf_counter()
+        for i in range(ITERATIONS):
+            database.get_instance(f'bench-{i % INSTANCES}')
+        get_us = (time.perf_counter() - started_at) / ITERATIONS * 1e6
+
+        started_at = time.perf_counter()
+        database.get_all_instances()
+        all_ms = (time.perf_counter() - started_at) * 1e3
+
+        print(f'{encoding:<10} {usage / INSTANCES:>16.0f} {get_us:>16.1f} {all_ms:>22.1f}')
+
+    client.flushdb()
+
+
+if __name__ == '__main__':
+    main()
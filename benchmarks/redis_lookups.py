@@ -0,0 +1,154 @@
+"""Round trips and latency of the RedisDatabase read paths, before and after they were collapsed.
+
+Usage: REDIS_URL=redis://127.0.0.1:6379/15 python -m benchmarks.redis_lookups
+
+note: the selected redis database is flushed, so do not point it at a database that is in use.
+"""
+
+import os
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from json import loads
+from typing import Any
+
+import redis
+from redis.connection import Connection
+
+from ctf_server.databases import RedisDatabase
+from ctf_server.types import UserData
+
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/15')
+INSTANCES = int(os.getenv('BENCH_INSTANCES', '1000'))
+ITERATIONS = int(os.getenv('BENCH_ITERATIONS', '200'))
+
+
+class _RoundTripCounter:
+    def __init__(self) -> None:
+        self.count = 0
+        self.__original = Connection.send_packed_command
+
+    @contextmanager
+    def patched(self) -> Iterator[None]:
+        original = self.__original
+
+        def send_packed_command(conn: Connection, *args: object, **kwargs: object) -> None:
+            self.count += 1
+            original(conn, *args, **kwargs)  # type: ignore[arg-type]
+
+        Connection.send_packed_command = send_packed_command  # type: ignore[method-assign,assignment]
+        try:
+            yield
+        finally:
+            Connection.send_packed_command = original  # type: ignore[method-assign]
+
+
+def _user_data(i: int) -> UserData:
+    now = time.time()
+    return UserData(
+        instance_id=f'bench-{i}',
+        external_id=f'bench-external-{i}',
+        created_at=now,
+        expires_at=now + (-60 if i % 10 == 0 else 3600),
+        anvil_instances={'main': {'id': 'main', 'ip': '10.0.0.1', 'port': 8545}},
+        daemon_instances={},
+        metadata={},
+    )
+
+
+# The read paths as they were implemented before, kept here only for the comparison
+def _legacy_get_instance(client: redis.Redis, instance_id: str) -> UserData | None:
+    instance: Any = client.json().get(f'instance/{instance_id}')
+    if instance is None:
+        return None
+
+    metadata: Any = client.hgetall(f'metadata/{instance_id}')
+    instance['metadata'] = {k: loads(v) for k, v in metadata.items()}
+    return instance
+
+
+def _legacy_get_instance_by_external_id(client: redis.Redis, external_id: str) -> UserData | None:
+    instance_id: Any = client.hget('external_ids', external_id)
+    if instance_id is None:
+        return None
+    return _legacy_get_instance(client, instance_id)
+
+
+def _legacy_get_all_instances(client: redis.Redis) -> list[UserData]:
+    return [
+        instance
+        for key in client.scan_iter(match='instance/*')
+        if (instance := _legacy_get_instance(client, str(key).split('/')[1]))
+    ]
+
+
+def _legacy_get_expired_instances(client: redis.Redis) -> list[UserData]:
+    instance_ids: Any = client.zrange('expiries', 0, int(time.time()), byscore=True)
+    return [instance for instance_id in instance_ids if (instance := _legacy_get_instance(client, instance_id))]
+
+
+def _measure(counter: _RoundTripCounter, fn: Callable[[], object], iterations: int) -> tuple[float, float]:
+    fn()  # warm up, loads the scripts
+
+    counter.count = 0
+    started_at = time.perf_counter()
+    with counter.patched():
+        for _ in range(iterations):
+            fn()
+    elapsed = time.perf_counter() - started_at
+    return counter.count / iterations, elapsed / iterations * 1e6
+
+
+def main() -> None:
+    client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    client.flushdb()
+
+    database = RedisDatabase(REDIS_URL)
+    for i in range(INSTANCES):
+        database.register_instance(f'bench-{i}', _user_data(i))
+        database.update_metadata(f'bench-{i}', {'mnemonic': 'test test test'})
+
+    batch = [f'bench-{i}' for i in range(0, INSTANCES, max(1, INSTANCES // 50))]
+    heavy = max(1, ITERATIONS // 20)
+    cases: list[tuple[str, Callable[[], object], Callable[[], object], int]] = [
+        (
+            'get_instance',
+            lambda: _legacy_get_instance(client, 'bench-1'),
+            lambda: database.get_instance('bench-1'),
+            ITERATIONS,
+        ),
+        (
+            'get_instance_by_external_id',
+            lambda: _legacy_get_instance_by_external_id(client, 'bench-external-1'),
+            lambda: database.get_instance_by_external_id('bench-external-1'),
+            ITERATIONS,
+        ),
+        (
+            f'get_instances ({len(batch)} ids)',
+            lambda: [_legacy_get_instance(client, instance_id) for instance_id in batch],
+            lambda: database.get_instances(batch),
+            ITERATIONS,
+        ),
+        (
+            'get_expired_instances',
+            lambda: _legacy_get_expired_instances(client),
+            database.get_expired_instances,
+            heavy,
+        ),
+        ('get_all_instances', lambda: _legacy_get_all_instances(client), database.get_all_instances, heavy),
+    ]
+
+    counter = _RoundTripCounter()
+    print(f'{INSTANCES} instances, {REDIS_URL}')
+    print(f'{"operation":<32} {"before rt":>10} {"before us":>12} {"after rt":>10} {"after us":>12}')
+    for name, before, after, iterations in cases:
+        before_rt, before_us = _measure(counter, before, iterations)
+        after_rt, after_us = _measure(counter, after, iterations)
+        print(f'{name:<32} {before_rt:>10.1f} {before_us:>12.1f} {after_rt:>10.1f} {after_us:>12.1f}')
+
+    client.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ from loguru import logger
 from web3 import Web3
 
 from ctf_launchers.types import ChallengeContract
+from ctf_server.tracing import tracer
 from foundry.anvil import anvil_auto_impersonate_account
 
 
@@ -61,18 +62,20 @@ def deploy(
     ]
 
     logger.info(f'Deploying contracts with command: ({" ".join(args)}) and environment: {env}')
-    proc = subprocess.Popen(
-        args=args,
-        env=env,
-        pass_fds=[wfd],
-        cwd=project_location,
-        text=True,
-        encoding='utf8',
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout, stderr = proc.communicate()
+    with tracer.span('forge_script', deploy_script=deploy_script) as span:
+        proc = subprocess.Popen(
+            args=args,
+            env=env,
+            pass_fds=[wfd],
+            cwd=project_location,
+            text=True,
+            encoding='utf8',
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout, stderr = proc.communicate()
+        span.set_attribute('returncode', proc.returncode)
 
     anvil_auto_impersonate_account(web3, enabled=False)
     if proc.returncode != 0:
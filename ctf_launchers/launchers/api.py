@@ -10,6 +10,8 @@ from loguru import logger
 from pydantic import BaseModel
 from starlette.requests import Request
 
+from ctf_server.tracing import trace_requests
+
 from .base import (
     CHALLENGE,
     DEFAULT_PROJECT_LOCATION,
@@ -85,6 +87,8 @@ class APIBaseLauncher(TeamInstanceLauncherBase):
                 content={'detail': str(exc)},
             )
 
+        self._api.middleware('http')(trace_requests)
+
         v1 = APIRouter(prefix='/v1', dependencies=[Depends(self._authenticate)])
         self._bind_v1(v1)
         self._api.include_router(v1)
@@ -1,17 +1,26 @@
+import contextlib
+import json
 import os
-from time import time
+from pathlib import Path
+from time import sleep, time
+from typing import Any, cast
 
 import requests
 from eth_abi import abi
-from eth_account.hdaccount import generate_mnemonic
 from pydantic import BaseModel
 from web3 import Web3
 
 from ctf_launchers.core.deployer import deploy
 from ctf_launchers.types import ChallengeContract
 from ctf_launchers.utils import http_url_to_ws
+from ctf_server.accounts import take_mnemonic
+from ctf_server.metrics import collect_timings, timed
+from ctf_server.tracing import tracer
 from ctf_server.types import (
+    ANVIL_PROFILES,
+    DEFAULT_DERIVATION_PATH,
     DEFAULT_MNEMONIC,
+    AnvilProfile,
     CreateInstanceRequest,
     DaemonInstanceArgs,
     LaunchAnvilInstanceArgs,
@@ -19,6 +28,7 @@ from ctf_server.types import (
     get_player_account,
     get_privileged_web3,
 )
+from foundry.anvil import anvil_load_prestate
 
 
 CHALLENGE = os.getenv('CHALLENGE', 'challenge')
@@ -28,9 +38,15 @@ PUBLIC_HOST = os.getenv('PUBLIC_HOST', 'http://127.0.0.1:8545').rstrip('/')
 PUBLIC_WEBSOCKET_HOST = http_url_to_ws(PUBLIC_HOST)
 
 ETH_RPC_URL = os.getenv('ETH_RPC_URL')
+# Forked anvils are fetching the state through the caching fork gateway when it's set, e.g. `http://fork-gateway:8547/mainnet`
+FORK_GATEWAY_URL = os.getenv('FORK_GATEWAY_URL')
 INSTANCE_LIFE_TIME = int(os.getenv('INSTANCE_LIFE_TIME', '900'))  # 15 minutes by default
+# Launches that were joined onto another one are waiting this many seconds for the other launcher to deploy
+COALESCED_LAUNCH_TIMEOUT = float(os.getenv('COALESCED_LAUNCH_TIMEOUT', '300'))
 
 DEFAULT_PROJECT_LOCATION = 'challenge/project'
+# Fork state recorded with `python -m ctf_launchers.prewarm`, it's loaded into the forked main chain before the deploy
+PRESTATE_PATH = os.getenv('PRESTATE_PATH', 'challenge/prestate.json')
 
 
 class NonSensitiveError(Exception):
@@ -89,6 +105,7 @@ class TeamInstanceLauncherBase:
     ) -> None:
         self.dynamic_fields = dynamic_fields if dynamic_fields else []
         self.project_location = project_location
+        tracer.setup('launcher')
 
     def get_anvil_instances(self) -> dict[str, LaunchAnvilInstanceArgs]:
         return {
@@ -99,14 +116,21 @@ class TeamInstanceLauncherBase:
         return {}
 
     def get_anvil_instance(self, **kwargs: int | str | list[str] | None) -> LaunchAnvilInstanceArgs:
+        profile = kwargs.pop('profile', None)
+        if profile is not None:
+            if profile not in ANVIL_PROFILES:
+                msg = f'unknown anvil profile: {profile}'
+                raise ValueError(msg)
+            kwargs = {**cast('dict[str, int | str | None]', ANVIL_PROFILES[cast('AnvilProfile', profile)]), **kwargs}
+
         if 'balance' not in kwargs:
             kwargs['balance'] = 1000
         if 'accounts' not in kwargs:
             kwargs['accounts'] = 2
         if 'fork_url' not in kwargs:
-            kwargs['fork_url'] = ETH_RPC_URL
+            kwargs['fork_url'] = FORK_GATEWAY_URL or ETH_RPC_URL
         if 'mnemonic' not in kwargs:
-            kwargs['mnemonic'] = generate_mnemonic(12, lang='english')
+            kwargs['mnemonic'] = take_mnemonic(DEFAULT_DERIVATION_PATH)
         return LaunchAnvilInstanceArgs(**kwargs)  # type: ignore[typeddict-item]
 
     def _get_instance_id(self, team: str) -> str:
@@ -118,11 +142,17 @@ class TeamInstanceLauncherBase:
             f'{ORCHESTRATOR_HOST}/instances/{self._get_instance_id(team)}/metadata',
             json=new_metadata,
             timeout=60,
+            headers=tracer.inject(),
         )
         body = resp.json()
         return bool(body.get('ok'))
 
     def launch_instance(self, team: str) -> LaunchedInstance:
+        # The whole launch is a single trace, the orchestrator and the backend are continuing it
+        with tracer.span('launch_instance', challenge_name=CHALLENGE, team_id=team):
+            return self._launch_instance(team)
+
+    def _launch_instance(self, team: str) -> LaunchedInstance:
         self._report_status(team, 'creating private blockchain...')
         form = CreateInstanceRequest(
             challenge_name=CHALLENGE,
@@ -135,23 +165,38 @@ class TeamInstanceLauncherBase:
         mnemonics = {k: str(v['mnemonic']) for k, v in form['anvil_instances'].items()}
         main_mnemonic = mnemonics['main']
 
-        body = requests.post(
-            f'{ORCHESTRATOR_HOST}/instances',
-            json=form,
-            timeout=60,
-        ).json()
-        if not body.get('ok'):
-            raise NonSensitiveError(body.get('message', 'an internal error occurred, contact admins'))
+        with collect_timings() as timings:
+            with timed('orchestrator_launch'):
+                body = self._request_instance(team, form)
+            if not body.get('ok'):
+                raise NonSensitiveError(body.get('message', 'an internal error occurred, contact admins'))
 
-        user_data = body['data']
+            if body.get('coalesced'):
+                # note: our mnemonics weren't funded, it's the other launch that deploys the challenge on its own ones
+                self._report_status(team, 'waiting for the challenge to be deployed...')
+                return self._wait_for_deploy(team)
 
-        self._report_status(team, 'deploying challenge...')
-        challenge_contracts = self.deploy(user_data, mnemonics)
+            user_data = body['data']
 
-        # FIXME(es3n1n): This is wrong, we should be saving all mnemonics, but it will do the trick for now
-        if not self.update_metadata({'mnemonic': main_mnemonic, 'challenge_contracts': challenge_contracts}, team):
-            msg = 'unable to update metadata'
-            raise NonSensitiveError(msg)
+            if form['anvil_instances']['main'].get('fork_url') and (prestate := self.get_prestate()):
+                self._report_status(team, 'warming up the fork...')
+                with timed('load_prestate'):
+                    anvil_load_prestate(get_privileged_web3(user_data, 'main'), prestate)
+
+            self._report_status(team, 'deploying challenge...')
+            with timed('deploy'):
+                challenge_contracts = self.deploy(user_data, mnemonics)
+
+            # FIXME(es3n1n): This is wrong, we should be saving all mnemonics, but it will do the trick for now
+            with timed('update_metadata'):
+                updated = self.update_metadata(
+                    {'mnemonic': main_mnemonic, 'challenge_contracts': challenge_contracts}, team
+                )
+            if not updated:
+                msg = 'unable to update metadata'
+                raise NonSensitiveError(msg)
+
+        self._report_timings(user_data['instance_id'], timings)
 
         self._report_status(team, 'private blockchain has been set up!')
         return LaunchedInstance.parse_instance(
@@ -160,8 +205,56 @@ class TeamInstanceLauncherBase:
             mnemonic=main_mnemonic,
         )
 
+    def _request_instance(self, team: str, form: CreateInstanceRequest) -> dict[str, Any]:
+        # The orchestrator streams our position in the admission queue while the launch is waiting for capacity
+        with requests.post(
+            f'{ORCHESTRATOR_HOST}/instances',
+            params={'stream': 'true'},
+            json=form,
+            stream=True,
+            timeout=60,
+            headers=tracer.inject(),
+        ) as resp:
+            body: dict[str, Any] = {}
+            position = None
+            for line in resp.iter_lines():
+                if not line:
+                    continue
+                body = json.loads(line)
+                if 'position' in body and body['position'] != position:
+                    position = body['position']
+                    self._report_status(team, f'you are #{position} in queue...')
+        return body
+
+    def _wait_for_deploy(self, team: str) -> LaunchedInstance:
+        # The instance is ready once the launcher that has deployed the challenge has saved its metadata
+        deadline = time() + COALESCED_LAUNCH_TIMEOUT
+        while time() < deadline:
+            body = requests.get(
+                f'{ORCHESTRATOR_HOST}/instances/{self._get_instance_id(team)}', timeout=5, headers=tracer.inject()
+            ).json()
+            if not body['ok']:
+                raise NonSensitiveError(body['message'])
+            if 'challenge_contracts' in body['data'].get('metadata', {}):
+                self._report_status(team, 'private blockchain has been set up!')
+                return LaunchedInstance.parse_instance(user_data=body['data'])
+            sleep(1)
+
+        msg = 'instance is still being deployed, try again later'
+        raise NonSensitiveError(msg)
+
+    @staticmethod
+    def _report_timings(instance_id: str, timings: dict[str, float]) -> None:
+        # note: the timings are only used for the metrics, a failure to report them shouldn't fail the launch
+        with contextlib.suppress(requests.RequestException):
+            requests.post(
+                f'{ORCHESTRATOR_HOST}/instances/{instance_id}/timings', json=timings, timeout=5, headers=tracer.inject()
+            )
+
     def instance_info(self, team: str) -> LaunchedInstance:
-        body = requests.get(f'{ORCHESTRATOR_HOST}/instances/{self._get_instance_id(team)}', timeout=5).json()
+        body = requests.get(
+            f'{ORCHESTRATOR_HOST}/instances/{self._get_instance_id(team)}', timeout=5, headers=tracer.inject()
+        ).json()
         if not body['ok']:
             raise NonSensitiveError(body['message'])
 
@@ -172,7 +265,9 @@ class TeamInstanceLauncherBase:
         )
 
     def kill_instance(self, team: str) -> bool:
-        resp = requests.delete(f'{ORCHESTRATOR_HOST}/instances/{self._get_instance_id(team)}', timeout=5)
+        resp = requests.delete(
+            f'{ORCHESTRATOR_HOST}/instances/{self._get_instance_id(team)}', timeout=5, headers=tracer.inject()
+        )
         body = resp.json()
         self._report_status(team, body.get('message', 'no message'))
         return True
@@ -181,6 +276,11 @@ class TeamInstanceLauncherBase:
         web3 = get_privileged_web3(user_data, 'main')
         return deploy(web3, self.project_location, mnemonics['main'], env=self.get_deployment_args(user_data))
 
+    def get_prestate(self) -> dict[str, dict[str, Any]] | None:
+        # This method can be overridden to pre-warm the fork with some other state
+        path = Path(PRESTATE_PATH)
+        return json.loads(path.read_text()) if path.exists() else None
+
     def get_deployment_args(self, _: UserData) -> dict[str, str]:
         # This method can be overridden to provide additional deployment arguments
         return {}
@@ -198,7 +298,9 @@ class PwnTeamInstanceLauncherBase(TeamInstanceLauncherBase):
         return os.getenv('FLAG', 'cr3{no_flag}')
 
     def get_flag(self, dynamic_fields: dict[str, str], team: str) -> str:
-        instance_body = requests.get(f'{ORCHESTRATOR_HOST}/instances/{self._get_instance_id(team)}', timeout=5).json()
+        instance_body = requests.get(
+            f'{ORCHESTRATOR_HOST}/instances/{self._get_instance_id(team)}', timeout=5, headers=tracer.inject()
+        ).json()
         if not instance_body['ok']:
             msg = 'are you sure instance is running?'
             raise NonSensitiveError(msg)
@@ -0,0 +1,99 @@
+"""Records the fork state that a reference deploy and solve have touched, so that new instances could be pre-warmed.
+
+Usage:
+    python -m ctf_launchers.prewarm trace <rpc url> <tx hash>... > challenge/prestate.json
+    python -m ctf_launchers.prewarm gateway <fork gateway url> <block number> > challenge/prestate.json
+
+`trace` needs a node with the prestate tracer, e.g. the reference anvil instance itself. `gateway` uses the state that
+the fork gateway has served at the block, the gateway should be running with a single worker while recording.
+"""
+
+import argparse
+import json
+import sys
+from typing import Any
+
+import requests
+from web3 import Web3
+
+from foundry.anvil import check_error
+
+
+Prestate = dict[str, dict[str, Any]]
+
+
+def _is_nonexistent(account: dict[str, Any]) -> bool:
+    # note: the tracer leaves out zero nonces, empty code and untouched storage, an account that didn't exist yet has at
+    # most a zero balance
+    return (
+        int(str(account.get('balance', 0)), 0) == 0
+        and not account.get('nonce')
+        and account.get('code') in (None, '', '0x')
+        and not account.get('storage')
+    )
+
+
+def merge_prestate(into: Prestate, other: Prestate) -> None:
+    # Transactions are traced in order, so the first time an account is seen its state is from before all of them.
+    # Later traces are only adding the storage slots that the earlier ones haven't touched, everything else that they
+    # report could have been changed by the earlier transactions already
+    for addr, account in other.items():
+        existing = into.get(addr.lower())
+        if existing is None:
+            # note: accounts that didn't exist are kept as empty placeholders, they've been created by the transactions
+            # and nothing that is reported for them later is prestate
+            into[addr.lower()] = {} if _is_nonexistent(account) else dict(account)
+            if into[addr.lower()] and 'storage' in account:
+                into[addr.lower()]['storage'] = {slot.lower(): value for slot, value in account['storage'].items()}
+            continue
+
+        if not existing:
+            continue
+        for slot, value in account.get('storage', {}).items():
+            existing.setdefault('storage', {}).setdefault(slot.lower(), value)
+
+
+def record_traces(rpc_url: str, tx_hashes: list[str]) -> Prestate:
+    web3 = Web3(Web3.HTTPProvider(rpc_url))
+    prestate: Prestate = {}
+    for tx_hash in tx_hashes:
+        resp = web3.provider.make_request(
+            'debug_traceTransaction',  # type: ignore[arg-type]
+            [tx_hash, {'tracer': 'prestateTracer'}],
+        )
+        check_error(resp)
+        merge_prestate(prestate, resp['result'])
+    return {addr: account for addr, account in prestate.items() if account}
+
+
+def record_gateway(gateway_url: str, block: str) -> Prestate:
+    body = requests.get(f'{gateway_url.rstrip("/")}/prestate/{block}', timeout=60).json()
+    if not body['ok']:
+        msg = f'fork gateway error: {body["message"]}'
+        raise RuntimeError(msg)
+    return body['data']
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='record fork state for pre-warming the instances')
+    subparsers = parser.add_subparsers(dest='source', required=True)
+
+    trace = subparsers.add_parser('trace', help='prestate of the transactions')
+    trace.add_argument('rpc_url')
+    trace.add_argument('tx_hashes', nargs='+')
+
+    gateway = subparsers.add_parser('gateway', help='state served by the fork gateway')
+    gateway.add_argument('gateway_url')
+    gateway.add_argument('block')
+
+    args = parser.parse_args()
+    if args.source == 'trace':
+        prestate = record_traces(args.rpc_url, args.tx_hashes)
+    else:
+        prestate = record_gateway(args.gateway_url, args.block)
+
+    json.dump(prestate, sys.stdout, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
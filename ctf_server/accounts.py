@@ -0,0 +1,75 @@
+import os
+from functools import lru_cache
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+from eth_account import Account
+from eth_account.hdaccount import Language, generate_mnemonic, key_from_seed, seed_from_mnemonic
+from eth_account.signers.local import LocalAccount
+
+
+SEED_CACHE_SIZE = int(os.getenv('SEED_CACHE_SIZE', '1024'))
+ACCOUNT_CACHE_SIZE = int(os.getenv('ACCOUNT_CACHE_SIZE', '8192'))
+
+MNEMONIC_POOL_SIZE = int(os.getenv('MNEMONIC_POOL_SIZE', '0'))
+MNEMONIC_POOL_ACCOUNTS = int(os.getenv('MNEMONIC_POOL_ACCOUNTS', '2'))
+
+
+def _generate_mnemonic() -> str:
+    return generate_mnemonic(12, lang=Language.ENGLISH)
+
+
+@lru_cache(maxsize=SEED_CACHE_SIZE)
+def derive_seed(mnemonic: str) -> bytes:
+    # note: this is the expensive part (2048 rounds of PBKDF2), so we only want to do it once per mnemonic
+    return seed_from_mnemonic(mnemonic, '')
+
+
+@lru_cache(maxsize=ACCOUNT_CACHE_SIZE)
+def derive_account(mnemonic: str, path: str) -> LocalAccount:
+    return Account.from_key(key_from_seed(derive_seed(mnemonic), path))
+
+
+def derive_accounts(mnemonic: str, derivation_path: str, count: int) -> list[LocalAccount]:
+    return [derive_account(mnemonic, f'{derivation_path}{i}') for i in range(count)]
+
+
+class MnemonicPool:
+    """Keeps a bounded amount of fresh mnemonics with their first accounts already derived."""
+
+    def __init__(self, size: int, derivation_path: str, accounts: int = MNEMONIC_POOL_ACCOUNTS) -> None:
+        self.__queue: Queue[str] = Queue(maxsize=size)
+        self.__derivation_path = derivation_path
+        self.__accounts = accounts
+
+        Thread(target=self.__generator_thread, name='Mnemonic Pool', daemon=True).start()
+
+    def __generator_thread(self) -> None:
+        while True:
+            mnemonic = _generate_mnemonic()
+            derive_accounts(mnemonic, self.__derivation_path, self.__accounts)
+            self.__queue.put(mnemonic)
+
+    def take(self) -> str:
+        try:
+            return self.__queue.get_nowait()
+        except Empty:
+            # Pool is drained, it is still better to generate one in place than to wait for the generator
+            return _generate_mnemonic()
+
+
+# note: the pooled mnemonics have their accounts derived for a single path, so there's a pool per derivation path
+_pools: dict[str, MnemonicPool] = {}
+_pools_lock = Lock()
+
+
+def take_mnemonic(derivation_path: str) -> str:
+    if MNEMONIC_POOL_SIZE <= 0:
+        return _generate_mnemonic()
+
+    with _pools_lock:
+        pool = _pools.get(derivation_path)
+        if pool is None:
+            pool = _pools[derivation_path] = MnemonicPool(MNEMONIC_POOL_SIZE, derivation_path)
+
+    return pool.take()
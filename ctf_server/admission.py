@@ -0,0 +1,179 @@
+import asyncio
+import contextlib
+import os
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+from ctf_server.databases.database import Database
+from ctf_server.types import CreateInstanceRequest
+
+
+# Launches that are running at the same time within a single orchestrator worker, 0 means no limit
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', '0'))
+# Caps of the running instances in total and per challenge, 0 means no limit
+ADMISSION_MAX_INSTANCES = int(os.getenv('ADMISSION_MAX_INSTANCES', '0'))
+ADMISSION_MAX_INSTANCES_PER_CHALLENGE = int(os.getenv('ADMISSION_MAX_INSTANCES_PER_CHALLENGE', '0'))
+# Launches that have been waiting for longer than this many seconds are rejected
+ADMISSION_TIMEOUT = float(os.getenv('ADMISSION_TIMEOUT', '600'))
+# Instance counts are sampled from the database at most this often, admission decisions are using the sampled ones
+ADMISSION_COUNT_REFRESH_INTERVAL = float(os.getenv('ADMISSION_COUNT_REFRESH_INTERVAL', '5'))
+
+
+class AdmissionError(Exception):
+    """Custom exception for launches that could not be admitted."""
+
+
+@dataclass(eq=False)
+class _Ticket:
+    team_id: str
+    challenge_name: str
+
+
+@dataclass
+class _Counts:
+    total: int = 0
+    per_challenge: dict[str, int] = field(default_factory=dict)
+    sampled_at: float = float('-inf')
+
+
+class AdmissionQueue:
+    """Admits the launches once there is capacity for them, taking turns between the teams.
+
+    Launches are waiting on the event loop of the orchestrator worker, so that the waiting ones won't take up the
+    threads that the other requests are served by.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        max_concurrent: int = ADMISSION_MAX_CONCURRENT,
+        max_instances: int = ADMISSION_MAX_INSTANCES,
+        max_instances_per_challenge: int = ADMISSION_MAX_INSTANCES_PER_CHALLENGE,
+        timeout: float = ADMISSION_TIMEOUT,
+    ) -> None:
+        self.__database = database
+        self.__max_concurrent = max_concurrent
+        self.__max_instances = max_instances
+        self.__max_instances_per_challenge = max_instances_per_challenge
+        self.__timeout = timeout
+
+        self.__cond = asyncio.Condition()
+        # Teams are served in this order, a team goes to the end once one of its launches is admitted
+        self.__queues: OrderedDict[str, deque[_Ticket]] = OrderedDict()
+        self.__counts = _Counts()
+        self.__in_flight: dict[str, int] = {}
+
+    @asynccontextmanager
+    async def admit(
+        self, request: CreateInstanceRequest, on_position: Callable[[int], None] | None = None
+    ) -> AsyncIterator[None]:
+        """Waits until the launch is admitted, `on_position` is called with the queue position on every recheck."""
+        ticket = _Ticket(request['team_id'], request['challenge_name'])
+        deadline = time.monotonic() + self.__timeout
+
+        async with self.__cond:
+            self.__queues.setdefault(ticket.team_id, deque()).append(ticket)
+            # note: the new ticket could be ahead of the waiting ones from the other teams
+            self.__cond.notify_all()
+            try:
+                while not await self.__try_admit(ticket):
+                    if on_position is not None:
+                        on_position(self.__position(ticket))
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        msg = 'no capacity for new instances, try again later'
+                        raise AdmissionError(msg)
+                    # note: waking up every now and then to notice the instances that are gone
+                    with contextlib.suppress(TimeoutError):
+                        await asyncio.wait_for(self.__cond.wait(), min(remaining, ADMISSION_COUNT_REFRESH_INTERVAL))
+            except:
+                self.__remove(ticket)
+                self.__cond.notify_all()
+                raise
+
+        launched = False
+        try:
+            yield
+            launched = True
+        finally:
+            async with self.__cond:
+                self.__in_flight[ticket.challenge_name] -= 1
+                if launched:
+                    # The instance is counted as running until the next sample tells otherwise
+                    self.__counts.total += 1
+                    per_challenge = self.__counts.per_challenge
+                    per_challenge[ticket.challenge_name] = per_challenge.get(ticket.challenge_name, 0) + 1
+                self.__cond.notify_all()
+
+    async def __try_admit(self, ticket: _Ticket) -> bool:
+        if await self.__next_ticket() is not ticket:
+            return False
+
+        self.__remove(ticket)
+        if ticket.team_id in self.__queues:
+            self.__queues.move_to_end(ticket.team_id)
+        self.__in_flight[ticket.challenge_name] = self.__in_flight.get(ticket.challenge_name, 0) + 1
+        # note: others could be admitted right away too, e.g. the ones for another challenge
+        self.__cond.notify_all()
+        return True
+
+    async def __next_ticket(self) -> _Ticket | None:
+        if self.__max_concurrent and sum(self.__in_flight.values()) >= self.__max_concurrent:
+            return None
+
+        await self.__refresh_counts()
+        if self.__max_instances and self.__counts.total + sum(self.__in_flight.values()) >= self.__max_instances:
+            return None
+
+        # Tickets for the challenges that are full are skipped, so that they won't hold up the other challenges
+        for queue in self.__queues.values():
+            for ticket in queue:
+                if self.__has_room(ticket.challenge_name):
+                    return ticket
+        return None
+
+    def __has_room(self, challenge_name: str) -> bool:
+        if not self.__max_instances_per_challenge:
+            return True
+        running = self.__counts.per_challenge.get(challenge_name, 0) + self.__in_flight.get(challenge_name, 0)
+        return running < self.__max_instances_per_challenge
+
+    async def __refresh_counts(self) -> None:
+        if not self.__max_instances and not self.__max_instances_per_challenge:
+            return
+        if time.monotonic() - self.__counts.sampled_at < ADMISSION_COUNT_REFRESH_INTERVAL:
+            return
+
+        counts = _Counts(sampled_at=time.monotonic())
+        # note: databases are blocking, the event loop keeps serving the other requests meanwhile
+        if self.__max_instances_per_challenge:
+            counts.per_challenge = await asyncio.to_thread(self.__database.count_instances_per_challenge)
+            counts.total = sum(counts.per_challenge.values())
+        else:
+            counts.total = await asyncio.to_thread(self.__database.count_instances)
+        self.__counts = counts
+
+    def __position(self, ticket: _Ticket) -> int:
+        # Teams are taking turns, so every team ahead of us in the rotation gets one more launch in before ours
+        index = self.__queues[ticket.team_id].index(ticket)
+        position = 1 + index
+        before = True
+        for team_id, queue in self.__queues.items():
+            if team_id == ticket.team_id:
+                before = False
+                continue
+            position += min(len(queue), index + 1 if before else index)
+        return position
+
+    def __remove(self, ticket: _Ticket) -> None:
+        queue = self.__queues.get(ticket.team_id)
+        if queue is None or ticket not in queue:
+            return
+
+        queue.remove(ticket)
+        if not queue:
+            del self.__queues[ticket.team_id]
@@ -18,12 +18,15 @@ from websockets import WebSocketException
 
 from .databases import Database
 from .loaders import load_database
+from .tracing import trace_requests, tracer
 from .types import InstanceInfo
 from .utils import worker
 
 
 MAX_BATCH_SIZE = int(os.getenv('ANVIL_PROXY_MAX_BATCH_SIZE', '100'))
 WS_RECV_TIMEOUT = float(os.getenv('ANVIL_PROXY_WS_RECV_TIMEOUT', '30'))
+# Share of the player requests without a trace of their own that are traced, the proxy serves every player RPC call
+TRACING_SAMPLE_RATIO = float(os.getenv('ANVIL_PROXY_TRACING_SAMPLE_RATIO', '0'))
 
 ALLOWED_NAMESPACES = ['web3', 'eth', 'net']
 DISALLOWED_METHODS = [
@@ -47,7 +50,8 @@ class Context:
     def setup(self) -> None:
         timeout = aiohttp.ClientTimeout(total=30, connect=5)
         self.session = aiohttp.ClientSession(timeout=timeout)
-        self.database = load_database()
+        # note: proxy is only reading instances, so the lookups could be served by the replicas
+        self.database = load_database(prefer_replicas=True)
 
     async def shutdown(self) -> None:
         if self.session is not None:
@@ -60,12 +64,14 @@ context = Context()
 @asynccontextmanager
 async def lifespan(_: FastAPI) -> AsyncGenerator[None]:
     worker.setup('anvil_proxy')
+    tracer.setup('anvil_proxy', sample_ratio=TRACING_SAMPLE_RATIO)
     context.setup()
     yield
     await context.shutdown()
 
 
 app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+app.middleware('http')(trace_requests)
 
 
 def jsonrpc_fail(id_: str | int | None, code: int, message: str) -> dict[str, str | dict[str, str | int] | Any]:
@@ -114,7 +120,7 @@ async def send_request(
 ) -> dict | list | None:
     instance_host = f'http://{anvil_instance["ip"]}:{anvil_instance["port"]}'
     try:
-        async with context.session.post(instance_host, json=body) as resp:
+        async with context.session.post(instance_host, json=body, headers=tracer.inject()) as resp:
             return await resp.json()
     except Exception as e:
         logger.opt(exception=e).error(f'failed to proxy anvil request to {anvil_instance}')
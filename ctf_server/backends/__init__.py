@@ -1,3 +1,6 @@
 from .backend import Backend  # noqa: F401
 from .docker_backend import DockerBackend  # noqa: F401
+from .federated_backend import FederatedKubernetesBackend  # noqa: F401
 from .kubernetes_backend import KubernetesBackend  # noqa: F401
+from .multihost_docker_backend import MultiHostDockerBackend  # noqa: F401
+from .process_backend import ProcessBackend  # noqa: F401
@@ -1,28 +1,46 @@
 import abc
+import contextvars
+import os
 import random
 import string
 import time
-from threading import Thread
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
 
-from eth_account import Account
-from eth_account.hdaccount import key_from_seed, seed_from_mnemonic
-from eth_account.signers.local import LocalAccount
-from loguru import logger
 from web3 import Web3
 
+from ctf_server.accounts import derive_accounts
 from ctf_server.databases.database import Database
+from ctf_server.metrics import LAUNCH_SECONDS, collect_timings, timed
+from ctf_server.tracing import tracer
 from ctf_server.types import (
     DEFAULT_ACCOUNTS,
     DEFAULT_BALANCE,
     DEFAULT_DERIVATION_PATH,
+    DEFAULT_IMAGE,
     DEFAULT_MNEMONIC,
     CreateInstanceRequest,
     InstanceInfo,
     LaunchAnvilInstanceArgs,
     UserData,
 )
-from ctf_server.utils import worker
-from foundry.anvil import anvil_set_balance
+from foundry.anvil import anvil_set_balances
+
+from .leader import LeaderElector
+from .pruner import InstancePruner
+from .reconciler import Reconciler
+
+
+# An instance has to be started, and all of its chains have to be prepared within this many seconds
+INSTANCE_START_TIMEOUT = float(os.getenv('INSTANCE_START_TIMEOUT', '120'))
+# Launches of the same instance are taking turns through a database lease, it's released early once the launch is done
+LAUNCH_LEASE_TTL = float(os.getenv('LAUNCH_LEASE_TTL', '300'))
+LAUNCH_LEASE_POLL_INTERVAL = 0.5
+# Images of the registered challenges are pulled ahead of the launches once elected and then this often
+IMAGE_PREPULL_INTERVAL = float(os.getenv('IMAGE_PREPULL_INTERVAL', '600'))
+# Images that are always pulled ahead, on top of the ones that the challenges have registered
+PREPULL_IMAGES = [image for image in os.getenv('PREPULL_IMAGES', DEFAULT_IMAGE).split(',') if image]
 
 
 class InstanceExistsError(Exception):
@@ -30,41 +48,145 @@ class InstanceExistsError(Exception):
 
 
 class Backend(abc.ABC):
-    def __init__(self, database: Database) -> None:
+    def __init__(self, database: Database, *, background_tasks: bool = True) -> None:
         self._database = database
 
-        # We only want to run this thread for a single worker
-        if worker.is_first:
-            Thread(
-                target=self.__instance_pruner_thread,
-                name=f'{self.__class__.__name__} Anvil Pruner',
-                daemon=True,
-            ).start()
-
-    def __instance_pruner_thread(self) -> None:
-        @logger.catch
-        def pruner() -> None:
-            for instance in self._database.get_expired_instances():
-                logger.info(f'pruning expired instance: {instance["instance_id"]}')
-                self.kill_instance(instance['instance_id'])
-
-        while True:
-            pruner()
-            time.sleep(1)
+        # Launches of this process that are still running, the requests for the same instance are waiting for them
+        self.__launches: dict[str, Future[UserData]] = {}
+        self.__launches_lock = Lock()
+        self.__lease_owner = f'{self.__class__.__name__}/{uuid.uuid4().hex}'
+
+        # Background tasks are running on every worker and replica, but only the elected leader is doing the work.
+        # Backends that are managed by another one aren't running them at all
+        self._leader = LeaderElector(database, 'orchestrator') if background_tasks else None
+
+        self._pruner = InstancePruner(
+            database, self.kill_instance, f'{self.__class__.__name__} Anvil Pruner', leader=self._leader
+        )
+        self._image_prepuller = Reconciler(
+            self.prepull_images, f'{self.__class__.__name__} Image Prepuller', IMAGE_PREPULL_INTERVAL, self._leader
+        )
+        if self._leader is not None:
+            self._pruner.start()
+            self._image_prepuller.start()
+            self._leader.add_listener(self._image_prepuller.trigger)
+            self._leader.start()
 
     def launch_instance(self, args: CreateInstanceRequest) -> UserData:
-        if self._database.get_instance(args['instance_id']) is not None:
-            raise InstanceExistsError
+        # Concurrent launches of the same instance are coalesced, the later callers are getting the result of the first
+        # one marked as `coalesced`, so that they know that it's the first caller who is setting the instance up
+        with self.__launches_lock:
+            launch = self.__launches.get(args['instance_id'])
+            if launch is None:
+                launch = self.__launches[args['instance_id']] = Future()
+                is_first = True
+            else:
+                is_first = False
+
+        if not is_first:
+            return self._coalesced(launch.result())
+
+        try:
+            with tracer.span('launch_instance', instance_id=args['instance_id'], challenge_name=args['challenge_name']):
+                user_data = self.__launch_leased(args)
+        except BaseException as e:
+            launch.set_exception(e)
+            raise
+        else:
+            launch.set_result(user_data)
+            return user_data
+        finally:
+            with self.__launches_lock:
+                del self.__launches[args['instance_id']]
+
+    def join_launch(self, instance_id: str) -> UserData | None:
+        # Result of the launch of the instance that this process is running already, marked as `coalesced`, or None
+        # when there's no such launch
+        with self.__launches_lock:
+            launch = self.__launches.get(instance_id)
+        return None if launch is None else self._coalesced(launch.result())
+
+    def __launch_leased(self, args: CreateInstanceRequest) -> UserData:
+        lease = f'launch/{args["instance_id"]}'
+        deadline = time.monotonic() + LAUNCH_LEASE_TTL
+        waited = False
+
+        while not self._database.acquire_lease(lease, self.__lease_owner, LAUNCH_LEASE_TTL):
+            # Another worker or replica is launching this instance, we're done once it gets registered
+            waited = True
+            if (instance := self._database.get_instance(args['instance_id'])) is not None:
+                return self._coalesced(instance)
+            if time.monotonic() >= deadline:
+                msg = f'instance {args["instance_id"]} is still being launched elsewhere'
+                raise TimeoutError(msg)
+            time.sleep(LAUNCH_LEASE_POLL_INTERVAL)
+
+        try:
+            if (instance := self._database.get_instance(args['instance_id'])) is not None:
+                if waited:
+                    return self._coalesced(instance)
+                raise InstanceExistsError
+            return self.__launch(args)
+        finally:
+            self._database.release_lease(lease, self.__lease_owner)
+
+    def __launch(self, args: CreateInstanceRequest) -> UserData:
+        started_at = time.perf_counter()
+        try:
+            with collect_timings() as timings:
+                user_data = self.create_instance(args)
+        except:
+            LAUNCH_SECONDS.observe(time.perf_counter() - started_at, 'failed')
+            raise
 
+        LAUNCH_SECONDS.observe(time.perf_counter() - started_at, 'ok')
+        user_data['challenge_name'] = args['challenge_name']
+        user_data['timings'] = {**timings, 'total': round(time.perf_counter() - started_at, 6)}
+        if (trace_id := tracer.trace_id) is not None:
+            user_data['trace_id'] = trace_id
         try:
-            user_data = self._launch_instance_impl(args)
             self._database.register_instance(args['instance_id'], user_data)
         except:
-            self._cleanup_instance(args)
+            self.destroy_instance(user_data)
             raise
         else:
             return user_data
 
+    def create_instance(self, args: CreateInstanceRequest) -> UserData:
+        # Starts the instance without registering it, everything that was allocated is released if it fails
+        try:
+            return self._launch_instance_impl(args)
+        except:
+            self._cleanup_instance(args)
+            raise
+
+    def kill_instance(self, instance_id: str) -> UserData | None:
+        instance = self._database.unregister_instance(instance_id)
+        if instance is None:
+            return None
+
+        self.destroy_instance(instance)
+        return instance
+
+    def get_images(self) -> dict[str, list[str]]:
+        # Every image that is pulled ahead, with the challenges that are using it
+        images: dict[str, list[str]] = {image: [] for image in PREPULL_IMAGES}
+        for challenge_name, challenge_images in self._database.get_images().items():
+            for image in challenge_images:
+                images.setdefault(image, []).append(challenge_name)
+        return images
+
+    def prepull_images(self) -> None:
+        self.pull_images(sorted(self.get_images()))
+
+    def pull_images(self, images: list[str]) -> None:
+        # Backends that aren't running any images, or are pulling them somehow else, don't have to do anything
+        _ = images
+
+    def get_image_status(self, images: list[str]) -> dict[str, dict[str, bool]]:
+        # Whether each of the images is present on each of the docker hosts or kubernetes nodes
+        return {image: {} for image in images}
+
     @abc.abstractmethod
     def _launch_instance_impl(self, args: CreateInstanceRequest) -> UserData:
         pass
@@ -74,34 +196,61 @@ class Backend(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def kill_instance(self, instance_id: str) -> UserData | None:
+    def destroy_instance(self, instance: UserData) -> None:
+        # Releases everything that was allocated for an instance that has been already unregistered
         pass
 
+    @staticmethod
+    def _coalesced(instance: UserData) -> UserData:
+        return {**instance, 'coalesced': True}
+
     @staticmethod
     def _generate_rpc_id(length: int = 24) -> str:
         return ''.join(random.SystemRandom().choice(string.ascii_letters) for _ in range(length))
 
-    @staticmethod
-    def __derive_account(derivation_path: str, mnemonic: str, index: int) -> LocalAccount:
-        seed = seed_from_mnemonic(mnemonic, '')
-        private_key = key_from_seed(seed, f'{derivation_path}{index}')
-        return Account.from_key(private_key)
-
-    def _prepare_node(self, args: LaunchAnvilInstanceArgs, web3: Web3) -> None:
-        while not web3.is_connected():
-            time.sleep(0.1)
-            continue
-
-        for i in range(args.get('accounts', None) or DEFAULT_ACCOUNTS):
-            anvil_set_balance(
-                web3,
-                self.__derive_account(
-                    args.get('derivation_path', None) or DEFAULT_DERIVATION_PATH,
-                    args.get('mnemonic', None) or DEFAULT_MNEMONIC,
-                    i,
-                ).address,
-                hex(int(args.get('balance', None) or DEFAULT_BALANCE) * 10**18),
+    def _prepare_nodes(
+        self,
+        requested: dict[str, LaunchAnvilInstanceArgs],
+        anvil_instances: dict[str, InstanceInfo],
+        deadline: float,
+    ) -> None:
+        # Chains are independent of each other, so they are prepared concurrently instead of one after another
+        with (
+            timed('prepare_nodes'),
+            ThreadPoolExecutor(max_workers=max(1, len(anvil_instances)), thread_name_prefix='Node Prepare') as pool,
+        ):
+            futures = [
+                pool.submit(
+                    # note: every chain gets its own copy of the context, so that its phases are timed for the launch
+                    contextvars.copy_context().run,
+                    self._prepare_node,
+                    requested[anvil_id],
+                    Web3(Web3.HTTPProvider(f'http://{info["ip"]}:{info["port"]}')),
+                    deadline,
+                )
+                for anvil_id, info in anvil_instances.items()
+            ]
+            for future in futures:
+                future.result()
+
+    def _prepare_node(self, args: LaunchAnvilInstanceArgs, web3: Web3, deadline: float) -> None:
+        with timed('node_ready'):
+            while not web3.is_connected():
+                if time.monotonic() >= deadline:
+                    msg = f'node {web3.provider} did not come up in time'
+                    raise TimeoutError(msg)
+                time.sleep(0.1)
+
+        with timed('set_balances'):
+            accounts = derive_accounts(
+                args.get('mnemonic', None) or DEFAULT_MNEMONIC,
+                args.get('derivation_path', None) or DEFAULT_DERIVATION_PATH,
+                args.get('accounts', None) or DEFAULT_ACCOUNTS,
             )
+            balance = hex(int(args.get('balance', None) or DEFAULT_BALANCE) * 10**18)
+
+            # All the cheatcodes are sent within a single json-rpc batch, instead of a request per account
+            anvil_set_balances(web3, {account.address: balance for account in accounts})
 
     @staticmethod
     def _remap_extra_anvil_keys(out: InstanceInfo, anvil_args: LaunchAnvilInstanceArgs) -> None:
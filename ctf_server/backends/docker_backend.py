@@ -1,25 +1,34 @@
 import http.client
+import ipaddress
+import os
 import shlex
 import time
-from typing import TYPE_CHECKING
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import TYPE_CHECKING, Any
 
 import docker
 from docker.errors import APIError, NotFound
 from docker.types import Mount
 from loguru import logger
-from web3 import Web3
 
 from ctf_server.databases.database import Database
+from ctf_server.metrics import timed
 from ctf_server.types import (
+    ANVIL_TMPFS_SIZE,
     DEFAULT_IMAGE,
     CreateInstanceRequest,
     InstanceInfo,
+    LaunchAnvilInstanceArgs,
     UserData,
     format_anvil_args,
     format_anvil_env,
 )
 
-from .backend import Backend
+from .backend import INSTANCE_START_TIMEOUT, Backend
+from .reconciler import Reconciler
 
 
 if TYPE_CHECKING:
@@ -31,72 +40,153 @@ if TYPE_CHECKING:
 #  instances but not the other way around
 INSTANCES_NETWORK_NAME = 'paradigmctf-instances'
 
+LABEL_INSTANCE = 'paradigmctf.instance'
+LABEL_CHALLENGE = 'paradigmctf.challenge'
+LABEL_CREATED_AT = 'paradigmctf.created_at'
+
+# Labelled containers and volumes of the instances that are not in the database are removed after this many seconds
+DOCKER_RECONCILE_GRACE = float(os.getenv('DOCKER_RECONCILE_GRACE', '600'))
+DOCKER_RECONCILE_WORKERS = int(os.getenv('DOCKER_RECONCILE_WORKERS', '8'))
+
+
+def _private_bind(address: str | None) -> str:
+    # note: anvil ports aren't going through the method allow-list of the proxy, they can't be published publicly
+    try:
+        ip = ipaddress.ip_address(address or '')
+    except ValueError:
+        ip = None
+    if ip is None or ip.is_unspecified or not ip.is_private:
+        msg = f'anvil ports can only be published on a private ip address, got {address}'
+        raise ValueError(msg)
+    return str(ip)
+
+
+@dataclass
+class _InstanceResources:
+    containers: list['Container'] = field(default_factory=list)
+    volumes: list['Volume'] = field(default_factory=list)
+    created_at: float = float('inf')
+
+    def add_container(self, container: 'Container') -> None:
+        self.containers.append(container)
+        self.__seen(container.labels)
+
+    def add_volume(self, volume: 'Volume') -> None:
+        self.volumes.append(volume)
+        self.__seen(volume.attrs.get('Labels') or {})
+
+    def __seen(self, labels: dict[str, str]) -> None:
+        # note: resources without a valid timestamp are treated as old ones
+        try:
+            created_at = float(labels.get(LABEL_CREATED_AT, 0))
+        except ValueError:
+            created_at = 0
+        self.created_at = min(self.created_at, created_at)
+
 
 class DockerBackend(Backend):
-    def __init__(self, database: Database) -> None:
-        self.__client = docker.from_env()
+    def __init__(
+        self,
+        database: Database,
+        client: docker.DockerClient | None = None,
+        *,
+        publish_address: str | None = None,
+        publish_bind: str | None = None,
+        background_tasks: bool = True,
+    ) -> None:
+        self.__client = client or docker.from_env()
+        # When the orchestrator and the proxy aren't on the docker host, anvils are reachable through published ports
+        self.__publish_address = publish_address
+        self.__publish_bind = _private_bind(publish_bind) if publish_address else None
+        # note: the network of the compose project only exists on its own host, others get it on their first launch
+        self.__network_lock = Lock()
+        self.__network_ready = publish_address is None
 
         # note(es3n1n, 28.03.24): We are initializing base backend after the client because it would start a container
         # prunner thread, and there could be an issue where there would be some expired instances that it will start
         # pruning them before we even init the client, which will result in undefined __client exceptions
-        super().__init__(database)
+        super().__init__(database, background_tasks=background_tasks)
+
+        self._reconciler = Reconciler(self.reconcile, f'{self.__class__.__name__} Reconciler', leader=self._leader)
+        if self._leader is not None:
+            self._reconciler.start()
 
     def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
         instance_id = request['instance_id']
         requested_anvil_instances = request['anvil_instances']
+        deadline = time.monotonic() + INSTANCE_START_TIMEOUT
 
-        volume: Volume = self.__client.volumes.create(name=instance_id)
+        labels = {
+            LABEL_INSTANCE: instance_id,
+            LABEL_CHALLENGE: request['challenge_name'],
+            LABEL_CREATED_AT: str(time.time()),
+        }
+
+        self.__ensure_network()
+
+        with timed('create_volume'):
+            volume: Volume = self.__client.volumes.create(name=instance_id, labels=labels)
 
         anvil_containers: dict[str, Container] = {}
         for anvil_id, anvil_args in requested_anvil_instances.items():
-            anvil_containers[anvil_id] = self.__client.containers.run(  # type: ignore[call-overload]
-                name=f'{instance_id}-{anvil_id}',
-                image=anvil_args.get('image', DEFAULT_IMAGE),
-                network=INSTANCES_NETWORK_NAME,
-                entrypoint=['sh', '-c'],
-                command=[
-                    'while true; do anvil '
-                    + ' '.join([shlex.quote(str(v)) for v in format_anvil_args(anvil_args, anvil_id)])
-                    + '; sleep 1; done;'
-                ],
-                restart_policy={'Name': 'always'},
-                detach=True,
-                mounts=[
-                    Mount(target='/data', source=volume.id),
-                ],
-                environment=format_anvil_env(anvil_args),
-            )
+            with timed('run_anvil_container'):
+                anvil_containers[anvil_id] = self.__client.containers.run(  # type: ignore[call-overload]
+                    name=f'{instance_id}-{anvil_id}',
+                    image=anvil_args.get('image', DEFAULT_IMAGE),
+                    network=INSTANCES_NETWORK_NAME,
+                    entrypoint=['sh', '-c'],
+                    command=[
+                        'while true; do anvil '
+                        + ' '.join([shlex.quote(str(v)) for v in format_anvil_args(anvil_args, anvil_id)])
+                        + '; sleep 1; done;'
+                    ],
+                    restart_policy={'Name': 'always'},
+                    detach=True,
+                    **self.__get_data_mount(anvil_args, volume),
+                    environment=format_anvil_env(anvil_args),
+                    labels=labels,
+                    # note: without a swap limit the container could keep on growing into the swap
+                    mem_limit=anvil_args.get('memory_limit'),
+                    memswap_limit=anvil_args.get('memory_limit'),
+                    ports={'8545/tcp': (self.__publish_bind, None)} if self.__publish_address else None,
+                )
 
         daemon_containers: dict[str, Container] = {}
         for daemon_id, daemon_args in request.get('daemon_instances', {}).items():
-            daemon_containers[daemon_id] = self.__client.containers.run(
-                name=f'{instance_id}-{daemon_id}',
-                image=daemon_args['image'],
-                network=INSTANCES_NETWORK_NAME,  # TODO(es3n1n): perhaps separate network?
-                restart_policy={'Name': 'always'},
-                detach=True,
-                environment={
-                    'INSTANCE_ID': instance_id,
-                },
-            )
+            with timed('run_daemon_container'):
+                daemon_containers[daemon_id] = self.__client.containers.run(
+                    name=f'{instance_id}-{daemon_id}',
+                    image=daemon_args['image'],
+                    network=INSTANCES_NETWORK_NAME,  # TODO(es3n1n): perhaps separate network?
+                    restart_policy={'Name': 'always'},
+                    detach=True,
+                    environment={
+                        'INSTANCE_ID': instance_id,
+                    },
+                    labels=labels,
+                )
 
         anvil_instances: dict[str, InstanceInfo] = {}
         for anvil_id, anvil_container in anvil_containers.items():
-            container: Container = self.__client.containers.get(anvil_container.id)
+            with timed('inspect_container'):
+                container: Container = self.__client.containers.get(anvil_container.id)
+            network_settings = container.attrs['NetworkSettings']
 
-            anvil_instances[anvil_id] = {
-                'id': anvil_id,
-                'ip': container.attrs['NetworkSettings']['Networks'][INSTANCES_NETWORK_NAME]['IPAddress'],
-                'port': 8545,
-            }
+            if self.__publish_address:
+                anvil_instances[anvil_id] = {
+                    'id': anvil_id,
+                    'ip': self.__publish_address,
+                    'port': int(network_settings['Ports']['8545/tcp'][0]['HostPort']),
+                }
+            else:
+                anvil_instances[anvil_id] = {
+                    'id': anvil_id,
+                    'ip': network_settings['Networks'][INSTANCES_NETWORK_NAME]['IPAddress'],
+                    'port': 8545,
+                }
             self._remap_extra_anvil_keys(anvil_instances[anvil_id], requested_anvil_instances[anvil_id])
 
-            self._prepare_node(
-                request['anvil_instances'][anvil_id],
-                Web3(
-                    Web3.HTTPProvider(f'http://{anvil_instances[anvil_id]["ip"]}:{anvil_instances[anvil_id]["port"]}')
-                ),
-            )
+        self._prepare_nodes(requested_anvil_instances, anvil_instances, deadline)
 
         daemon_instances: dict[str, InstanceInfo] = {}
         for daemon_id in daemon_containers:
@@ -115,27 +205,120 @@ class DockerBackend(Backend):
             metadata={},
         )
 
-    def _cleanup_instance(self, args: CreateInstanceRequest) -> None:
-        instance_id = args['instance_id']
+    def __ensure_network(self) -> None:
+        with self.__network_lock:
+            if self.__network_ready:
+                return
 
-        self.__try_delete(
-            instance_id,
-            list(args.get('anvil_instances', {}).keys()),
-            list(args.get('daemon_instances', {}).keys()),
-        )
+            try:
+                self.__client.networks.get(INSTANCES_NETWORK_NAME)
+            except NotFound:
+                logger.info(f'creating the {INSTANCES_NETWORK_NAME} network on {self.__publish_address}')
+                self.__client.networks.create(INSTANCES_NETWORK_NAME, driver='bridge', check_duplicate=True)
+            self.__network_ready = True
+
+    @staticmethod
+    def __get_data_mount(anvil_args: LaunchAnvilInstanceArgs, volume: 'Volume') -> dict[str, Any]:
+        # note: the memory backed state survives anvil crashes, but not the container restarts
+        if anvil_args.get('persistence') == 'tmpfs':
+            return {'tmpfs': {'/data': f'size={ANVIL_TMPFS_SIZE}'}}
+        return {'mounts': [Mount(target='/data', source=volume.id)]}
+
+    def get_host_load(self) -> tuple[int, int]:
+        # Number of the running containers and the memory of the host that isn't reserved by the instances yet
+        info = self.__client.info()
+        instances = self.__client.containers.list(filters={'label': LABEL_INSTANCE})
+        reserved = sum(container.attrs['HostConfig'].get('Memory') or 0 for container in instances)
+        return info['ContainersRunning'], max(0, info['MemTotal'] - reserved)
+
+    def pull_images(self, images: list[str]) -> None:
+        # note: images that are already there aren't pulled again, so that `latest` won't change in the middle of a ctf
+        for image, present in self.__image_presence(images).items():
+            if present:
+                continue
+
+            logger.info(f'pulling image: {image}')
+            try:
+                self.__client.images.pull(image)
+            except APIError as e:
+                logger.opt(exception=e).error(f'failed to pull image: {image}')
+
+    def get_image_status(self, images: list[str]) -> dict[str, dict[str, bool]]:
+        return {image: {'local': present} for image, present in self.__image_presence(images).items()}
+
+    def __image_presence(self, images: list[str]) -> dict[str, bool]:
+        presence: dict[str, bool] = {}
+        for image in images:
+            try:
+                self.__client.images.get(image)
+            except NotFound:
+                presence[image] = False
+            else:
+                presence[image] = True
+        return presence
+
+    def reconcile(self) -> None:
+        # Everything that we have ever started is labelled, so the orphans could be found in a single listing
+        containers = self.__client.containers.list(all=True, filters={'label': LABEL_INSTANCE})
+        volumes = self.__client.volumes.list(filters={'label': LABEL_INSTANCE})
+
+        resources: defaultdict[str, _InstanceResources] = defaultdict(_InstanceResources)
+        for container in containers:
+            resources[container.labels[LABEL_INSTANCE]].add_container(container)
+        for volume in volumes:
+            resources[volume.attrs['Labels'][LABEL_INSTANCE]].add_volume(volume)
+
+        # note: instances are registered only once they're up, the fresh ones could still be launching
+        now = time.time()
+        candidates = [
+            instance_id
+            for instance_id, instance_resources in resources.items()
+            if now - instance_resources.created_at >= DOCKER_RECONCILE_GRACE
+        ]
+        if not candidates:
+            return
+
+        instances = self._database.get_instances(candidates)
+        orphans = [instance_id for instance_id, instance in zip(candidates, instances, strict=True) if instance is None]
+        if not orphans:
+            return
 
-    def kill_instance(self, instance_id: str) -> UserData | None:
-        instance = self._database.unregister_instance(instance_id)
-        if instance is None:
-            return None
+        logger.warning(f'removing {len(orphans)} orphaned instances: {", ".join(orphans)}')
+        with ThreadPoolExecutor(max_workers=DOCKER_RECONCILE_WORKERS, thread_name_prefix='Docker Reconcile') as pool:
+            for instance_id in orphans:
+                pool.submit(self.__delete_resources, resources[instance_id])
 
+    def _cleanup_instance(self, args: CreateInstanceRequest) -> None:
+        self.__delete_resources(self.__list_resources(args['instance_id']))
+
+    def destroy_instance(self, instance: UserData) -> None:
+        resources = self.__list_resources(instance['instance_id'])
+        if resources.containers or resources.volumes:
+            self.__delete_resources(resources)
+            return
+
+        # note: instances that were launched before the labels were introduced could only be found by their names
         self.__try_delete(
-            instance_id,
+            instance['instance_id'],
             list(instance.get('anvil_instances', {}).keys()),
             list(instance.get('daemon_instances', {}).keys()),
         )
 
-        return instance
+    def __list_resources(self, instance_id: str) -> '_InstanceResources':
+        label = f'{LABEL_INSTANCE}={instance_id}'
+        resources = _InstanceResources()
+        for container in self.__client.containers.list(all=True, filters={'label': label}):
+            resources.add_container(container)
+        for volume in self.__client.volumes.list(filters={'label': label}):
+            resources.add_volume(volume)
+        return resources
+
+    def __delete_resources(self, resources: '_InstanceResources') -> None:
+        # Volumes are in use until all of the containers are gone
+        for container in resources.containers:
+            self.__delete_container(container)
+        for volume in resources.volumes:
+            self.__delete_volume(volume)
 
     def __try_delete(self, instance_id: str, anvil_ids: list[str], daemon_ids: list[str]) -> None:
         for anvil_id in anvil_ids:
@@ -152,6 +335,9 @@ class DockerBackend(Backend):
         except NotFound:
             return
 
+        self.__delete_container(container)
+
+    def __delete_container(self, container: 'Container') -> None:
         logger.info(f'deleting container {container.id} ({container.name})')
         try:
             try:
@@ -161,6 +347,9 @@ class DockerBackend(Backend):
                 if api_error.status_code != http.client.CONFLICT:
                     raise
             container.remove()
+        except NotFound:
+            # note: the container has been deleted by someone else in the meantime
+            return
         except Exception as e:
             logger.opt(exception=e).error(f'failed to delete container {container.name} ({container.id})')
 
@@ -170,8 +359,13 @@ class DockerBackend(Backend):
         except NotFound:
             return
 
+        self.__delete_volume(volume)
+
+    def __delete_volume(self, volume: 'Volume') -> None:
         logger.info(f'deleting volume {volume.name} ({volume.id})')
         try:
             volume.remove()
+        except NotFound:
+            return
         except Exception as e:
             logger.opt(exception=e).error(f'failed to delete volume {volume.name} ({volume.id})')
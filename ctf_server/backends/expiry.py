@@ -0,0 +1,102 @@
+import heapq
+import os
+import time
+from collections.abc import Callable
+from threading import Condition, Thread
+
+from loguru import logger
+
+from ctf_server.databases.database import Database
+
+
+# The in-memory schedule is rebuilt from the database every so often, in case we've missed any event
+EXPIRY_RESYNC_INTERVAL = float(os.getenv('EXPIRY_RESYNC_INTERVAL', '60'))
+# Databases that only notify the listeners within the same process are resynced this often instead, otherwise the
+# launches and extensions made by the other workers would be seen by the leader's pruner only after a full interval
+EXPIRY_LOCAL_RESYNC_INTERVAL = float(os.getenv('EXPIRY_LOCAL_RESYNC_INTERVAL', '5'))
+
+
+class ExpiryScheduler:
+    """Sleeps until the closest instance expiry instead of polling the database."""
+
+    def __init__(
+        self,
+        database: Database,
+        on_expired: Callable[[], None],
+        name: str,
+        resync_interval: float | None = None,
+    ) -> None:
+        self.__database = database
+        self.__on_expired = on_expired
+        self.__name = name
+        if resync_interval is None:
+            resync_interval = EXPIRY_RESYNC_INTERVAL if database.shares_expiry_events else EXPIRY_LOCAL_RESYNC_INTERVAL
+        self.__resync_interval = resync_interval
+
+        self.__cond = Condition()
+        self.__expiries: dict[str, float] = {}
+        # Entries are never removed from the heap in place, the stale ones are skipped once they reach the top
+        self.__heap: list[tuple[float, str]] = []
+        self.__next_resync = 0.0
+
+    def start(self) -> None:
+        self.__database.add_expiry_listener(self.schedule)
+        Thread(target=self.__scheduler_thread, name=self.__name, daemon=True).start()
+
+    def schedule(self, instance_id: str, expires_at: float | None) -> None:
+        with self.__cond:
+            if expires_at is None:
+                self.__expiries.pop(instance_id, None)
+                return
+
+            self.__expiries[instance_id] = expires_at
+            heapq.heappush(self.__heap, (expires_at, instance_id))
+            self.__cond.notify()
+
+    @property
+    def pending(self) -> int:
+        with self.__cond:
+            return len(self.__expiries)
+
+    def __resync(self) -> None:
+        expiries = self.__database.get_expiries()
+        with self.__cond:
+            self.__expiries = expiries
+            self.__heap = [(expires_at, instance_id) for instance_id, expires_at in expiries.items()]
+            heapq.heapify(self.__heap)
+            self.__next_resync = time.monotonic() + self.__resync_interval
+
+    def __pop_expired(self) -> bool:
+        with self.__cond:
+            while True:
+                while self.__heap and self.__expiries.get(self.__heap[0][1]) != self.__heap[0][0]:
+                    heapq.heappop(self.__heap)
+
+                if time.monotonic() >= self.__next_resync:
+                    return False
+
+                now = time.time()
+                if self.__heap and self.__heap[0][0] <= now:
+                    break
+
+                timeout = self.__next_resync - time.monotonic()
+                if self.__heap:
+                    timeout = min(timeout, self.__heap[0][0] - now)
+                self.__cond.wait(timeout)
+
+            while self.__heap and self.__heap[0][0] <= now:
+                expires_at, instance_id = heapq.heappop(self.__heap)
+                # note: stale entries of the rescheduled instances mustn't drop their current schedule
+                if self.__expiries.get(instance_id) == expires_at:
+                    del self.__expiries[instance_id]
+            return True
+
+    def __scheduler_thread(self) -> None:
+        while True:
+            try:
+                if not self.__pop_expired():
+                    self.__resync()
+                self.__on_expired()
+            except Exception as e:
+                logger.opt(exception=e).error('expiry scheduler failed')
+                time.sleep(1)
@@ -0,0 +1,60 @@
+import os
+
+from loguru import logger
+
+from ctf_server.databases.database import Database
+from ctf_server.types import CreateInstanceRequest
+
+from .kubernetes_backend import KubernetesBackend
+from .placement import Load, PlacementBackend
+
+
+# Free capacity of the clusters is fetched again once it's older than this many seconds
+CLUSTER_CAPACITY_REFRESH_INTERVAL = float(os.getenv('CLUSTER_CAPACITY_REFRESH_INTERVAL', '30'))
+
+
+class FederatedKubernetesBackend(PlacementBackend):
+    """Places the instances on whichever of the kubernetes clusters has the most free capacity."""
+
+    member_kind = 'cluster'
+
+    def __init__(self, database: Database, members: dict[str, KubernetesBackend]) -> None:
+        self.__clusters = members
+        super().__init__(database, members)
+
+    @classmethod
+    def from_kubeconfigs(cls, database: Database, clusters: dict[str, str]) -> 'FederatedKubernetesBackend':
+        # note: members aren't pruning on their own, the instances are pruned through the federated backend instead
+        return cls(
+            database,
+            {
+                name: KubernetesBackend(database, kubeconfig, background_tasks=False)
+                for name, kubeconfig in clusters.items()
+            },
+        )
+
+    @property
+    def _refresh_interval(self) -> float:
+        return CLUSTER_CAPACITY_REFRESH_INTERVAL
+
+    def _fetch_load(self, name: str) -> Load:
+        # Clusters with the most free memory go first, then the ones with the most free cpu
+        free = self.__clusters[name].get_free_resources()
+        return -free.memory, -free.cpu
+
+    def _reserve_load(self, name: str, load: Load, args: CreateInstanceRequest) -> Load:
+        requests = self.__clusters[name].get_instance_requests(args)
+        return load[0] + requests.memory, load[1] + requests.cpu
+
+    def get_image_status(self, images: list[str]) -> dict[str, dict[str, bool]]:
+        status: dict[str, dict[str, bool]] = {image: {} for image in images}
+        for name, member in self.__clusters.items():
+            try:
+                member_status = member.get_image_status(images)
+            except Exception as e:
+                logger.opt(exception=e).warning(f'cannot fetch the images of {name}')
+                continue
+
+            for image, nodes in member_status.items():
+                status[image].update({f'{name}/{node}': present for node, present in nodes.items()})
+        return status
@@ -0,0 +1,167 @@
+import http.client
+import os
+import time
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Lock, Thread
+from typing import TYPE_CHECKING, cast
+
+from kubernetes import watch as k8s_watch
+from kubernetes.client.api import core_v1_api
+from kubernetes.client.exceptions import ApiException
+from loguru import logger
+
+
+if TYPE_CHECKING:
+    from kubernetes.client.models import V1ListMeta, V1ObjectMeta, V1Pod
+
+
+# The watch is restarted from the last seen resource version this often, the api server closes them anyway
+INFORMER_WATCH_TIMEOUT = int(os.getenv('INFORMER_WATCH_TIMEOUT', '300'))
+
+PodCheck = Callable[['V1Pod | None'], bool]
+
+
+def _pod_name(pod: 'V1Pod') -> str:
+    # note: objects coming from the api server always have the metadata filled in
+    return cast('str', cast('V1ObjectMeta', pod.metadata).name)
+
+
+@dataclass(eq=False)
+class _Waiter:
+    check: PodCheck
+    # Lists that have been started after the waiter was registered could tell that the pod doesn't exist
+    generation: int
+    future: Future['V1Pod | None'] = field(default_factory=Future)
+
+
+class PodInformer:
+    """Keeps a local cache of the pods through a single long-lived watch and wakes up the threads waiting for them."""
+
+    def __init__(
+        self,
+        core_v1: core_v1_api.CoreV1Api,
+        name: str,
+        namespace: str = 'default',
+        label_selector: str = 'app=anvil',
+    ) -> None:
+        self.__core_v1 = core_v1
+        self.__name = name
+        self.__namespace = namespace
+        self.__label_selector = label_selector
+
+        self.__lock = Lock()
+        self.__pods: dict[str, V1Pod] = {}
+        self.__waiters: defaultdict[str, list[_Waiter]] = defaultdict(list)
+        self.__generation = 0
+
+    def start(self) -> None:
+        Thread(target=self.__informer_thread, name=self.__name, daemon=True).start()
+
+    @contextmanager
+    def expect(self, name: str, check: PodCheck) -> Iterator[Future['V1Pod | None']]:
+        """Registers a waiter that is resolved once `check` passes for the pod, or fails if `check` raises.
+
+        `check` receives None once the pod is gone. The waiter should be registered before the request that changes
+        the pod is sent, so that the event won't be missed.
+        """
+        with self.__lock:
+            waiter = _Waiter(check, self.__generation)
+            # note: the pod that is not in the cache could also be the one that we haven't seen yet
+            pod = self.__pods.get(name)
+            if pod is None or not self.__resolve(waiter, pod):
+                self.__waiters[name].append(waiter)
+
+        try:
+            yield waiter.future
+        finally:
+            with self.__lock:
+                if waiter in self.__waiters.get(name, []):
+                    self.__waiters[name].remove(waiter)
+                    if not self.__waiters[name]:
+                        del self.__waiters[name]
+
+    @staticmethod
+    def __resolve(waiter: _Waiter, pod: 'V1Pod | None') -> bool:
+        try:
+            if not waiter.check(pod):
+                return False
+            waiter.future.set_result(pod)
+        except Exception as e:
+            waiter.future.set_exception(e)
+        return True
+
+    def __notify(self, name: str, pod: 'V1Pod | None', generation: int | None = None) -> None:
+        waiters = self.__waiters.get(name)
+        if not waiters:
+            return
+
+        pending = [
+            waiter
+            for waiter in waiters
+            if (pod is None and generation is not None and waiter.generation >= generation)
+            or not self.__resolve(waiter, pod)
+        ]
+        if pending:
+            self.__waiters[name] = pending
+        else:
+            del self.__waiters[name]
+
+    def __list(self) -> str:
+        with self.__lock:
+            self.__generation += 1
+            generation = self.__generation
+
+        pods = self.__core_v1.list_namespaced_pod(namespace=self.__namespace, label_selector=self.__label_selector)
+        with self.__lock:
+            self.__pods = {_pod_name(pod): pod for pod in pods.items}
+            for name in list(self.__waiters):
+                self.__notify(name, self.__pods.get(name), generation)
+
+        return cast('str', cast('V1ListMeta', pods.metadata).resource_version)
+
+    def __watch(self, resource_version: str) -> str:
+        w = k8s_watch.Watch()
+        for event in w.stream(
+            self.__core_v1.list_namespaced_pod,
+            namespace=self.__namespace,
+            label_selector=self.__label_selector,
+            resource_version=resource_version,
+            timeout_seconds=INFORMER_WATCH_TIMEOUT,
+            allow_watch_bookmarks=True,
+        ):
+            if event['type'] == 'BOOKMARK':
+                continue
+
+            pod: V1Pod = event['object']
+            name = _pod_name(pod)
+            with self.__lock:
+                if event['type'] == 'DELETED':
+                    self.__pods.pop(name, None)
+                    self.__notify(name, None)
+                else:
+                    self.__pods[name] = pod
+                    self.__notify(name, pod)
+
+        return w.resource_version or resource_version
+
+    def __informer_thread(self) -> None:
+        resource_version: str | None = None
+        while True:
+            try:
+                if resource_version is None:
+                    resource_version = self.__list()
+                resource_version = self.__watch(resource_version)
+            except ApiException as e:
+                # note: the resource version we've been watching from is too old, everything has to be listed again
+                if e.status != http.client.GONE:
+                    logger.opt(exception=e).warning('pod informer watch failed, relisting')
+                    time.sleep(1)
+                resource_version = None
+            except Exception as e:
+                logger.opt(exception=e).error('pod informer failed, relisting')
+                resource_version = None
+                time.sleep(1)
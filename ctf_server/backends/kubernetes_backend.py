@@ -1,31 +1,46 @@
 import http.client
+import os
 import shlex
 import time
-from collections.abc import Iterator
-from typing import TYPE_CHECKING, Any
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, Any, cast
 
-from kubernetes import config
-from kubernetes import watch as k8s_watch
+from kubernetes import client, config
 from kubernetes.client import V1EnvVar
-from kubernetes.client.api import core_v1_api
+from kubernetes.client.api import apps_v1_api, core_v1_api
 from kubernetes.client.exceptions import ApiException
 from loguru import logger
-from web3 import Web3
 
 from ctf_server.databases.database import Database
+from ctf_server.metrics import record_phase, timed
 from ctf_server.types import (
+    ANVIL_TMPFS_SIZE,
     DEFAULT_IMAGE,
     CreateInstanceRequest,
     InstanceInfo,
+    LaunchAnvilInstanceArgs,
     UserData,
     format_anvil_args,
     format_anvil_env,
 )
 
-from .backend import Backend
+from .backend import INSTANCE_START_TIMEOUT, Backend
+from .informer import PodCheck, PodInformer
+from .kubernetes_profiles import (
+    KUBERNETES_NAMESPACES,
+    KubernetesProfile,
+    Resources,
+    get_profile,
+    instance_requests,
+    load_profiles,
+    pod_spec_overrides,
+    shard_namespace,
+)
 
 
 if TYPE_CHECKING:
+    from concurrent.futures import Future
+
     from kubernetes.client.models import V1Pod
 
 
@@ -38,28 +53,175 @@ _CONTAINER_SECURITY_CONTEXT = {
     'seccompProfile': {'type': 'RuntimeDefault'},
 }
 
+_POD_DELETION_TIMEOUT = 120
+# Probing every second, anvil is given this many seconds to start listening before the container is restarted
+ANVIL_STARTUP_PROBE_FAILURES = int(os.getenv('ANVIL_STARTUP_PROBE_FAILURES', '120'))
+
+# Images are pre-pulled on every node by the init containers of this daemon set, it lives in the first namespace
+KUBERNETES_IMAGE_PREPULL_DAEMONSET = os.getenv('KUBERNETES_IMAGE_PREPULL_DAEMONSET', 'paradigmctf-image-prepull')
+KUBERNETES_PAUSE_IMAGE = os.getenv('KUBERNETES_PAUSE_IMAGE', 'registry.k8s.io/pause:3.10')
+# Its static busybox binary is what the pre-pulled images are running, so that they don't need anything of their own
+KUBERNETES_PREPULL_TOOLS_IMAGE = os.getenv('KUBERNETES_PREPULL_TOOLS_IMAGE', 'busybox:1.37')
+_IMAGES_ANNOTATION = 'paradigmctf/images'
+_PREPULL_TOOLS_PATH = '/prepull'
+
+
+class PodFailedError(Exception):
+    """Custom exception for pods that have terminated before becoming ready."""
+
+
+def _anvil_probes(port: int) -> dict[str, Any]:
+    return {
+        'startupProbe': {
+            'tcpSocket': {'port': port},
+            'periodSeconds': 1,
+            'failureThreshold': ANVIL_STARTUP_PROBE_FAILURES,
+        },
+        'readinessProbe': {
+            'tcpSocket': {'port': port},
+            'periodSeconds': 5,
+            'failureThreshold': 3,
+        },
+    }
+
+
+def _anvil_resources(profile: KubernetesProfile, anvil_args: LaunchAnvilInstanceArgs) -> dict[str, dict[str, str]]:
+    # The memory limit of the chain takes precedence over the one from the placement profile
+    resources = profile.get('resources', {})
+    memory_limit = anvil_args.get('memory_limit')
+    if memory_limit is None:
+        return resources
+    return {**resources, 'limits': {**resources.get('limits', {}), 'memory': str(memory_limit)}}
+
+
+def _is_pod_ready(anvil_ids: list[str]) -> PodCheck:
+    # note: daemons have no probes and could be crash looping until the chains are up, so only anvils are checked
+    def check(pod: 'V1Pod | None') -> bool:
+        if pod is None or pod.status is None:
+            return False
+        if pod.status.phase in ('Failed', 'Succeeded'):
+            msg = f'pod has terminated: {pod.status.phase}'
+            raise PodFailedError(msg)
+
+        ready = {status.name for status in pod.status.container_statuses or [] if status.ready}
+        return ready.issuperset(anvil_ids)
+
+    return check
+
+
+def _image_prepull_daemon_set(namespace: str, images: list[str]) -> dict[str, Any]:
+    # note: init containers are only there for their images to be pulled. The images could be missing a shell or even
+    # a libc, so they're running a static `true` that the first init container copies into a shared volume, otherwise
+    # an image that can't start would be crash looping and holding up the ones after it
+    labels = {'app': KUBERNETES_IMAGE_PREPULL_DAEMONSET}
+    tools_mount = {'name': 'prepull-tools', 'mountPath': _PREPULL_TOOLS_PATH}
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'DaemonSet',
+        'metadata': {
+            'name': KUBERNETES_IMAGE_PREPULL_DAEMONSET,
+            'namespace': namespace,
+            'labels': labels,
+            'annotations': {_IMAGES_ANNOTATION: ','.join(images)},
+        },
+        'spec': {
+            'selector': {'matchLabels': labels},
+            'template': {
+                'metadata': {'labels': labels},
+                'spec': {
+                    'initContainers': [
+                        {
+                            'name': 'prepull-tools',
+                            'image': KUBERNETES_PREPULL_TOOLS_IMAGE,
+                            # note: busybox picks the applet by the name that it's called with
+                            'command': ['cp', '/bin/busybox', f'{_PREPULL_TOOLS_PATH}/true'],
+                            'volumeMounts': [tools_mount],
+                            'securityContext': _CONTAINER_SECURITY_CONTEXT,
+                        },
+                        *(
+                            {
+                                'name': f'image-{offset}',
+                                'image': image,
+                                'command': [f'{_PREPULL_TOOLS_PATH}/true'],
+                                'volumeMounts': [tools_mount],
+                                'securityContext': _CONTAINER_SECURITY_CONTEXT,
+                            }
+                            for offset, image in enumerate(images)
+                        ),
+                    ],
+                    'containers': [
+                        {
+                            'name': 'pause',
+                            'image': KUBERNETES_PAUSE_IMAGE,
+                            'resources': {'requests': {'cpu': '1m', 'memory': '8Mi'}},
+                            'securityContext': _CONTAINER_SECURITY_CONTEXT,
+                        }
+                    ],
+                    'volumes': [{'name': 'prepull-tools', 'emptyDir': {}}],
+                    # Challenge nodes are usually tainted, the images have to be there as well
+                    'tolerations': [{'operator': 'Exists'}],
+                    'securityContext': _POD_SECURITY_CONTEXT,
+                },
+            },
+        },
+    }
+
+
+def _record_pod_scheduling(pod: 'V1Pod') -> None:
+    # note: kubernetes timestamps have a second resolution, this is only telling apart the slow schedules
+    if pod.metadata is None or pod.metadata.creation_timestamp is None or pod.status is None:
+        return
+
+    for condition in pod.status.conditions or []:
+        if condition.type == 'PodScheduled' and condition.status == 'True' and condition.last_transition_time:
+            seconds = (condition.last_transition_time - pod.metadata.creation_timestamp).total_seconds()
+            record_phase('pod_scheduling', max(seconds, 0.0))
+            return
+
+
+def _is_pod_deleted(pod: 'V1Pod | None') -> bool:
+    return pod is None
+
 
 class KubernetesBackend(Backend):
-    def __init__(self, database: Database, kubeconfig: str) -> None:
+    def __init__(self, database: Database, kubeconfig: str, *, background_tasks: bool = True) -> None:
+        # note: every backend has its own api client, so that there could be multiple clusters within one process
         if kubeconfig == 'incluster':
-            config.load_incluster_config()
+            configuration = client.Configuration()
+            config.load_incluster_config(client_configuration=configuration)
+            api_client = client.ApiClient(configuration)
         else:
-            config.load_kube_config(kubeconfig)
+            api_client = config.new_client_from_config(kubeconfig)
 
-        self.__core_v1 = core_v1_api.CoreV1Api()
+        self.__core_v1 = core_v1_api.CoreV1Api(api_client)
+        self.__apps_v1 = apps_v1_api.AppsV1Api(api_client)
+        self.__profiles = load_profiles()
+        self.__namespaces = KUBERNETES_NAMESPACES
+
+        # Launches and kills are waiting for the pods through a single shared watch instead of opening their own
+        self.__informers = {
+            namespace: PodInformer(self.__core_v1, f'Kubernetes Pod Informer ({namespace})', namespace)
+            for namespace in self.__namespaces
+        }
+        for informer in self.__informers.values():
+            informer.start()
 
         # note(es3n1n, 28.03.24): see docker backend ctor if you're wondering why we are doing this after the vars init
-        super().__init__(database)
+        super().__init__(database, background_tasks=background_tasks)
 
     def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
         instance_id = request['instance_id']
+        namespace = self.__namespace(instance_id)
+        profile = get_profile(self.__profiles, request['challenge_name'])
+        deadline = time.monotonic() + INSTANCE_START_TIMEOUT
 
-        anvil_containers, anvil_volumes = self.__get_anvil_containers_and_volumes(request)
+        anvil_containers, anvil_volumes = self.__get_anvil_containers_and_volumes(request, profile)
         pod_manifest = {
             'apiVersion': 'v1',
             'kind': 'Pod',
             'metadata': {
                 'name': instance_id,
+                'namespace': namespace,
                 'labels': {
                     'app': 'anvil',
                     'category': 'blockchain',
@@ -72,12 +234,18 @@ class KubernetesBackend(Backend):
                 'automountServiceAccountToken': False,
                 'securityContext': _POD_SECURITY_CONTEXT,
                 'volumes': anvil_volumes,
-                'containers': anvil_containers + self.__get_daemon_containers(request),
+                'containers': anvil_containers + self.__get_daemon_containers(request, profile),
+                **pod_spec_overrides(profile, {'app': 'anvil'}),
             },
         }
 
-        self.__core_v1.create_namespaced_pod(namespace='default', body=pod_manifest)
-        api_response = self._wait_for_pod_ready(instance_id)
+        informer = self.__informers[namespace]
+        with informer.expect(instance_id, _is_pod_ready(list(request.get('anvil_instances', {})))) as ready:
+            with timed('create_pod'):
+                self.__core_v1.create_namespaced_pod(namespace=namespace, body=pod_manifest)
+            with timed('pod_ready'):
+                api_response = cast('V1Pod', self._wait_for_pod(instance_id, ready, 'become ready', deadline))
+        _record_pod_scheduling(api_response)
 
         anvil_instances: dict[str, InstanceInfo] = {}
         for offset, anvil_id in enumerate(request.get('anvil_instances', {}).keys()):
@@ -88,12 +256,7 @@ class KubernetesBackend(Backend):
             }
             self._remap_extra_anvil_keys(anvil_instances[anvil_id], request['anvil_instances'][anvil_id])
 
-            self._prepare_node(
-                request['anvil_instances'][anvil_id],
-                Web3(
-                    Web3.HTTPProvider(f'http://{anvil_instances[anvil_id]["ip"]}:{anvil_instances[anvil_id]["port"]}')
-                ),
-            )
+        self._prepare_nodes(request.get('anvil_instances', {}), anvil_instances, deadline)
 
         daemon_instances: dict[str, InstanceInfo] = {}
         for daemon_id in request.get('daemon_instances', {}):
@@ -108,10 +271,76 @@ class KubernetesBackend(Backend):
             anvil_instances=anvil_instances,
             daemon_instances=daemon_instances,
             metadata={},
+            namespace=namespace,
         )
 
+    def get_free_resources(self) -> Resources:
+        # Allocatable resources of the schedulable nodes, minus whatever the pods on them have requested
+        nodes: dict[str, Resources] = {}
+        for node in self.__core_v1.list_node().items:
+            if node.metadata is None or node.status is None or (node.spec is not None and node.spec.unschedulable):
+                continue
+            if any(c.type == 'Ready' and c.status == 'True' for c in node.status.conditions or []):
+                nodes[cast('str', node.metadata.name)] = Resources.parse(node.status.allocatable)
+        free = sum(nodes.values(), Resources())
+
+        pods = self.__core_v1.list_pod_for_all_namespaces(field_selector='status.phase!=Succeeded,status.phase!=Failed')
+        for pod in pods.items:
+            if pod.spec is None or pod.spec.node_name not in nodes:
+                continue
+            for container in pod.spec.containers:
+                free -= Resources.parse(container.resources.requests if container.resources else None)
+        return free
+
+    def pull_images(self, images: list[str]) -> None:
+        namespace = self.__namespaces[0]
+        manifest = _image_prepull_daemon_set(namespace, images)
+        try:
+            existing = self.__apps_v1.read_namespaced_daemon_set(KUBERNETES_IMAGE_PREPULL_DAEMONSET, namespace)
+        except ApiException as e:
+            if e.status != http.client.NOT_FOUND:
+                raise
+            logger.info(f'creating the image pre-pull daemon set with {len(images)} images')
+            self.__apps_v1.create_namespaced_daemon_set(namespace, manifest)  # type: ignore[arg-type]
+            return
+
+        annotations = (existing.metadata.annotations if existing.metadata else None) or {}
+        if annotations.get(_IMAGES_ANNOTATION) == manifest['metadata']['annotations'][_IMAGES_ANNOTATION]:
+            return
+
+        logger.info(f'updating the image pre-pull daemon set with {len(images)} images')
+        self.__apps_v1.replace_namespaced_daemon_set(
+            KUBERNETES_IMAGE_PREPULL_DAEMONSET,
+            namespace,
+            manifest,  # type: ignore[arg-type]
+        )
+
+    def get_image_status(self, images: list[str]) -> dict[str, dict[str, bool]]:
+        status: dict[str, dict[str, bool]] = {image: {} for image in images}
+        for node in self.__core_v1.list_node().items:
+            if node.metadata is None or node.status is None:
+                continue
+
+            # note: nodes are reporting the normalized names, e.g. `docker.io/library/` is prepended to the short ones
+            names = {name for node_image in node.status.images or [] for name in node_image.names or []}
+            for image in images:
+                status[image][cast('str', node.metadata.name)] = any(
+                    name == image or name.endswith(f'/{image}') for name in names
+                )
+        return status
+
+    def get_instance_requests(self, request: CreateInstanceRequest) -> Resources:
+        return instance_requests(
+            get_profile(self.__profiles, request['challenge_name']),
+            len(request.get('anvil_instances', {})),
+            len(request.get('daemon_instances', {})),
+        )
+
+    def __namespace(self, instance_id: str) -> str:
+        return shard_namespace(instance_id, self.__namespaces)
+
     def __get_anvil_containers_and_volumes(
-        self, args: CreateInstanceRequest
+        self, args: CreateInstanceRequest, profile: KubernetesProfile
     ) -> tuple[list[Any], list[dict[str, str | dict]]]:
         # Making sure we're using the same items list order in both things
         volumes: list[dict[str, str | dict]] = []
@@ -122,7 +351,11 @@ class KubernetesBackend(Backend):
             volumes.append(
                 {
                     'name': volume_name,
-                    'emptyDir': {},
+                    'emptyDir': (
+                        {'medium': 'Memory', 'sizeLimit': str(ANVIL_TMPFS_SIZE)}
+                        if anvil_args.get('persistence') == 'tmpfs'
+                        else {}
+                    ),
                 }
             )
             containers.append(
@@ -145,12 +378,14 @@ class KubernetesBackend(Backend):
                     ],
                     'env': [V1EnvVar(name=k, value=v) for k, v in format_anvil_env(anvil_args).items()],
                     'securityContext': _CONTAINER_SECURITY_CONTEXT,
+                    'resources': _anvil_resources(profile, anvil_args),
+                    **_anvil_probes(8545 + offset),
                 }
             )
 
         return containers, volumes
 
-    def __get_daemon_containers(self, args: CreateInstanceRequest) -> list[Any]:
+    def __get_daemon_containers(self, args: CreateInstanceRequest, profile: KubernetesProfile) -> list[Any]:
         return [
             {
                 'name': daemon_id,
@@ -162,66 +397,56 @@ class KubernetesBackend(Backend):
                     }
                 ],
                 'securityContext': _CONTAINER_SECURITY_CONTEXT,
+                'resources': profile.get('daemon_resources', {}),
             }
             for (daemon_id, daemon_args) in args.get('daemon_instances', {}).items()
         ]
 
-    def kill_instance(self, instance_id: str) -> UserData | None:
-        instance = self._database.unregister_instance(instance_id)
-        if instance is None:
-            return None
-
-        self.__core_v1.delete_namespaced_pod(namespace='default', name=instance_id, grace_period_seconds=0)
-        self._wait_for_pod_deletion(instance_id)
-
-        return instance
-
-    def _watch_pod(self, instance_id: str, timeout: int = 120, **kwargs: str) -> Iterator[dict]:
-        w = k8s_watch.Watch()
-        yield from w.stream(
-            self.__core_v1.list_namespaced_pod,
-            namespace='default',
-            field_selector=f'metadata.name={instance_id}',
-            timeout_seconds=timeout,
-            **kwargs,
-        )
+    def destroy_instance(self, instance: UserData) -> None:
+        # note: the namespaces could have been changed since the launch, so the one the pod was created in is used
+        self._delete_pod(instance['instance_id'], namespace=instance.get('namespace'))
 
-    def _wait_for_pod_ready(self, instance_id: str, timeout: int = 120) -> 'V1Pod':
-        for event in self._watch_pod(instance_id, timeout):
-            pod: V1Pod = event['object']
-            if pod.status.phase != 'Pending':
-                return pod
-
-        msg = f'pod {instance_id} did not become ready within {timeout}s'
-        raise TimeoutError(msg)
-
-    def _wait_for_pod_deletion(self, instance_id: str, timeout: int = 120) -> None:
+    @staticmethod
+    def _wait_for_pod(instance_id: str, future: 'Future[V1Pod | None]', action: str, deadline: float) -> 'V1Pod | None':
         try:
-            pod = self.__core_v1.read_namespaced_pod(name=instance_id, namespace='default')
-        except ApiException as e:
-            if e.status == http.client.NOT_FOUND:
-                return
-            raise
-
-        for event in self._watch_pod(instance_id, timeout, resource_version=pod.metadata.resource_version):
-            if event['type'] == 'DELETED':
+            return future.result(max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            msg = f'pod {instance_id} did not {action} in time'
+            raise TimeoutError(msg) from None
+
+    def _delete_pod(
+        self, instance_id: str, propagation_policy: str | None = None, namespace: str | None = None
+    ) -> None:
+        namespace = namespace or self.__namespace(instance_id)
+        # Namespaces that are no longer configured aren't watched, their pods are deleted without waiting for them
+        informer = self.__informers.get(namespace)
+
+        # note: waiting until the pod disappears so that a subsequent launch can reuse the name
+        with informer.expect(instance_id, _is_pod_deleted) if informer is not None else nullcontext() as deleted:
+            try:
+                self.__core_v1.delete_namespaced_pod(
+                    namespace=namespace,
+                    name=instance_id,
+                    grace_period_seconds=0,
+                    propagation_policy=propagation_policy,
+                )
+            except ApiException as e:
+                if e.status == http.client.NOT_FOUND:
+                    return
+                raise
+
+            if deleted is None:
                 return
+            try:
+                self._wait_for_pod(instance_id, deleted, 'terminate', time.monotonic() + _POD_DELETION_TIMEOUT)
+            except TimeoutError as e:
+                logger.warning(str(e))
 
     def _cleanup_instance(self, args: CreateInstanceRequest) -> None:
         instance_id = args['instance_id']
         logger.warning(f'cleaning up instance: {instance_id}')
 
         try:
-            self.__core_v1.delete_namespaced_pod(
-                namespace='default',
-                name=instance_id,
-                grace_period_seconds=0,
-                propagation_policy='Background',
-            )
+            self._delete_pod(instance_id, propagation_policy='Background')
         except ApiException as e:
-            if e.status != http.client.NOT_FOUND:
-                logger.opt(exception=e).error(f'cannot delete pod {instance_id} during cleanup')
-                return
-
-        # wait until the pod disappears so that a subsequent launch can reuse the name
-        self._wait_for_pod_deletion(instance_id)
+            logger.opt(exception=e).error(f'cannot delete pod {instance_id} during cleanup')
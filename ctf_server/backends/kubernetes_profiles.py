@@ -0,0 +1,119 @@
+import json
+import os
+import zlib
+from dataclasses import dataclass
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, NotRequired, TypedDict, cast
+
+from kubernetes.utils.quantity import parse_quantity
+
+
+# JSON object with profiles keyed by the challenge name, challenges that are not listed are using the `default` one
+KUBERNETES_PROFILES_PATH = os.getenv('KUBERNETES_PROFILES_PATH', '')
+# Comma separated list of namespaces that the instances are sharded between
+KUBERNETES_NAMESPACES = [x.strip() for x in os.getenv('KUBERNETES_NAMESPACES', 'default').split(',') if x.strip()]
+
+DEFAULT_PROFILE = 'default'
+
+
+class KubernetesProfileError(Exception):
+    """Custom exception for invalid kubernetes profiles."""
+
+
+class KubernetesProfile(TypedDict):
+    # Container resources, e.g. {"requests": {"cpu": "250m"}, "limits": {"memory": "1Gi"}}
+    resources: NotRequired[dict[str, dict[str, str]]]
+    daemon_resources: NotRequired[dict[str, dict[str, str]]]
+    node_selector: NotRequired[dict[str, str]]
+    tolerations: NotRequired[list[dict[str, Any]]]
+    affinity: NotRequired[dict[str, Any]]
+    priority_class_name: NotRequired[str]
+    # Instances are spread evenly across each of these node labels
+    spread_topology_keys: NotRequired[list[str]]
+    spread_max_skew: NotRequired[int]
+
+
+_BUILTIN_DEFAULT_PROFILE = KubernetesProfile(
+    spread_topology_keys=['kubernetes.io/hostname', 'topology.kubernetes.io/zone'],
+)
+
+
+def load_profiles(path: str = KUBERNETES_PROFILES_PATH) -> dict[str, KubernetesProfile]:
+    profiles: dict[str, KubernetesProfile] = {}
+    if path:
+        raw = json.loads(Path(path).read_text())
+        if not isinstance(raw, dict) or not all(isinstance(v, dict) for v in raw.values()):
+            msg = f'{path} should contain an object of profiles'
+            raise KubernetesProfileError(msg)
+
+        for name, profile in raw.items():
+            unknown = set(profile) - set(KubernetesProfile.__annotations__)
+            if unknown:
+                msg = f'unknown keys in the {name} profile: {", ".join(sorted(unknown))}'
+                raise KubernetesProfileError(msg)
+            profiles[name] = cast('KubernetesProfile', profile)
+
+    profiles.setdefault(DEFAULT_PROFILE, _BUILTIN_DEFAULT_PROFILE)
+    return profiles
+
+
+def get_profile(profiles: dict[str, KubernetesProfile], challenge_name: str) -> KubernetesProfile:
+    # note: challenge profiles are only overriding the keys that they specify
+    return cast('KubernetesProfile', {**profiles[DEFAULT_PROFILE], **profiles.get(challenge_name, {})})
+
+
+def shard_namespace(instance_id: str, namespaces: list[str]) -> str:
+    # note: python's hash() is salted per process, and every worker has to come up with the same namespace
+    return namespaces[zlib.crc32(instance_id.encode()) % len(namespaces)]
+
+
+def pod_spec_overrides(profile: KubernetesProfile, match_labels: dict[str, str]) -> dict[str, Any]:
+    spec: dict[str, Any] = {}
+    if 'node_selector' in profile:
+        spec['nodeSelector'] = profile['node_selector']
+    if 'tolerations' in profile:
+        spec['tolerations'] = profile['tolerations']
+    if 'affinity' in profile:
+        spec['affinity'] = profile['affinity']
+    if 'priority_class_name' in profile:
+        spec['priorityClassName'] = profile['priority_class_name']
+
+    # note: spreading is a preference only, nodes that don't have the label are still usable
+    if profile.get('spread_topology_keys'):
+        spec['topologySpreadConstraints'] = [
+            {
+                'maxSkew': profile.get('spread_max_skew', 1),
+                'topologyKey': topology_key,
+                'whenUnsatisfiable': 'ScheduleAnyway',
+                'labelSelector': {'matchLabels': match_labels},
+            }
+            for topology_key in profile['spread_topology_keys']
+        ]
+    return spec
+
+
+@dataclass(frozen=True)
+class Resources:
+    cpu: Decimal = Decimal(0)
+    memory: Decimal = Decimal(0)
+
+    def __add__(self, other: 'Resources') -> 'Resources':
+        return Resources(self.cpu + other.cpu, self.memory + other.memory)
+
+    def __sub__(self, other: 'Resources') -> 'Resources':
+        return Resources(self.cpu - other.cpu, self.memory - other.memory)
+
+    @classmethod
+    def parse(cls, quantities: dict[str, str] | None) -> 'Resources':
+        quantities = quantities or {}
+        return cls(
+            cpu=parse_quantity(quantities.get('cpu', '0')),
+            memory=parse_quantity(quantities.get('memory', '0')),
+        )
+
+
+def instance_requests(profile: KubernetesProfile, anvils: int, daemons: int) -> Resources:
+    anvil = Resources.parse(profile.get('resources', {}).get('requests'))
+    daemon = Resources.parse(profile.get('daemon_resources', {}).get('requests'))
+    return Resources(anvil.cpu * anvils + daemon.cpu * daemons, anvil.memory * anvils + daemon.memory * daemons)
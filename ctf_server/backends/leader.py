@@ -0,0 +1,79 @@
+import atexit
+import os
+import socket
+import time
+import uuid
+from collections.abc import Callable
+from threading import Thread
+
+from loguru import logger
+
+from ctf_server.databases.database import Database
+
+
+# The leader has to renew its lease within this many seconds, otherwise another process takes over
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', '15'))
+
+
+class LeaderElector:
+    """Elects a single process among all the workers and replicas through a lease in the shared database."""
+
+    def __init__(self, database: Database, name: str, ttl: float = LEADER_LEASE_TTL) -> None:
+        self.__database = database
+        self.__lease = f'leader/{name}'
+        self.__ttl = ttl
+        self.__owner = f'{socket.gethostname()}/{os.getpid()}/{uuid.uuid4().hex[:8]}'
+
+        self.__leading_until = 0.0
+        self.__listeners: list[Callable[[], None]] = []
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self.__leading_until
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        # Called every time this process becomes the leader, e.g. to catch up on the work of the previous one
+        self.__listeners.append(listener)
+
+    def start(self) -> None:
+        Thread(target=self.__elector_thread, name=f'Leader Elector {self.__lease}', daemon=True).start()
+        # note: stepping down on a clean shutdown, so that the others won't have to wait for the lease to expire
+        atexit.register(self.__step_down)
+
+    def __elector_thread(self) -> None:
+        while True:
+            self.__elect()
+            time.sleep(self.__ttl / 3)
+
+    def __elect(self) -> None:
+        started_at = time.monotonic()
+        try:
+            acquired = self.__database.acquire_lease(self.__lease, self.__owner, self.__ttl)
+        except Exception as e:
+            logger.warning(f'failed to renew the lease: {self.__lease}: {e}')
+            acquired = False
+
+        was_leader = self.is_leader
+        # We're stepping down a third of the ttl earlier than the lease expires in the database, in case the clocks
+        # are drifting apart or the renewal is late
+        self.__leading_until = started_at + self.__ttl * 2 / 3 if acquired else 0.0
+        if acquired == was_leader:
+            return
+
+        if not acquired:
+            logger.warning(f'lost the leadership: {self.__lease}')
+            return
+
+        logger.info(f'became the leader: {self.__lease}')
+        for listener in self.__listeners:
+            try:
+                listener()
+            except Exception as e:
+                logger.opt(exception=e).error('leader listener failed')
+
+    def __step_down(self) -> None:
+        self.__leading_until = 0.0
+        try:
+            self.__database.release_lease(self.__lease, self.__owner)
+        except Exception as e:
+            logger.opt(exception=e).warning(f'failed to release the lease: {self.__lease}')
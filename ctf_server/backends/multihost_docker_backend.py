@@ -0,0 +1,97 @@
+import os
+from urllib.parse import urlparse
+
+import docker
+from docker.utils import kwargs_from_env
+from loguru import logger
+
+from ctf_server.databases.database import Database
+from ctf_server.types import CreateInstanceRequest
+from ctf_server.utils import parse_members
+
+from .docker_backend import DockerBackend
+from .placement import Load, PlacementBackend
+from .reconciler import Reconciler
+
+
+# Load of the hosts is fetched again once it's older than this many seconds
+DOCKER_HOST_LOAD_REFRESH_INTERVAL = float(os.getenv('DOCKER_HOST_LOAD_REFRESH_INTERVAL', '10'))
+# Private addresses that the anvil ports are published on as name=address pairs, e.g. `a=10.0.0.2`, the hosts that
+# aren't listed here are publishing them on their address from DOCKER_HOSTS
+DOCKER_PUBLISH_BIND = os.getenv('DOCKER_PUBLISH_BIND', '')
+
+
+def connect_docker_host(url: str) -> docker.DockerClient:
+    # note: tls settings are the same for every host and come from DOCKER_TLS_VERIFY/DOCKER_CERT_PATH
+    kwargs = kwargs_from_env()
+    kwargs['base_url'] = url
+    # note: shelling out to the ssh binary, so that ssh configs and agents are working as usual
+    return docker.DockerClient(**kwargs, use_ssh_client=url.startswith('ssh://'))
+
+
+class MultiHostDockerBackend(PlacementBackend):
+    """Places the instances on whichever of the docker hosts runs the least containers."""
+
+    member_kind = 'docker host'
+
+    def __init__(self, database: Database, members: dict[str, DockerBackend]) -> None:
+        self.__hosts = members
+        super().__init__(database, members)
+
+        # note: members aren't reconciling on their own either
+        self._reconciler = Reconciler(self.reconcile, f'{self.__class__.__name__} Reconciler', leader=self._leader)
+        if self._leader is not None:
+            self._reconciler.start()
+
+    @classmethod
+    def from_urls(cls, database: Database, hosts: dict[str, str]) -> 'MultiHostDockerBackend':
+        binds = parse_members(DOCKER_PUBLISH_BIND) if DOCKER_PUBLISH_BIND else {}
+        members: dict[str, DockerBackend] = {}
+        for name, url in hosts.items():
+            address = urlparse(url).hostname
+            if address is None:
+                msg = f'cannot tell the address of the docker host {name} from {url}'
+                raise ValueError(msg)
+
+            # note: members aren't pruning on their own, the instances are pruned through this backend instead
+            members[name] = DockerBackend(
+                database,
+                connect_docker_host(url),
+                publish_address=address,
+                publish_bind=binds.get(name, address),
+                background_tasks=False,
+            )
+        return cls(database, members)
+
+    @property
+    def _refresh_interval(self) -> float:
+        return DOCKER_HOST_LOAD_REFRESH_INTERVAL
+
+    def _fetch_load(self, name: str) -> Load:
+        # Hosts with the fewest containers go first, ties are broken by the free memory of the host
+        running, free_memory = self.__hosts[name].get_host_load()
+        return running, -free_memory
+
+    def _reserve_load(self, _: str, load: Load, args: CreateInstanceRequest) -> Load:
+        containers = len(args.get('anvil_instances', {})) + len(args.get('daemon_instances', {}))
+        return load[0] + containers, load[1]
+
+    def reconcile(self) -> None:
+        for name, member in self.__hosts.items():
+            try:
+                member.reconcile()
+            except Exception as e:
+                logger.opt(exception=e).error(f'cannot reconcile {name}')
+
+    def get_image_status(self, images: list[str]) -> dict[str, dict[str, bool]]:
+        status: dict[str, dict[str, bool]] = {image: {} for image in images}
+        for name, member in self.__hosts.items():
+            try:
+                member_status = member.get_image_status(images)
+            except Exception as e:
+                logger.opt(exception=e).warning(f'cannot fetch the images of {name}')
+                continue
+
+            for image, locations in member_status.items():
+                status[image][name] = all(locations.values())
+        return status
@@ -0,0 +1,125 @@
+import abc
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from threading import Lock
+
+from loguru import logger
+
+from ctf_server.databases.database import Database
+from ctf_server.types import CreateInstanceRequest, UserData
+
+from .backend import Backend
+
+
+# Load of a member, the members with the lowest one are tried first
+Load = tuple[int | Decimal, ...]
+
+
+class PlacementBackend(Backend):
+    """Places the instances on one of the member backends, the least loaded ones go first."""
+
+    # Shown in the logs and errors, e.g. `cluster` or `docker host`
+    member_kind = 'member'
+
+    def __init__(self, database: Database, members: Mapping[str, Backend]) -> None:
+        self.__members = members
+        self.__lock = Lock()
+        self.__refresh_lock = Lock()
+        # Members that we failed to query are None
+        self.__load: dict[str, Load | None] = {}
+        self.__refreshed_at = 0.0
+
+        super().__init__(database)
+
+    @property
+    @abc.abstractmethod
+    def _refresh_interval(self) -> float:
+        # Load of the members is fetched again once it's older than this many seconds
+        pass
+
+    @abc.abstractmethod
+    def _fetch_load(self, name: str) -> Load:
+        pass
+
+    @abc.abstractmethod
+    def _reserve_load(self, name: str, load: Load, args: CreateInstanceRequest) -> Load:
+        # Load of the member once the instance has been placed on it, until the next refresh
+        pass
+
+    def _launch_instance_impl(self, args: CreateInstanceRequest) -> UserData:
+        last_error: Exception | None = None
+        for name in self.__ranked_members():
+            try:
+                user_data = self.__members[name].create_instance(args)
+            except Exception as e:
+                logger.opt(exception=e).warning(f'cannot launch {args["instance_id"]} on {name}, spilling over')
+                last_error = e
+                continue
+
+            user_data['placement'] = name
+            self.__reserve(name, args)
+            return user_data
+
+        msg = f'no {self.member_kind} could launch the instance {args["instance_id"]}'
+        raise RuntimeError(msg) from last_error
+
+    def pull_images(self, images: list[str]) -> None:
+        # note: members are logging their own failures, a slow member doesn't hold up the others
+        with ThreadPoolExecutor(max_workers=len(self.__members), thread_name_prefix='Image Pull') as pool:
+            for member in self.__members.values():
+                pool.submit(member.pull_images, images)
+
+    def _cleanup_instance(self, args: CreateInstanceRequest) -> None:
+        # note: members are cleaning up after their own failed launches in create_instance
+        pass
+
+    def destroy_instance(self, instance: UserData) -> None:
+        name = instance.get('placement')
+        if name is None or name not in self.__members:
+            logger.error(f'instance {instance["instance_id"]} has unknown placement {name}, cannot destroy it')
+            return
+
+        self.__members[name].destroy_instance(instance)
+
+    def __ranked_members(self) -> list[str]:
+        # note: members are queried over the network, so only one launch refreshes at a time and without holding the
+        # placement lock, the others keep going with the cached load unless there's none yet
+        if time.monotonic() - self.__refreshed_at >= self._refresh_interval and (
+            self.__refresh_lock.acquire(blocking=not self.__refreshed_at)
+        ):
+            try:
+                self.__refresh()
+            finally:
+                self.__refresh_lock.release()
+
+        with self.__lock:
+            load = dict(self.__load)
+
+        # The ones we failed to query are only tried as a last resort
+        def key(name: str) -> tuple[bool, Load]:
+            member_load = load.get(name)
+            return (True, ()) if member_load is None else (False, member_load)
+
+        return sorted(self.__members, key=key)
+
+    def __refresh(self) -> None:
+        load: dict[str, Load | None] = {}
+        for name in self.__members:
+            try:
+                load[name] = self._fetch_load(name)
+            except Exception as e:
+                logger.opt(exception=e).warning(f'cannot fetch the load of {self.member_kind} {name}')
+                load[name] = None
+
+        with self.__lock:
+            self.__load = load
+            self.__refreshed_at = time.monotonic()
+
+    def __reserve(self, name: str, args: CreateInstanceRequest) -> None:
+        # note: the cache is only a hint until the next refresh, concurrent launches shouldn't all pick the same member
+        with self.__lock:
+            member_load = self.__load.get(name)
+            if member_load is not None:
+                self.__load[name] = self._reserve_load(name, member_load, args)
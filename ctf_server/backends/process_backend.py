@@ -0,0 +1,243 @@
+import contextlib
+import json
+import os
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from filelock import FileLock
+from loguru import logger
+
+from ctf_server.databases.database import Database
+from ctf_server.metrics import timed
+from ctf_server.types import (
+    CreateInstanceRequest,
+    InstanceInfo,
+    UserData,
+    format_anvil_args,
+    format_anvil_env,
+)
+
+from .backend import INSTANCE_START_TIMEOUT, Backend, InstanceExistsError
+
+
+# Every instance gets its own directory with the chain state, logs and process groups of its processes
+PROCESS_BACKEND_ROOT = Path(os.getenv('PROCESS_BACKEND_ROOT', Path(tempfile.gettempdir()) / 'paradigmctf-instances'))
+# Inclusive range of the ports that anvils are listening on, e.g. `20000-29999`
+PROCESS_PORT_RANGE = os.getenv('PROCESS_PORT_RANGE', '20000-29999')
+# Interface that anvils are listening on, the anvil proxy has to be able to reach it
+PROCESS_BIND = os.getenv('PROCESS_BIND', '127.0.0.1')
+ANVIL_PATH = os.getenv('ANVIL_PATH', 'anvil')
+
+_PORTS_FILE = 'ports.json'
+_STOP_TIMEOUT = 10
+
+
+class ProcessBackendError(Exception):
+    """Custom exception for errors in the process backend."""
+
+
+def _parse_port_range(value: str) -> range:
+    start, _, end = value.partition('-')
+    try:
+        return range(int(start), int(end or start) + 1)
+    except ValueError:
+        msg = f'invalid port range: {value}'
+        raise ProcessBackendError(msg) from None
+
+
+def _is_port_free(host: str, port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+        except OSError:
+            return False
+    return True
+
+
+def _is_group_alive(pgid: int) -> bool:
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ProcessBackend(Backend):
+    """Runs anvils and daemons as local processes, without any container runtime."""
+
+    def __init__(
+        self,
+        database: Database,
+        root: Path = PROCESS_BACKEND_ROOT,
+        port_range: str = PROCESS_PORT_RANGE,
+        *,
+        background_tasks: bool = True,
+    ) -> None:
+        self.__root = root
+        self.__root.mkdir(parents=True, exist_ok=True)
+        self.__ports = _parse_port_range(port_range)
+        # note: ports are allocated by every worker, the lock makes sure that two launches won't pick the same ones
+        self.__ports_lock = FileLock(self.__root / 'ports.lock')
+
+        super().__init__(database, background_tasks=background_tasks)
+
+    def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
+        instance_id = request['instance_id']
+        instance_dir = self.__instance_dir(instance_id)
+        try:
+            instance_dir.mkdir(parents=True)
+        except FileExistsError:
+            if self._database.get_instance(instance_id) is not None:
+                msg = f'instance {instance_id} is already running'
+                raise InstanceExistsError(msg) from None
+
+            # note: launches are holding the lease of the instance, so a directory without a registered instance was
+            # left behind by a worker that has crashed or restarted during the launch, or after it
+            logger.warning(f'cleaning up orphaned instance: {instance_id}')
+            self.__try_delete(instance_id)
+            instance_dir.mkdir(parents=True)
+
+        # note: only the directory that this launch has created is cleaned up, the existing one belongs to a live
+        # instance
+        try:
+            return self.__start_instance(request, instance_dir)
+        except:
+            logger.warning(f'cleaning up instance: {instance_id}')
+            self.__try_delete(instance_id)
+            raise
+
+    def __start_instance(self, request: CreateInstanceRequest, instance_dir: Path) -> UserData:
+        instance_id = request['instance_id']
+        requested_anvil_instances = request.get('anvil_instances', {})
+        deadline = time.monotonic() + INSTANCE_START_TIMEOUT
+
+        with timed('allocate_ports'):
+            ports = self.__allocate_ports(instance_dir, list(requested_anvil_instances))
+
+        anvil_instances: dict[str, InstanceInfo] = {}
+        for anvil_id, anvil_args in requested_anvil_instances.items():
+            data_dir = instance_dir / anvil_id
+            data_dir.mkdir()
+
+            anvil_args_list = format_anvil_args(
+                anvil_args, anvil_id, ports[anvil_id], host=PROCESS_BIND, data_dir=str(data_dir)
+            )
+            with timed('spawn_anvil'):
+                self.__spawn(instance_dir, anvil_id, [ANVIL_PATH, *anvil_args_list], format_anvil_env(anvil_args))
+
+            anvil_instances[anvil_id] = {
+                'id': anvil_id,
+                'ip': PROCESS_BIND,
+                'port': ports[anvil_id],
+            }
+            self._remap_extra_anvil_keys(anvil_instances[anvil_id], anvil_args)
+
+        daemon_instances: dict[str, InstanceInfo] = {}
+        for daemon_id, daemon_args in request.get('daemon_instances', {}).items():
+            command = daemon_args.get('command')
+            if not command:
+                msg = f'daemon {daemon_id} has no command, images cannot be started by the process backend'
+                raise ProcessBackendError(msg)
+
+            with timed('spawn_daemon'):
+                self.__spawn(instance_dir, daemon_id, command, {'INSTANCE_ID': instance_id})
+            daemon_instances[daemon_id] = {'id': daemon_id}
+
+        self._prepare_nodes(requested_anvil_instances, anvil_instances, deadline)
+
+        now = time.time()
+        return UserData(
+            instance_id=instance_id,
+            external_id=self._generate_rpc_id(),
+            created_at=now,
+            expires_at=now + request['timeout'],
+            anvil_instances=anvil_instances,
+            daemon_instances=daemon_instances,
+            metadata={},
+        )
+
+    def _cleanup_instance(self, _: CreateInstanceRequest) -> None:
+        # note: failed launches are cleaning up after themselves in _launch_instance_impl
+        pass
+
+    def destroy_instance(self, instance: UserData) -> None:
+        self.__try_delete(instance['instance_id'])
+
+    def __instance_dir(self, instance_id: str) -> Path:
+        path = self.__root / instance_id
+        if instance_id in ('.', '..') or path.parent != self.__root:
+            msg = f'invalid instance id: {instance_id}'
+            raise ProcessBackendError(msg)
+        return path
+
+    def __allocate_ports(self, instance_dir: Path, anvil_ids: list[str]) -> dict[str, int]:
+        with self.__ports_lock:
+            used: set[int] = set()
+            for ports_file in self.__root.glob(f'*/{_PORTS_FILE}'):
+                used.update(json.loads(ports_file.read_text()).values())
+
+            # note: something else on the host could be listening on a port from the range too
+            free = (port for port in self.__ports if port not in used and _is_port_free(PROCESS_BIND, port))
+            ports = dict(zip(anvil_ids, free, strict=False))
+            if len(ports) != len(anvil_ids):
+                msg = f'not enough free ports in {PROCESS_PORT_RANGE}'
+                raise ProcessBackendError(msg)
+
+            (instance_dir / _PORTS_FILE).write_text(json.dumps(ports))
+        return ports
+
+    @staticmethod
+    def __spawn(instance_dir: Path, name: str, command: list[str], env: dict[str, str]) -> None:
+        # The command is restarted by the shell loop whenever it crashes. The loop is started in the background by a
+        # shell that exits right away, so that it won't become a zombie of the worker once it's killed
+        log_path = shlex.quote(str(instance_dir / f'{name}.log'))
+        script = f'(while true; do {shlex.join(command)}; sleep 1; done) >>{log_path} 2>&1 </dev/null &'
+        process = subprocess.Popen(  # noqa: S603
+            ['/bin/sh', '-c', script],
+            cwd=instance_dir,
+            env={**os.environ, **env},
+            start_new_session=True,
+        )
+        process.wait()
+
+        # note: the loop stays in the process group of the shell that has started it
+        (instance_dir / f'{name}.pgid').write_text(str(process.pid))
+
+    def __try_delete(self, instance_id: str) -> None:
+        instance_dir = self.__instance_dir(instance_id)
+        if not instance_dir.exists():
+            return
+
+        for pgid_file in instance_dir.glob('*.pgid'):
+            try:
+                self.__stop_group(int(pgid_file.read_text()))
+            except Exception as e:
+                logger.opt(exception=e).error(f'failed to stop {pgid_file.stem} of {instance_id}')
+
+        logger.info(f'deleting instance directory {instance_dir}')
+        shutil.rmtree(instance_dir, ignore_errors=True)
+
+    @staticmethod
+    def __stop_group(pgid: int) -> None:
+        try:
+            os.killpg(pgid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+
+        # note: anvil is dumping the state on SIGTERM, it's given some time to do that before it's killed
+        deadline = time.monotonic() + _STOP_TIMEOUT
+        while _is_group_alive(pgid):
+            if time.monotonic() >= deadline:
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(pgid, signal.SIGKILL)
+                return
+            time.sleep(0.1)
@@ -0,0 +1,122 @@
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from threading import Lock
+
+from loguru import logger
+
+from ctf_server.databases.database import Database
+from ctf_server.metrics import PRUNE_SECONDS, PRUNER_BACKLOG, PRUNER_IN_FLIGHT
+from ctf_server.types import UserData
+
+from .expiry import ExpiryScheduler
+from .leader import LeaderElector
+
+
+PRUNER_WORKERS = int(os.getenv('PRUNER_WORKERS', '8'))
+PRUNER_CLAIM_BATCH = int(os.getenv('PRUNER_CLAIM_BATCH', '128'))
+# If a claimed instance is not deleted within this amount of seconds, it will be claimed again
+PRUNER_CLAIM_LEASE = int(os.getenv('PRUNER_CLAIM_LEASE', '300'))
+
+
+@dataclass
+class PrunerStats:
+    backlog: int = 0
+    in_flight: int = 0
+    pruned: int = 0
+    failed: int = 0
+    last_latency: float = 0.0
+    max_latency: float = 0.0
+    total_latency: float = 0.0
+
+
+class InstancePruner:
+    def __init__(
+        self,
+        database: Database,
+        kill_instance: Callable[[str], UserData | None],
+        name: str,
+        workers: int = PRUNER_WORKERS,
+        leader: LeaderElector | None = None,
+    ) -> None:
+        self.__database = database
+        self.__kill_instance = kill_instance
+        self.__leader = leader
+
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name} Worker')
+        self.__pending: set[str] = set()
+        self.__lock = Lock()
+        self.__stats = PrunerStats()
+        self.__scheduler = ExpiryScheduler(database, self.prune, name)
+
+    @property
+    def stats(self) -> PrunerStats:
+        with self.__lock:
+            return replace(self.__stats)
+
+    def start(self) -> None:
+        # Instead of polling the database, we are waking up whenever the closest instance expires
+        self.__scheduler.start()
+        if self.__leader is not None:
+            # Followers are keeping their schedules too, the new leader catches up with whatever has expired meanwhile
+            self.__leader.add_listener(self.prune)
+
+    @logger.catch
+    def prune(self) -> None:
+        if self.__leader is not None and not self.__leader.is_leader:
+            return
+
+        while True:
+            claimed = self.__database.claim_expired_instances(PRUNER_CLAIM_BATCH, PRUNER_CLAIM_LEASE)
+            for instance_id in claimed:
+                self.submit(instance_id)
+
+            if len(claimed) < PRUNER_CLAIM_BATCH:
+                break
+
+    def submit(self, instance_id: str) -> None:
+        with self.__lock:
+            if instance_id in self.__pending:
+                return
+
+            self.__pending.add(instance_id)
+            self.__stats.backlog += 1
+            backlog = self.__stats.backlog
+            # note: the gauges are set under the lock, so that a stale value can't overwrite a newer one
+            PRUNER_BACKLOG.set(backlog)
+
+        logger.info(f'pruning expired instance: {instance_id} (backlog: {backlog})')
+        self.__executor.submit(self.__delete, instance_id)
+
+    def __delete(self, instance_id: str) -> None:
+        with self.__lock:
+            self.__stats.backlog -= 1
+            self.__stats.in_flight += 1
+            PRUNER_BACKLOG.set(self.__stats.backlog)
+            PRUNER_IN_FLIGHT.set(self.__stats.in_flight)
+
+        started_at = time.monotonic()
+        ok = True
+        try:
+            self.__kill_instance(instance_id)
+        except Exception as e:
+            ok = False
+            logger.opt(exception=e).error(f'failed to prune instance: {instance_id}')
+        finally:
+            latency = time.monotonic() - started_at
+            with self.__lock:
+                self.__pending.discard(instance_id)
+                self.__stats.in_flight -= 1
+                self.__stats.pruned += ok
+                self.__stats.failed += not ok
+                self.__stats.last_latency = latency
+                self.__stats.max_latency = max(self.__stats.max_latency, latency)
+                self.__stats.total_latency += latency
+                backlog = self.__stats.backlog
+                PRUNER_IN_FLIGHT.set(self.__stats.in_flight)
+
+            PRUNE_SECONDS.observe(latency, 'ok' if ok else 'failed')
+
+        logger.info(f'pruned instance: {instance_id} in {latency:.2f}s (backlog: {backlog})')
@@ -0,0 +1,47 @@
+import os
+from collections.abc import Callable
+from threading import Event, Thread
+
+from loguru import logger
+
+from .leader import LeaderElector
+
+
+# Resources of the instances that aren't in the database anymore are looked for this often
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', '60'))
+
+
+class Reconciler:
+    """Periodically brings whatever the backend is running in line with the database."""
+
+    def __init__(
+        self,
+        reconcile: Callable[[], None],
+        name: str,
+        interval: float = RECONCILE_INTERVAL,
+        leader: LeaderElector | None = None,
+    ) -> None:
+        self.__reconcile = reconcile
+        self.__name = name
+        self.__interval = interval
+        self.__leader = leader
+        self.__wakeup = Event()
+
+    def start(self) -> None:
+        Thread(target=self.__reconciler_thread, name=self.__name, daemon=True).start()
+
+    def trigger(self) -> None:
+        # Runs the next pass right away instead of waiting for the interval
+        self.__wakeup.set()
+
+    def __reconciler_thread(self) -> None:
+        while True:
+            self.__wakeup.wait(self.__interval)
+            self.__wakeup.clear()
+            if self.__leader is not None and not self.__leader.is_leader:
+                continue
+
+            try:
+                self.__reconcile()
+            except Exception as e:
+                logger.opt(exception=e).error('reconciler failed')
@@ -1,3 +1,4 @@
 from .database import Database  # noqa: F401
+from .memorydb import MemoryDatabase  # noqa: F401
 from .redisdb import RedisDatabase  # noqa: F401
 from .sqlitedb import SQLiteDatabase  # noqa: F401
@@ -1,11 +1,28 @@
 import abc
+from collections import Counter
+from collections.abc import Callable
 
 from ctf_server.types import UserData
 
 
+# Called with the instance id and its new expiry timestamp, or `None` if the instance is gone
+ExpiryListener = Callable[[str, float | None], None]
+
+
 class Database(abc.ABC):
+    # Whether the expiry listeners are notified of the changes made by the other processes too, or only of our own
+    shares_expiry_events = False
+
     def __init__(self) -> None:
         super().__init__()
+        self._expiry_listeners: list[ExpiryListener] = []
+
+    def add_expiry_listener(self, listener: ExpiryListener) -> None:
+        self._expiry_listeners.append(listener)
+
+    def _notify_expiry(self, instance_id: str, expires_at: float | None) -> None:
+        for listener in self._expiry_listeners:
+            listener(instance_id, expires_at)
 
     @abc.abstractmethod
     def register_instance(self, instance_id: str, instance: UserData) -> None:
@@ -19,6 +36,13 @@ class Database(abc.ABC):
     def get_instance(self, instance_id: str) -> UserData | None:
         pass
 
+    def get_instances(self, instance_ids: list[str]) -> list[UserData | None]:
+        return [self.get_instance(instance_id) for instance_id in instance_ids]
+
+    @abc.abstractmethod
+    def get_all_instances(self) -> list[UserData]:
+        pass
+
     @abc.abstractmethod
     def get_instance_by_external_id(self, external_id: str) -> UserData | None:
         pass
@@ -27,6 +51,40 @@ class Database(abc.ABC):
     def get_expired_instances(self) -> list[UserData]:
         pass
 
+    @abc.abstractmethod
+    def get_expiries(self) -> dict[str, float]:
+        pass
+
+    def count_instances(self) -> int:
+        return len(self.get_expiries())
+
+    def count_instances_per_challenge(self) -> dict[str, int]:
+        # note: instances launched by older versions aren't carrying the challenge name, they are counted under ''
+        return dict(Counter(instance.get('challenge_name', '') for instance in self.get_all_instances()))
+
+    def claim_expired_instances(self, limit: int, lease: int) -> list[str]:
+        # Databases that are shared between multiple processes should override this so that the claim is atomic
+        _ = lease
+        return [instance['instance_id'] for instance in self.get_expired_instances()[:limit]]
+
+    @abc.abstractmethod
+    def register_images(self, challenge_name: str, images: list[str]) -> None:
+        # Replaces the images that the challenge is launching, these are pulled ahead of the launches
+        pass
+
+    @abc.abstractmethod
+    def get_images(self) -> dict[str, list[str]]:
+        pass
+
+    @abc.abstractmethod
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        # Takes the lease if it's free or expired, the owner that's already holding it is extending it instead
+        pass
+
+    @abc.abstractmethod
+    def release_lease(self, name: str, owner: str) -> None:
+        pass
+
     @abc.abstractmethod
     def update_metadata(self, instance_id: str, metadata: dict[str, str | list[dict[str, str]]]) -> None:
         pass
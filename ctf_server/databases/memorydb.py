@@ -0,0 +1,293 @@
+import heapq
+import json
+import mmap
+import struct
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from copy import deepcopy
+from pathlib import Path
+from threading import RLock
+from typing import Any, NotRequired, TypedDict
+
+from filelock import FileLock
+
+from ctf_server.types import UserData
+
+from .database import Database
+
+
+class MemoryDatabaseError(Exception):
+    """Custom exception for in-memory database errors."""
+
+
+class _State(TypedDict):
+    instances: dict[str, UserData]
+    # Kept apart from the instances, claimed instances are rescheduled here and not in the instance itself
+    expiries: dict[str, float]
+    # Snapshots written by older versions don't have these
+    images: NotRequired[dict[str, list[str]]]
+    # Lease name to its owner and expiry
+    leases: NotRequired[dict[str, tuple[str, float]]]
+
+
+# magic, generation, payload length
+_HEADER = struct.Struct('<4sQQ')
+_MAGIC = b'PCDB'
+
+
+class _Snapshot:
+    """The state serialized into a memory mapped file that is shared between the processes on the same host."""
+
+    def __init__(self, path: str) -> None:
+        self.__path = Path(path)
+        self.__lock = FileLock(f'{path}.lock')
+
+        self.__path.touch(exist_ok=True)
+        self.__file = self.__path.open('r+b')
+        if self.__path.stat().st_size < _HEADER.size:
+            self.__file.truncate(mmap.PAGESIZE)
+        self.__mm = mmap.mmap(self.__file.fileno(), 0)
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        with self.__lock:
+            yield
+
+    def __header(self) -> tuple[int, int]:
+        magic, generation, length = _HEADER.unpack_from(self.__mm, 0)
+        if magic != _MAGIC:
+            return 0, 0
+        return generation, length
+
+    @property
+    def generation(self) -> int:
+        return self.__header()[0]
+
+    def __remap(self, size: int) -> None:
+        if self.__path.stat().st_size < size:
+            self.__file.truncate(size)
+        self.__mm.close()
+        self.__mm = mmap.mmap(self.__file.fileno(), 0)
+
+    def read(self) -> tuple[int, _State | None]:
+        generation, length = self.__header()
+        if generation == 0:
+            return 0, None
+
+        # Some other process could've grown the file since we've mapped it
+        if _HEADER.size + length > len(self.__mm):
+            self.__remap(_HEADER.size + length)
+
+        return generation, json.loads(self.__mm[_HEADER.size : _HEADER.size + length])
+
+    def write(self, state: _State) -> int:
+        payload = json.dumps(state, separators=(',', ':')).encode()
+        if _HEADER.size + len(payload) > len(self.__mm):
+            # Growing twice as much as needed, so that we won't have to remap on every write
+            pages = (2 * (_HEADER.size + len(payload))) // mmap.PAGESIZE + 1
+            self.__remap(pages * mmap.PAGESIZE)
+
+        generation = self.generation + 1
+        self.__mm[_HEADER.size : _HEADER.size + len(payload)] = payload
+        _HEADER.pack_into(self.__mm, 0, _MAGIC, generation, len(payload))
+        return generation
+
+
+class MemoryDatabase(Database):
+    """Keeps everything in the process memory, optionally sharing it with the other workers through a snapshot file.
+
+    Every write re-serializes the whole state into the snapshot, so this is meant for tests and small single-host
+    deployments only.
+    """
+
+    def __init__(self, snapshot_path: str | None = None) -> None:
+        super().__init__()
+
+        self.__lock = RLock()
+        self.__snapshot = _Snapshot(snapshot_path) if snapshot_path else None
+        self.__generation = 0
+        self.__dirty = False
+
+        self.__instances: dict[str, UserData] = {}
+        self.__external_ids: dict[str, str] = {}
+        self.__expiries: dict[str, float] = {}
+        self.__images: dict[str, list[str]] = {}
+        self.__leases: dict[str, tuple[str, float]] = {}
+        # Entries are never removed from the heap in place, the stale ones are skipped once they reach the top
+        self.__expiry_heap: list[tuple[float, str]] = []
+
+        with self.__transaction():
+            pass
+
+    @contextmanager
+    def __transaction(self, *, read_only: bool = False) -> Iterator[None]:
+        snapshot = self.__snapshot
+        with self.__lock:
+            # Reads don't need the file lock unless some other process has changed the snapshot since we've loaded it
+            if snapshot is None or (read_only and snapshot.generation == self.__generation):
+                yield
+                return
+
+            with snapshot.locked():
+                if snapshot.generation != self.__generation:
+                    generation, state = snapshot.read()
+                    self.__load(state or _State(instances={}, expiries={}))
+                    self.__generation = generation
+
+                self.__dirty = False
+                yield
+
+                if self.__dirty:
+                    self.__generation = snapshot.write(
+                        _State(
+                            instances=self.__instances,
+                            expiries=self.__expiries,
+                            images=self.__images,
+                            leases=self.__leases,
+                        )
+                    )
+
+    def __load(self, state: _State) -> None:
+        self.__instances = state['instances']
+        self.__expiries = state['expiries']
+        self.__images = state.get('images', {})
+        self.__leases = state.get('leases', {})
+        self.__external_ids = {
+            instance['external_id']: instance_id for instance_id, instance in self.__instances.items()
+        }
+        self.__expiry_heap = [(expires_at, instance_id) for instance_id, expires_at in self.__expiries.items()]
+        heapq.heapify(self.__expiry_heap)
+
+    def __schedule(self, instance_id: str, expires_at: float) -> None:
+        self.__dirty = True
+        self.__expiries[instance_id] = expires_at
+        heapq.heappush(self.__expiry_heap, (expires_at, instance_id))
+
+    def __pop_expired(self, now: float, limit: int) -> list[str]:
+        result: list[str] = []
+        while self.__expiry_heap and len(result) < limit:
+            expires_at, instance_id = self.__expiry_heap[0]
+            if self.__expiries.get(instance_id) != expires_at:
+                heapq.heappop(self.__expiry_heap)
+                continue
+            if expires_at > now:
+                break
+
+            heapq.heappop(self.__expiry_heap)
+            result.append(instance_id)
+        return result
+
+    def __get(self, instance_id: str) -> UserData | None:
+        instance = self.__instances.get(instance_id)
+        # Copying, so that the callers won't be able to mess with our state
+        return deepcopy(instance) if instance is not None else None
+
+    def register_instance(self, instance_id: str, instance: UserData) -> None:
+        with self.__transaction():
+            if instance_id in self.__instances:
+                msg = f'instance {instance_id} already exists'
+                raise MemoryDatabaseError(msg)
+
+            self.__instances[instance_id] = deepcopy(instance)
+            self.__instances[instance_id]['metadata'] = {}
+            self.__external_ids[instance['external_id']] = instance_id
+            self.__schedule(instance_id, instance['expires_at'])
+
+        self._notify_expiry(instance_id, instance['expires_at'])
+
+    def unregister_instance(self, instance_id: str) -> UserData | None:
+        with self.__transaction():
+            instance = self.__instances.pop(instance_id, None)
+            if instance is None:
+                return None
+
+            self.__dirty = True
+            self.__external_ids.pop(instance['external_id'], None)
+            self.__expiries.pop(instance_id, None)
+
+        self._notify_expiry(instance_id, None)
+        return instance
+
+    def get_instance(self, instance_id: str) -> UserData | None:
+        with self.__transaction(read_only=True):
+            return self.__get(instance_id)
+
+    def get_instances(self, instance_ids: list[str]) -> list[UserData | None]:
+        with self.__transaction(read_only=True):
+            return [self.__get(instance_id) for instance_id in instance_ids]
+
+    def get_all_instances(self) -> list[UserData]:
+        with self.__transaction(read_only=True):
+            return deepcopy(list(self.__instances.values()))
+
+    def get_instance_by_external_id(self, external_id: str) -> UserData | None:
+        with self.__transaction(read_only=True):
+            instance_id = self.__external_ids.get(external_id)
+            return self.__get(instance_id) if instance_id is not None else None
+
+    def get_expired_instances(self) -> list[UserData]:
+        now = time.time()
+        with self.__transaction(read_only=True):
+            return [
+                instance
+                for instance_id, expires_at in self.__expiries.items()
+                if expires_at <= now and (instance := self.__get(instance_id))
+            ]
+
+    def get_expiries(self) -> dict[str, float]:
+        with self.__transaction(read_only=True):
+            return dict(self.__expiries)
+
+    def claim_expired_instances(self, limit: int, lease: int) -> list[str]:
+        now = time.time()
+        with self.__transaction(read_only=True):
+            # Not taking the snapshot lock when there's nothing to claim, the top of the heap could be stale though
+            if not self.__expiry_heap or self.__expiry_heap[0][0] > now:
+                return []
+
+        with self.__transaction():
+            claimed = self.__pop_expired(now, limit)
+            for instance_id in claimed:
+                self.__schedule(instance_id, now + lease)
+            return claimed
+
+    def register_images(self, challenge_name: str, images: list[str]) -> None:
+        with self.__transaction():
+            self.__dirty = True
+            self.__images[challenge_name] = list(images)
+
+    def get_images(self) -> dict[str, list[str]]:
+        with self.__transaction(read_only=True):
+            return deepcopy(self.__images)
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self.__transaction():
+            lease = self.__leases.get(name)
+            if lease is not None:
+                lease_owner, expires_at = lease
+                if lease_owner != owner and expires_at > now:
+                    return False
+
+            self.__dirty = True
+            self.__leases[name] = (owner, now + ttl)
+            return True
+
+    def release_lease(self, name: str, owner: str) -> None:
+        with self.__transaction():
+            lease = self.__leases.get(name)
+            if lease is not None and lease[0] == owner:
+                self.__dirty = True
+                del self.__leases[name]
+
+    def update_metadata(self, instance_id: str, metadata: dict[str, str | list[dict[str, str]]]) -> None:
+        with self.__transaction():
+            instance = self.__instances.get(instance_id)
+            if instance is None:
+                msg = f'instance {instance_id} does not exist'
+                raise MemoryDatabaseError(msg)
+
+            self.__dirty = True
+            instance_metadata: dict[str, Any] = instance['metadata']
+            instance_metadata.update(deepcopy(metadata))
@@ -0,0 +1,32 @@
+"""Rewrites the redis instance records into another encoding, see `ctf_server.databases.redis_encoding`.
+
+Usage:
+    python -m ctf_server.databases.migrate_redis [--url <redis url>] [--encoding json|hash] [--batch-size <n>]
+
+The url and the encoding are defaulting to `REDIS_URL` and `REDIS_ENCODING`, the same ones that the server uses.
+Records that are already in the target encoding are skipped, so the migration could be safely re-run.
+"""
+
+import argparse
+import os
+from typing import cast
+
+from loguru import logger
+
+from .redis_encoding import ENCODINGS, RedisEncoding
+from .redisdb import RedisDatabase
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description='convert the redis instance records into another encoding')
+    parser.add_argument('--url', default=os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0'))
+    parser.add_argument('--encoding', choices=ENCODINGS, default=os.getenv('REDIS_ENCODING', 'json'))
+    parser.add_argument('--batch-size', type=int, default=128)
+
+    args = parser.parse_args(argv)
+    database = RedisDatabase(args.url, encoding=cast('RedisEncoding', args.encoding))
+    logger.info(f'migrated {database.migrate_encoding(args.batch_size)} instances')
+
+
+if __name__ == '__main__':
+    main()
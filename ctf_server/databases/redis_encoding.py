@@ -0,0 +1,81 @@
+from json import dumps, loads
+from typing import Any, Literal, cast
+
+from ctf_server.types import InstanceInfo, UserData
+
+
+# json - RedisJSON document, requires redis stack
+# hash - flat hash of fields, works on plain redis and valkey
+RedisEncoding = Literal['json', 'hash']
+ENCODINGS: tuple[RedisEncoding, ...] = ('json', 'hash')
+
+_SCALAR_FIELDS = ('instance_id', 'external_id')
+_FLOAT_FIELDS = ('created_at', 'expires_at')
+_ANVIL_PREFIX = 'anvil/'
+_DAEMON_PREFIX = 'daemon/'
+# Everything that doesn't have a dedicated field is stored as json under this prefix
+_EXTRA_PREFIX = 'extra/'
+
+
+def encode_instance_hash(instance: UserData) -> dict[str, str]:
+    fields: dict[str, str] = {}
+    for key, value in instance.items():
+        if key in _SCALAR_FIELDS:
+            fields[key] = cast('str', value)
+        elif key in _FLOAT_FIELDS:
+            fields[key] = repr(value)
+        elif key == 'anvil_instances':
+            for anvil_id, info in instance['anvil_instances'].items():
+                fields.update(_encode_instance_info(f'{_ANVIL_PREFIX}{anvil_id}/', info))
+        elif key == 'daemon_instances':
+            for daemon_id, info in instance['daemon_instances'].items():
+                fields.update(_encode_instance_info(f'{_DAEMON_PREFIX}{daemon_id}/', info))
+        elif key != 'metadata':
+            # note: metadata is stored separately regardless of the encoding
+            fields[f'{_EXTRA_PREFIX}{key}'] = dumps(value)
+    return fields
+
+
+def _encode_instance_info(prefix: str, info: InstanceInfo) -> dict[str, str]:
+    fields = {f'{prefix}id': info['id']}
+    if 'ip' in info:
+        fields[f'{prefix}ip'] = info['ip']
+    if 'port' in info:
+        fields[f'{prefix}port'] = str(info['port'])
+    for key, value in info.items():
+        if key not in ('id', 'ip', 'port'):
+            fields[f'{prefix}{_EXTRA_PREFIX}{key}'] = dumps(value)
+    return fields
+
+
+def decode_instance_hash(fields: dict[str, str]) -> UserData:
+    instance: dict[str, Any] = {
+        'anvil_instances': {},
+        'daemon_instances': {},
+        'metadata': {},
+    }
+
+    for key, value in fields.items():
+        if key in _SCALAR_FIELDS:
+            instance[key] = value
+        elif key in _FLOAT_FIELDS:
+            instance[key] = float(value)
+        elif key.startswith(_ANVIL_PREFIX):
+            _decode_instance_info_field(instance['anvil_instances'], key.removeprefix(_ANVIL_PREFIX), value)
+        elif key.startswith(_DAEMON_PREFIX):
+            _decode_instance_info_field(instance['daemon_instances'], key.removeprefix(_DAEMON_PREFIX), value)
+        elif key.startswith(_EXTRA_PREFIX):
+            instance[key.removeprefix(_EXTRA_PREFIX)] = loads(value)
+
+    return cast('UserData', instance)
+
+
+def _decode_instance_info_field(infos: dict[str, dict[str, Any]], key: str, value: str) -> None:
+    # note: ids could contain slashes, field names can't
+    if f'/{_EXTRA_PREFIX}' in key:
+        instance_id, field = key.rsplit(f'/{_EXTRA_PREFIX}', 1)
+        infos.setdefault(instance_id, {})[field] = loads(value)
+        return
+
+    instance_id, field = key.rsplit('/', 1)
+    infos.setdefault(instance_id, {})[field] = int(value) if field == 'port' else value
@@ -1,35 +1,276 @@
 import time
 from json import dumps, loads
+from threading import Thread
 from typing import Any, Never, cast
+from urllib.parse import urlsplit
 
 import redis
+from loguru import logger
+from redis.client import Pipeline, PubSub
+from redis.cluster import ClusterNode, LoadBalancingStrategy, RedisCluster
+from redis.sentinel import Sentinel
 
 from ctf_server.types import UserData
 
-from .database import Database
+from .database import Database, ExpiryListener
+from .redis_encoding import ENCODINGS, RedisEncoding, decode_instance_hash, encode_instance_hash
 
 
 class RedisDatabaseError(Exception):
     """Custom exception for Redis database errors."""
 
 
+# Reschedules the expired instances `lease` seconds into the future, so that only one caller claims them
+_CLAIM_EXPIRED_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, id in ipairs(ids) do
+    redis.call('ZADD', KEYS[1], ARGV[1] + ARGV[3], id)
+end
+return ids
+"""
+
+# Leases are plain keys holding the owner, only the owner could extend or release them
+_ACQUIRE_LEASE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+_RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+"""
+
+_EXPIRY_EVENTS_CHANNEL = 'expiry-events'
+
+# Instances could be stored either as RedisJSON documents or as plain hashes (see `redis_encoding`), so the scripts
+# are checking the key type, that also makes both of the encodings readable during the migration
+_READ_INSTANCE_FN = """
+local function read_instance(key)
+    local key_type = redis.call('TYPE', key)['ok']
+    if key_type == 'hash' then
+        return redis.call('HGETALL', key)
+    end
+    if key_type == 'ReJSON-RL' then
+        return redis.call('JSON.GET', key, '.')
+    end
+    return false
+end
+
+local function external_id_of(key, raw_instance)
+    if type(raw_instance) == 'table' then
+        return redis.call('HGET', key, 'external_id')
+    end
+    return cjson.decode(raw_instance)['external_id']
+end
+"""
+
+# Reads the instances and their metadata in a single round trip, the keys are the instance and metadata key pairs.
+# note: every key that a script touches is passed in KEYS, scripts can't derive key names on their own
+_GET_BY_KEYS_SCRIPT = (
+    _READ_INSTANCE_FN
+    + """
+local result = {}
+for i = 1, #KEYS, 2 do
+    result[#result + 1] = {read_instance(KEYS[i]), redis.call('HGETALL', KEYS[i + 1])}
+end
+return result
+"""
+)
+
+# Resolves the external id and reads the instance with its metadata in a single round trip, on the proxy hot path.
+# note: the instance keys are only known once the index is read, so they are derived from the key prefixes in ARGV,
+# that is only done outside of the cluster mode, where every key is on the same node
+_GET_BY_EXTERNAL_ID_SCRIPT = (
+    _READ_INSTANCE_FN
+    + """
+local instance_id = redis.call('HGET', KEYS[1], ARGV[1])
+if not instance_id then
+    return false
+end
+return {read_instance(ARGV[2] .. instance_id), redis.call('HGETALL', ARGV[3] .. instance_id)}
+"""
+)
+
+# Deleting the instance atomically, so that concurrent unregisters won't both get the instance back
+_UNREGISTER_SCRIPT = (
+    _READ_INSTANCE_FN
+    + """
+local raw_instance = read_instance(KEYS[3])
+if not raw_instance then
+    return false
+end
+
+redis.call('HDEL', KEYS[1], external_id_of(KEYS[3], raw_instance))
+redis.call('DEL', KEYS[3], KEYS[4])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('PUBLISH', ARGV[2], cjson.encode({instance_id = ARGV[1], expires_at = cjson.null}))
+return raw_instance
+"""
+)
+
+# In cluster mode scripts could only touch the keys of a single slot, so the indexes are updated separately
+_CLUSTER_UNREGISTER_SCRIPT = (
+    _READ_INSTANCE_FN
+    + """
+local raw_instance = read_instance(KEYS[1])
+if not raw_instance then
+    return false
+end
+
+local external_id = external_id_of(KEYS[1], raw_instance)
+redis.call('DEL', KEYS[1], KEYS[2])
+return {raw_instance, external_id}
+"""
+)
+
+_SENTINEL_PORT = 26379
+_CLUSTER_PORT = 6379
+
+
+def _parse_hosts(netloc: str, default_port: int) -> tuple[list[tuple[str, int]], str | None, str | None]:
+    credentials, _, hosts = netloc.rpartition('@')
+    username, _, password = credentials.partition(':')
+
+    result: list[tuple[str, int]] = []
+    for host in hosts.split(','):
+        hostname, _, port = host.partition(':')
+        result.append((hostname, int(port) if port else default_port))
+    return result, username or None, password or None
+
+
+def _connect(url: str, redis_kwargs: dict[str, Any], *, replicas: bool) -> redis.Redis:
+    """Connects to redis described by the url.
+
+    Apart from the urls supported by redis-py, these are accepted:
+        redis+sentinel://[[username]:password@]host[:port][,host[:port]...]/service_name[/db]
+        redis+cluster://[[username]:password@]host[:port][,host[:port]...]
+
+    With `replicas` set, the returned client would be reading from the replicas if there are any.
+    """
+    parts = urlsplit(url)
+    scheme, _, topology = parts.scheme.partition('+')
+    if not topology:
+        return redis.Redis.from_url(url, decode_responses=True, **redis_kwargs)
+
+    kwargs: dict[str, Any] = {'decode_responses': True, 'ssl': scheme == 'rediss', **redis_kwargs}
+    if topology == 'cluster':
+        hosts, username, password = _parse_hosts(parts.netloc, _CLUSTER_PORT)
+        # note: cluster client is exposing the same commands as the regular one, and it's routing them by the keys
+        cluster = RedisCluster(
+            startup_nodes=[ClusterNode(host, port) for host, port in hosts],
+            username=username,
+            password=password,
+            load_balancing_strategy=LoadBalancingStrategy.ROUND_ROBIN_REPLICAS if replicas else None,
+            **kwargs,
+        )
+        return cast('redis.Redis', cluster)
+
+    if topology == 'sentinel':
+        hosts, username, password = _parse_hosts(parts.netloc, _SENTINEL_PORT)
+        service_name, _, db = parts.path.strip('/').partition('/')
+        if not service_name:
+            msg = f'sentinel url is missing the service name: {url}'
+            raise RedisDatabaseError(msg)
+
+        sentinel = Sentinel(hosts, sentinel_kwargs=kwargs.pop('sentinel_kwargs', None))
+        connect = sentinel.slave_for if replicas else sentinel.master_for
+        return connect(service_name, db=int(db or 0), username=username, password=password, **kwargs)
+
+    msg = f'unsupported redis url scheme: {parts.scheme}'
+    raise RedisDatabaseError(msg)
+
+
+def _pairs_to_dict(pairs: list[str]) -> dict[str, str]:
+    return dict(zip(pairs[::2], pairs[1::2], strict=True))
+
+
 class RedisDatabase(Database):
-    def __init__(self, url: str, redis_kwargs: dict[str, Any] | None = None) -> None:
+    # note: the expiry events are published to every worker and replica through a redis channel
+    shares_expiry_events = True
+
+    def __init__(
+        self,
+        url: str,
+        redis_kwargs: dict[str, Any] | None = None,
+        encoding: RedisEncoding = 'json',
+        *,
+        prefer_replicas: bool = False,
+    ) -> None:
         if redis_kwargs is None:
             redis_kwargs = {}
+        if encoding not in ENCODINGS:
+            msg = f'unsupported encoding: {encoding}'
+            raise RedisDatabaseError(msg)
         super().__init__()
 
-        self.__client: redis.Redis = redis.Redis.from_url(
-            url,
-            decode_responses=True,
-            **redis_kwargs,
-        )
+        self.__encoding = encoding
+
+        self.__client = _connect(url, redis_kwargs, replicas=False)
+        # note: replicas could be lagging behind, lookups that didn't find anything are retried on the primary
+        self.__reader = _connect(url, redis_kwargs, replicas=True) if prefer_replicas else self.__client
+        # Every key of an instance is sharing the same hash tag in cluster mode, the cross-slot scripts can't be used
+        self.__cluster = isinstance(self.__client, RedisCluster)
+
+        self.__claim_expired = self.__client.register_script(_CLAIM_EXPIRED_SCRIPT)
+        self.__get_by_keys = self.__client.register_script(_GET_BY_KEYS_SCRIPT)
+        self.__get_by_external_id = self.__client.register_script(_GET_BY_EXTERNAL_ID_SCRIPT)
+        self.__unregister = self.__client.register_script(_UNREGISTER_SCRIPT)
+        self.__cluster_unregister = self.__client.register_script(_CLUSTER_UNREGISTER_SCRIPT)
+        self.__acquire_lease = self.__client.register_script(_ACQUIRE_LEASE_SCRIPT)
+        self.__release_lease = self.__client.register_script(_RELEASE_LEASE_SCRIPT)
+        self.__expiry_events: Thread | None = None
+
+    def __instance_key(self, instance_id: str) -> str:
+        return f'instance/{{{instance_id}}}' if self.__cluster else f'instance/{instance_id}'
+
+    def __metadata_key(self, instance_id: str) -> str:
+        return f'metadata/{{{instance_id}}}' if self.__cluster else f'metadata/{instance_id}'
+
+    def __instance_keys(self, instance_ids: list[str]) -> list[str]:
+        return [
+            key
+            for instance_id in instance_ids
+            for key in (self.__instance_key(instance_id), self.__metadata_key(instance_id))
+        ]
+
+    def __pipeline(self, client: redis.Redis | None = None) -> Pipeline:
+        # note: cluster pipelines are spanning multiple slots, so they can't be transactional
+        return (client or self.__client).pipeline(transaction=not self.__cluster)
+
+    def add_expiry_listener(self, listener: ExpiryListener) -> None:
+        super().add_expiry_listener(listener)
+
+        # Instances are registered by every worker, so the events are delivered through pub/sub instead of locally
+        if self.__expiry_events is None:
+            pubsub = self.__client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{_EXPIRY_EVENTS_CHANNEL: self.__on_expiry_event})
+            self.__expiry_events = pubsub.run_in_thread(
+                sleep_time=1,
+                daemon=True,
+                exception_handler=self.__on_expiry_events_error,
+            )
+
+    def __on_expiry_event(self, message: dict[str, str]) -> None:
+        event = loads(message['data'])
+        self._notify_expiry(event['instance_id'], event['expires_at'])
+
+    @staticmethod
+    def __on_expiry_events_error(e: BaseException, _: PubSub, __: Thread) -> None:
+        # note: pubsub reconnects and resubscribes by itself on the next read, events missed in between are
+        # picked up by the expiry scheduler resync
+        logger.opt(exception=e).warning('expiry events subscription failed, reconnecting')
+        time.sleep(1)
 
     def register_instance(self, _: str, instance: UserData) -> None:
-        pipeline = self.__client.pipeline()
+        pipeline = self.__pipeline()
 
         try:
-            pipeline.json().set(f'instance/{instance["instance_id"]}', '$', instance)  # type: ignore[call-arg,arg-type]
+            self.__write_instance(pipeline, instance)
             pipeline.hset('external_ids', instance['external_id'], instance['instance_id'])
             pipeline.zadd(
                 'expiries',
@@ -40,60 +281,215 @@ class RedisDatabase(Database):
         finally:
             pipeline.execute()
 
+        # note: cluster pipelines are refusing PUBLISH, so the event is sent once the instance has been written
+        self.__client.publish(
+            _EXPIRY_EVENTS_CHANNEL,
+            dumps({'instance_id': instance['instance_id'], 'expires_at': instance['expires_at']}),
+        )
+
+    def __write_instance(self, pipeline: Pipeline, instance: UserData) -> None:
+        key = self.__instance_key(instance['instance_id'])
+        if self.__encoding == 'hash':
+            pipeline.hset(key, mapping=encode_instance_hash(instance))
+            return
+
+        pipeline.json().set(key, '$', instance)  # type: ignore[call-arg,arg-type]
+
     def update_instance(self, _: str, __: UserData) -> Never:
         msg = 'not supported'
         raise RedisDatabaseError(msg)
 
     def unregister_instance(self, instance_id: str) -> UserData | None:
-        instance = cast('UserData | None', self.__client.json().get(f'instance/{instance_id}'))
-        if instance is None:
+        if not self.__cluster:
+            raw_instance = self.__unregister(
+                keys=['external_ids', 'expiries', *self.__instance_keys([instance_id])],
+                args=[instance_id, _EXPIRY_EVENTS_CHANNEL],
+            )
+            return self.__decode_instance(raw_instance, {})
+
+        response = self.__cluster_unregister(keys=[self.__instance_key(instance_id), self.__metadata_key(instance_id)])
+        if not response:
             return None
 
-        pipeline = self.__client.pipeline()
-        try:
-            pipeline.json().delete(f'instance/{instance_id}')
-            pipeline.hdel('external_ids', instance['external_id'])
-            pipeline.zrem('expiries', instance_id)
-            pipeline.delete(f'metadata/{instance_id}')
-            return cast('UserData', instance)
-        finally:
-            pipeline.execute()
+        raw_instance, external_id = response
+        pipeline = self.__pipeline()
+        pipeline.hdel('external_ids', external_id)
+        pipeline.zrem('expiries', instance_id)
+        pipeline.execute()
+        self.__client.publish(_EXPIRY_EVENTS_CHANNEL, dumps({'instance_id': instance_id, 'expires_at': None}))
+        return self.__decode_instance(raw_instance, {})
 
     def get_instance(self, instance_id: str) -> UserData | None:
-        instance = cast('UserData | None', self.__client.json().get(f'instance/{instance_id}'))
-        if instance is None:
-            return None
+        instance = self.__get_instances([instance_id], self.__reader)[0]
+        if instance is None and self.__reader is not self.__client:
+            instance = self.__get_instances([instance_id], self.__client)[0]
+        return instance
 
-        instance['metadata'] = {}
-        metadata = self.__client.hgetall(f'metadata/{instance_id}')
-        if metadata is not None:
-            metadata = {k: loads(v) for k, v in metadata.items()}  # type: ignore[union-attr]
-            instance['metadata'] = metadata
+    def get_instances(self, instance_ids: list[str]) -> list[UserData | None]:
+        return self.__get_instances(instance_ids, self.__reader)
 
-        return instance
+    def __get_instances(self, instance_ids: list[str], client: redis.Redis) -> list[UserData | None]:
+        if not instance_ids:
+            return []
+
+        if not self.__cluster:
+            response = self.__get_by_keys(keys=self.__instance_keys(instance_ids), client=client)
+            return [self.__decode_instance(*item) for item in response]
+
+        # note: scripts are loaded on the primaries only, so plain commands are used to be able to read from replicas
+        pipeline = self.__pipeline(client)
+        for instance_id in instance_ids:
+            if self.__encoding == 'hash':
+                pipeline.hgetall(self.__instance_key(instance_id))
+            else:
+                pipeline.execute_command('JSON.GET', self.__instance_key(instance_id), '.')
+            pipeline.hgetall(self.__metadata_key(instance_id))
+
+        response = pipeline.execute()
+        return [self.__decode_instance(response[i], response[i + 1]) for i in range(0, len(response), 2)]
 
     def get_instance_by_external_id(self, rpc_id: str) -> UserData | None:
-        instance_id = self.__client.hget('external_ids', rpc_id)
-        if instance_id is None:
-            return None
+        instance = self.__get_instance_by_external_id(rpc_id, self.__reader)
+        if instance is None and self.__reader is not self.__client:
+            instance = self.__get_instance_by_external_id(rpc_id, self.__client)
+        return instance
 
-        return self.get_instance(instance_id)  # type: ignore[arg-type]
+    def __get_instance_by_external_id(self, rpc_id: str, client: redis.Redis) -> UserData | None:
+        if not self.__cluster:
+            response = self.__get_by_external_id(
+                keys=['external_ids'], args=[rpc_id, self.__instance_key(''), self.__metadata_key('')], client=client
+            )
+            return self.__decode_instance(*response) if response else None
+
+        # note: the index and the instance are in different slots in cluster mode, so this takes two round trips
+        instance_id = cast('str | None', client.hget('external_ids', rpc_id))
+        return self.__get_instances([instance_id], client)[0] if instance_id is not None else None
 
     def get_all_instances(self) -> list[UserData]:
-        return [
-            instance
-            for key in self.__client.scan_iter(match='instance/*')
-            if (instance := self.get_instance(key.split('/')[1]))  # type: ignore[union-attr]
-        ]
+        return self.__get_instances_by_expiry('-inf', '+inf')
 
     def get_expired_instances(self) -> list[UserData]:
-        instance_ids = self.__client.zrange('expiries', 0, int(time.time()), byscore=True)
-        return [instance for instance_id in instance_ids if (instance := self.get_instance(instance_id))]  # type: ignore[union-attr]
+        return self.__get_instances_by_expiry('-inf', int(time.time()))
+
+    def __get_instances_by_expiry(self, min_score: int | str, max_score: int | str) -> list[UserData]:
+        # note: instances that are unregistered in between the two round trips are skipped
+        instance_ids = cast('list[str]', self.__reader.zrangebyscore('expiries', min_score, max_score))
+        return [instance for instance in self.__get_instances(instance_ids, self.__reader) if instance]
+
+    @staticmethod
+    def __decode_instance(
+        raw_instance: str | list[str] | dict[str, str] | None, raw_metadata: dict[str, str] | list[str]
+    ) -> UserData | None:
+        if not raw_instance:
+            return None
+
+        # note: scripts are returning json documents as a string, hashes and metadata as a flat list of pairs,
+        # pipelined HGETALLs are already decoded into a dict
+        if isinstance(raw_instance, list):
+            raw_instance = _pairs_to_dict(raw_instance)
+        if isinstance(raw_instance, dict):
+            instance = decode_instance_hash(raw_instance)
+        else:
+            instance = cast('UserData', loads(raw_instance))
+
+        if isinstance(raw_metadata, list):
+            raw_metadata = _pairs_to_dict(raw_metadata)
+        instance['metadata'] = {k: loads(v) for k, v in raw_metadata.items()}
+        return instance
+
+    def migrate_encoding(self, batch_size: int = 128) -> int:
+        # Rewrites all the instances that are stored in a different encoding than the configured one
+        if self.__cluster:
+            msg = 'encoding migration is not supported in cluster mode'
+            raise RedisDatabaseError(msg)
+
+        instance_ids = list(self.get_expiries())
+        source_encoding: RedisEncoding = 'json' if self.__encoding == 'hash' else 'hash'
+        migrated = 0
+
+        for offset in range(0, len(instance_ids), batch_size):
+            batch = instance_ids[offset : offset + batch_size]
+            # Records are read with the commands of the encoding they're migrated from, the ones that are already in
+            # the configured encoding are failing with WRONGTYPE and are left as they are
+            reads = self.__client.pipeline(transaction=False)
+            for instance_id in batch:
+                if source_encoding == 'hash':
+                    reads.hgetall(self.__instance_key(instance_id))
+                else:
+                    reads.json().get(self.__instance_key(instance_id))
+
+            for instance_id, raw_instance in zip(batch, reads.execute(raise_on_error=False), strict=True):
+                if not raw_instance or isinstance(raw_instance, redis.ResponseError):
+                    continue
+
+                migrated += self.__migrate_instance(instance_id, source_encoding)
+
+        return migrated
+
+    def __migrate_instance(self, instance_id: str, source_encoding: RedisEncoding) -> int:
+        # note: the record is read again while it's watched, so an instance that is unregistered in the meantime
+        # isn't written back, and the rewrite is retried if the record changes before it's done
+        key = self.__instance_key(instance_id)
+        with self.__client.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(key)
+                    instance = self.__read_watched_instance(pipeline, key, source_encoding)
+                    if instance is None:
+                        return 0
+
+                    # note: metadata is stored separately and stays where it is
+                    instance['metadata'] = {}
+                    pipeline.multi()
+                    pipeline.delete(key)
+                    self.__write_instance(pipeline, instance)
+                    pipeline.execute()
+                except redis.WatchError:
+                    continue
+                else:
+                    return 1
+
+    @staticmethod
+    def __read_watched_instance(pipeline: Pipeline, key: str, source_encoding: RedisEncoding) -> UserData | None:
+        try:
+            if source_encoding == 'hash':
+                raw_instance = cast('dict[str, str]', pipeline.hgetall(key))
+                return decode_instance_hash(raw_instance) if raw_instance else None
+
+            raw_document = cast('str | UserData | None', pipeline.execute_command('JSON.GET', key, '.'))
+        except redis.ResponseError:
+            # Records that are in the configured encoding already
+            return None
+
+        # note: the document is decoded already when the client has the RedisJSON response callbacks
+        return cast('UserData', loads(raw_document)) if isinstance(raw_document, str) else raw_document
+
+    def get_expiries(self) -> dict[str, float]:
+        return dict(cast('list[tuple[str, float]]', self.__client.zrange('expiries', 0, -1, withscores=True)))
+
+    def count_instances(self) -> int:
+        return cast('int', self.__reader.zcard('expiries'))
+
+    def claim_expired_instances(self, limit: int, lease: int) -> list[str]:
+        return cast('list[str]', self.__claim_expired(keys=['expiries'], args=[int(time.time()), limit, lease]))
+
+    def register_images(self, challenge_name: str, images: list[str]) -> None:
+        self.__client.hset('challenge_images', challenge_name, dumps(images))
+
+    def get_images(self) -> dict[str, list[str]]:
+        raw = cast('dict[str, str]', self.__client.hgetall('challenge_images'))
+        return {challenge_name: loads(images) for challenge_name, images in raw.items()}
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        return bool(self.__acquire_lease(keys=[f'lease/{name}'], args=[owner, int(ttl * 1000)]))
+
+    def release_lease(self, name: str, owner: str) -> None:
+        self.__release_lease(keys=[f'lease/{name}'], args=[owner])
 
     def update_metadata(self, instance_id: str, metadata: dict[str, str | list[dict[str, str]]]) -> None:
-        pipeline = self.__client.pipeline()
+        pipeline = self.__pipeline()
         try:
             for k, v in metadata.items():
-                pipeline.hset(f'metadata/{instance_id}', k, dumps(v))
+                pipeline.hset(self.__metadata_key(instance_id), k, dumps(v))
         finally:
             pipeline.execute()
@@ -1,112 +1,256 @@
 import json
 import sqlite3
-from threading import Lock
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from threading import Lock, local
 
 from loguru import logger
 
 from ctf_server.databases import Database
-from ctf_server.types import InstanceInfo, UserData
+from ctf_server.types import UserData
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS anvil_instances
+(
+    instance_id VARCHAR PRIMARY KEY,
+    rpc_id VARCHAR,
+    instance_data JSON,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS instance_metadata
+(
+    instance_id VARCHAR NOT NULL REFERENCES anvil_instances(instance_id) ON DELETE CASCADE,
+    key VARCHAR NOT NULL,
+    value JSON NOT NULL,
+    PRIMARY KEY (instance_id, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS challenge_images
+(
+    challenge_name VARCHAR PRIMARY KEY,
+    images JSON NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS leases
+(
+    name VARCHAR PRIMARY KEY,
+    owner VARCHAR NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+_INDEXES = """
+CREATE UNIQUE INDEX IF NOT EXISTS anvil_instances_rpc_id ON anvil_instances(rpc_id);
+CREATE INDEX IF NOT EXISTS anvil_instances_expires_at ON anvil_instances(expires_at);
+"""
+
+# note: sqlite3 keeps a per-connection cache of prepared statements keyed by the sql text, so all the queries are
+# constants and every thread prepares each of them only once
+_SELECT_INSTANCE = """
+SELECT instance_data, (
+    SELECT json_group_object(key, json(value)) FROM instance_metadata WHERE instance_id = anvil_instances.instance_id
+)
+FROM anvil_instances
+"""
+_GET_INSTANCE = f'{_SELECT_INSTANCE} WHERE instance_id = ?'
+_GET_INSTANCE_BY_RPC_ID = f'{_SELECT_INSTANCE} WHERE rpc_id = ?'
+_GET_ALL_INSTANCES = _SELECT_INSTANCE
+_GET_EXPIRED_INSTANCES = f'{_SELECT_INSTANCE} WHERE expires_at <= ?'
+_GET_EXPIRIES = 'SELECT instance_id, expires_at FROM anvil_instances'
+_COUNT_INSTANCES = 'SELECT COUNT(*) FROM anvil_instances'
+_COUNT_INSTANCES_PER_CHALLENGE = """
+SELECT COALESCE(json_extract(instance_data, '$.challenge_name'), ''), COUNT(*) FROM anvil_instances GROUP BY 1
+"""
+_INSERT_INSTANCE = 'INSERT INTO anvil_instances(instance_id, rpc_id, instance_data, expires_at) VALUES (?, ?, ?, ?)'
+_UPDATE_INSTANCE = 'UPDATE anvil_instances SET rpc_id = ?, instance_data = ?, expires_at = ? WHERE instance_id = ?'
+_DELETE_INSTANCE = 'DELETE FROM anvil_instances WHERE instance_id = ? RETURNING instance_data'
+_CLAIM_EXPIRED = """
+UPDATE anvil_instances SET expires_at = ?
+WHERE instance_id IN (SELECT instance_id FROM anvil_instances WHERE expires_at <= ? ORDER BY expires_at LIMIT ?)
+RETURNING instance_id
+"""
+_UPSERT_IMAGES = """
+INSERT INTO challenge_images(challenge_name, images) VALUES (?, ?)
+ON CONFLICT (challenge_name) DO UPDATE SET images = excluded.images
+"""
+_GET_IMAGES = 'SELECT challenge_name, images FROM challenge_images'
+# The conflicting row is updated only if it's ours or expired, nothing is returned otherwise
+_ACQUIRE_LEASE = """
+INSERT INTO leases(name, owner, expires_at) VALUES (?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+WHERE leases.owner = excluded.owner OR leases.expires_at <= ?
+RETURNING name
+"""
+_RELEASE_LEASE = 'DELETE FROM leases WHERE name = ? AND owner = ?'
+_UPSERT_METADATA = """
+INSERT INTO instance_metadata(instance_id, key, value) VALUES (?, ?, ?)
+ON CONFLICT (instance_id, key) DO UPDATE SET value = excluded.value
+"""
+
+_STATEMENT_CACHE_SIZE = 32
+_BUSY_TIMEOUT_MS = 5000
 
 
 class SQLiteDatabase(Database):
     def __init__(self, db_path: str) -> None:
         super().__init__()
 
-        self.__conn_lock = Lock()
-        self.__conn = sqlite3.connect(database=db_path, check_same_thread=False)
-        self.__conn.execute(
+        self.__db_path = db_path
+        self.__local = local()
+
+        # note: every connection to `:memory:` is a separate database, so in this case a single connection is shared
+        # between the threads, and file databases are getting a connection per thread instead
+        self.__shared_conn: sqlite3.Connection | None = None
+        self.__shared_conn_lock = Lock()
+        if db_path == ':memory:':
+            self.__shared_conn = self.__connect(check_same_thread=False)
+
+        with self.__connection() as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.executescript(_SCHEMA)
+            self.__migrate(conn)
+            conn.executescript(_INDEXES)
+
+    def __connect(self, *, check_same_thread: bool = True) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.__db_path,
+            isolation_level=None,
+            check_same_thread=check_same_thread,
+            cached_statements=_STATEMENT_CACHE_SIZE,
+        )
+        conn.execute(f'PRAGMA busy_timeout = {_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA foreign_keys = ON')
+        return conn
+
+    @contextmanager
+    def __connection(self) -> Iterator[sqlite3.Connection]:
+        if self.__shared_conn is not None:
+            with self.__shared_conn_lock:
+                yield self.__shared_conn
+            return
+
+        conn: sqlite3.Connection | None = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = self.__connect()
+            self.__local.conn = conn
+        yield conn
+
+    @staticmethod
+    def __migrate(conn: sqlite3.Connection) -> None:
+        # Databases created by older versions were storing everything within the json blob
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(anvil_instances)')]
+        if 'expires_at' not in columns:
+            conn.execute('ALTER TABLE anvil_instances ADD COLUMN expires_at REAL')
+
+        conn.execute(
             """
-CREATE TABLE IF NOT EXISTS anvil_instances
-(
-    instance_id VARCHAR PRIMARY KEY,
-    rpc_id VARCHAR,
-    instance_data JSON
-);"""
+UPDATE anvil_instances SET
+    rpc_id = json_extract(instance_data, '$.external_id'),
+    expires_at = json_extract(instance_data, '$.expires_at')
+WHERE rpc_id IS NULL OR expires_at IS NULL"""
         )
 
+    @staticmethod
+    def __decode_instance(row: tuple[str, str | None] | None) -> UserData | None:
+        if row is None:
+            return None
+
+        instance: UserData = json.loads(row[0])
+        instance['metadata'] = json.loads(row[1]) if row[1] else {}
+        return instance
+
     def register_instance(self, instance_id: str, instance: UserData) -> None:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                'INSERT INTO anvil_instances(instance_id, instance_data) VALUES (?, ?)',
-                (instance_id, json.dumps(instance)),
+        with self.__connection() as conn:
+            conn.execute(
+                _INSERT_INSTANCE,
+                (instance_id, instance['external_id'], json.dumps(instance), instance['expires_at']),
             )
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
-
-    def update_instance(self, instance_id: str, instance: InstanceInfo) -> None:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                'UPDATE anvil_instances SET instance_data = ? WHERE instance_id = ?',
-                (json.dumps(instance), instance_id),
+
+        self._notify_expiry(instance_id, instance['expires_at'])
+
+    def update_instance(self, instance_id: str, instance: UserData) -> None:
+        with self.__connection() as conn:
+            conn.execute(
+                _UPDATE_INSTANCE,
+                (instance['external_id'], json.dumps(instance), instance['expires_at'], instance_id),
             )
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
+
+        self._notify_expiry(instance_id, instance['expires_at'])
 
     def unregister_instance(self, instance_id: str) -> UserData | None:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                'DELETE FROM anvil_instances WHERE instance_id = ? RETURNING instance_data', (instance_id,)
-            )
-            row = cursor.fetchone()
-            if row is None:
-                return None
-
-            return json.loads(row[0])
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
-
-    def get_all_instances(self) -> list[InstanceInfo]:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute('SELECT instance_data FROM anvil_instances')
-            result = []
-            while True:
-                row = cursor.fetchone()
-                if row is None:
-                    break
-
-                result.append(json.loads(row[0]))
-            return result
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
+        with self.__connection() as conn:
+            row = conn.execute(_DELETE_INSTANCE, (instance_id,)).fetchone()
+
+        if row is None:
+            return None
+
+        self._notify_expiry(instance_id, None)
+        return json.loads(row[0])
+
+    def get_all_instances(self) -> list[UserData]:
+        with self.__connection() as conn:
+            rows = conn.execute(_GET_ALL_INSTANCES).fetchall()
+        return [instance for row in rows if (instance := self.__decode_instance(row))]
 
     def get_instance_by_external_id(self, rpc_id: str) -> UserData | None:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute('SELECT instance_data FROM anvil_instances WHERE rpc_id = ?', (rpc_id,))
-            row = cursor.fetchone()
-            if row is None:
-                return None
-
-            return json.loads(row[0])
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
+        with self.__connection() as conn:
+            return self.__decode_instance(conn.execute(_GET_INSTANCE_BY_RPC_ID, (rpc_id,)).fetchone())
 
     def get_instance(self, instance_id: str) -> UserData | None:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                'SELECT instance_data FROM anvil_instances WHERE instance_id = ?', (instance_id,)
-            )
-            row = cursor.fetchone()
-            if row is None:
-                return None
-
-            return json.loads(row[0])
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
+        with self.__connection() as conn:
+            return self.__decode_instance(conn.execute(_GET_INSTANCE, (instance_id,)).fetchone())
 
     def get_expired_instances(self) -> list[UserData]:
-        return []
+        with self.__connection() as conn:
+            rows = conn.execute(_GET_EXPIRED_INSTANCES, (time.time(),)).fetchall()
+        return [instance for row in rows if (instance := self.__decode_instance(row))]
+
+    def get_expiries(self) -> dict[str, float]:
+        with self.__connection() as conn:
+            return dict(conn.execute(_GET_EXPIRIES).fetchall())
+
+    def count_instances(self) -> int:
+        with self.__connection() as conn:
+            return conn.execute(_COUNT_INSTANCES).fetchone()[0]
+
+    def count_instances_per_challenge(self) -> dict[str, int]:
+        with self.__connection() as conn:
+            return dict(conn.execute(_COUNT_INSTANCES_PER_CHALLENGE).fetchall())
+
+    def claim_expired_instances(self, limit: int, lease: int) -> list[str]:
+        now = time.time()
+        with self.__connection() as conn:
+            return [row[0] for row in conn.execute(_CLAIM_EXPIRED, (now + lease, now, limit)).fetchall()]
+
+    def register_images(self, challenge_name: str, images: list[str]) -> None:
+        with self.__connection() as conn:
+            conn.execute(_UPSERT_IMAGES, (challenge_name, json.dumps(images)))
+
+    def get_images(self) -> dict[str, list[str]]:
+        with self.__connection() as conn:
+            return {challenge_name: json.loads(images) for challenge_name, images in conn.execute(_GET_IMAGES)}
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self.__connection() as conn:
+            return conn.execute(_ACQUIRE_LEASE, (name, owner, now + ttl, now)).fetchone() is not None
+
+    def release_lease(self, name: str, owner: str) -> None:
+        with self.__connection() as conn:
+            conn.execute(_RELEASE_LEASE, (name, owner))
 
     def update_metadata(self, instance_id: str, metadata: dict[str, str | list[dict[str, str]]]) -> None:
-        logger.warning(f'Update metadata not supported in SQLiteDatabase: {instance_id} {metadata}')
+        with self.__connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(_UPSERT_METADATA, [(instance_id, k, json.dumps(v)) for k, v in metadata.items()])
+            except sqlite3.IntegrityError:
+                # note: the instance is gone, updating its metadata is a no-op just like it has always been
+                conn.execute('ROLLBACK')
+                logger.warning(f'not updating metadata of an unknown instance: {instance_id}')
+                return
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
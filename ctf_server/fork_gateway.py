@@ -0,0 +1,350 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from typing import Any, cast
+
+import aiohttp
+from fastapi import FastAPI, Request
+from loguru import logger
+
+from .utils import parse_members
+
+
+# Comma separated name=url pairs of the upstream nodes, anvils are forking from `<gateway>/<name>`
+FORK_GATEWAY_UPSTREAMS = os.getenv('FORK_GATEWAY_UPSTREAMS', '')
+# Responses are kept on the disk in here, the cache is shared between the workers and survives the restarts
+FORK_GATEWAY_CACHE_DIR = os.getenv('FORK_GATEWAY_CACHE_DIR', '')
+FORK_GATEWAY_MEMORY_ENTRIES = int(os.getenv('FORK_GATEWAY_MEMORY_ENTRIES', '100000'))
+# Accessed state is recorded for this many of the most recently used blocks, see `/<name>/prestate/<block>`
+FORK_GATEWAY_RECORDED_BLOCKS = int(os.getenv('FORK_GATEWAY_RECORDED_BLOCKS', '16'))
+
+# Index of the block parameter of the methods whose results only depend on it
+_BLOCK_PARAM = {
+    'eth_getBalance': 1,
+    'eth_getTransactionCount': 1,
+    'eth_getCode': 1,
+    'eth_getStorageAt': 2,
+    'eth_getProof': 2,
+    'eth_call': 1,
+    'eth_getBlockByNumber': 0,
+}
+# Methods whose results never change once they are there
+_IMMUTABLE_METHODS = {
+    'eth_chainId',
+    'net_version',
+    'eth_getBlockByHash',
+    'eth_getTransactionByHash',
+    'eth_getTransactionReceipt',
+}
+
+# Fields of the prestate tracer accounts that the state queries are filling in
+_PRESTATE_FIELDS = {
+    'eth_getBalance': 'balance',
+    'eth_getTransactionCount': 'nonce',
+    'eth_getCode': 'code',
+    'eth_getStorageAt': 'storage',
+}
+
+Upstream = Callable[[list[dict]], Awaitable[list[dict]]]
+
+
+def jsonrpc_fail(id_: str | int | None, code: int, message: str) -> dict[str, Any]:
+    return {'jsonrpc': '2.0', 'id': id_, 'error': {'code': code, 'message': message}}
+
+
+def _is_pinned(block: object) -> bool:
+    # Block numbers and EIP-1898 block objects are pinned, tags like `latest` are not
+    if isinstance(block, dict):
+        return 'blockHash' in block or _is_pinned(block.get('blockNumber'))
+    return isinstance(block, str) and block.startswith('0x')
+
+
+def cache_key(chain: str, request: dict) -> str | None:
+    method = request.get('method')
+    params = request.get('params') or []
+    if not isinstance(method, str) or not isinstance(params, list):
+        return None
+
+    if method in _BLOCK_PARAM:
+        index = _BLOCK_PARAM[method]
+        if len(params) <= index or not _is_pinned(params[index]):
+            return None
+    elif method not in _IMMUTABLE_METHODS:
+        return None
+
+    # note: every parameter of the cached methods is hex, so the checksummed and lowercase addresses are the same
+    canonical = json.dumps([chain, method, params], sort_keys=True, separators=(',', ':')).lower()
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ForkCache:
+    """Content addressed cache of the responses, the hot ones are in memory and everything is on the disk."""
+
+    def __init__(self, path: Path | None, memory_entries: int = FORK_GATEWAY_MEMORY_ENTRIES) -> None:
+        self.__path = path
+        self.__memory: OrderedDict[str, Any] = OrderedDict()
+        self.__memory_entries = memory_entries
+        # note: the cache is used from the threads that are doing the disk io
+        self.__lock = Lock()
+
+    def get(self, key: str) -> Any:  # noqa: ANN401
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                return self.__memory[key]
+
+        if self.__path is None:
+            return None
+        try:
+            value = json.loads(self.__file(key).read_text())
+        except FileNotFoundError:
+            return None
+
+        self.__remember(key, value)
+        return value
+
+    def put(self, key: str, value: Any) -> None:  # noqa: ANN401
+        self.__remember(key, value)
+        if self.__path is None:
+            return
+
+        # note: written to a temporary file first, so that the other workers won't ever read a partial entry
+        file = self.__file(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(value))
+        tmp.replace(file)
+
+    def __remember(self, key: str, value: Any) -> None:  # noqa: ANN401
+        with self.__lock:
+            self.__memory[key] = value
+            self.__memory.move_to_end(key)
+            while len(self.__memory) > self.__memory_entries:
+                self.__memory.popitem(last=False)
+
+    def __file(self, key: str) -> Path:
+        return Path(self.__path or '') / key[:2] / f'{key[2:]}.json'
+
+
+class PrestateRecorder:
+    """Keeps the account state that has been accessed at each block, in the prestate tracer format."""
+
+    def __init__(self, blocks: int = FORK_GATEWAY_RECORDED_BLOCKS) -> None:
+        self.__blocks = blocks
+        self.__prestates: OrderedDict[int, dict[str, dict[str, Any]]] = OrderedDict()
+
+    def record(self, request: dict, result: Any) -> None:  # noqa: ANN401
+        field = _PRESTATE_FIELDS.get(request.get('method', ''))
+        params = request.get('params') or []
+        block = params[-1] if params else None
+        if field is None or result is None or not isinstance(block, str) or not block.startswith('0x'):
+            return
+
+        block_number = int(block, 16)
+        prestate = self.__prestates.setdefault(block_number, {})
+        self.__prestates.move_to_end(block_number)
+        while len(self.__prestates) > self.__blocks:
+            self.__prestates.popitem(last=False)
+
+        account = prestate.setdefault(params[0].lower(), {})
+        if field == 'storage':
+            account.setdefault('storage', {})[params[1].lower()] = result
+        elif field == 'nonce':
+            account['nonce'] = int(result, 16)
+        else:
+            account[field] = result
+
+    def prestate(self, block_number: int) -> dict[str, dict[str, Any]]:
+        return self.__prestates.get(block_number, {})
+
+
+@dataclass
+class ForkGatewayStats:
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    passthrough: int = 0
+
+
+class ForkGateway:
+    """State at a pinned block never changes, so whatever one anvil has fetched is served to the others from the cache.
+
+    Identical fetches that are in flight at the same time are sent upstream only once.
+    """
+
+    def __init__(self, chain: str, cache: ForkCache, upstream: Upstream) -> None:
+        self.__chain = chain
+        self.__cache = cache
+        self.__upstream = upstream
+        # Fetches that are in flight, resolved with the upstream response without its id
+        self.__inflight: dict[str, asyncio.Future[dict]] = {}
+        self.stats = ForkGatewayStats()
+        self.recorder = PrestateRecorder()
+
+    async def handle(self, body: dict | list) -> dict | list:
+        if isinstance(body, dict):
+            return (await self.handle_batch([body]))[0]
+        return await self.handle_batch(body)
+
+    async def handle_batch(self, batch: list) -> list[dict]:
+        keys = [cache_key(self.__chain, request) if isinstance(request, dict) else None for request in batch]
+        cached = await asyncio.to_thread(lambda: [self.__cache.get(key) if key else None for key in keys])
+
+        responses: list[dict | None] = [None] * len(batch)
+        waiting: dict[int, asyncio.Future[dict]] = {}
+        fetching: dict[int, asyncio.Future[dict]] = {}
+        forward: list[int] = []
+        for i, (request, key, value) in enumerate(zip(batch, keys, cached, strict=True)):
+            if not isinstance(request, dict):
+                responses[i] = jsonrpc_fail(None, -32600, 'expected json object')
+            elif value is not None:
+                self.stats.hits += 1
+                responses[i] = {'jsonrpc': '2.0', 'id': request.get('id'), 'result': value}
+            elif key is None:
+                self.stats.passthrough += 1
+                forward.append(i)
+            elif key in self.__inflight:
+                self.stats.coalesced += 1
+                waiting[i] = self.__inflight[key]
+            else:
+                self.stats.misses += 1
+                fetching[i] = self.__inflight[key] = asyncio.get_running_loop().create_future()
+                forward.append(i)
+
+        if forward:
+            forwarded = await self.__forward(batch, keys, forward, fetching)
+            for i in forward:
+                responses[i] = {**forwarded[i], 'id': batch[i].get('id')}
+
+        for i, future in waiting.items():
+            try:
+                response = await asyncio.shield(future)
+            except Exception:
+                response = jsonrpc_fail(None, -32603, 'upstream request failed')
+            responses[i] = {**response, 'id': batch[i].get('id')}
+
+        self.__record(batch, responses)
+        return [response for response in responses if response is not None]
+
+    def __record(self, batch: list, responses: list[dict | None]) -> None:
+        for request, response in zip(batch, responses, strict=True):
+            if isinstance(request, dict) and response is not None:
+                self.recorder.record(request, response.get('result'))
+
+    async def __forward(
+        self, batch: list, keys: list[str | None], forward: list[int], fetching: dict[int, asyncio.Future[dict]]
+    ) -> dict[int, dict]:
+        responses: dict[int, dict] = {}
+        try:
+            # note: ids are replaced with our own ones, the requests could have come with the duplicate ones
+            upstream_batch = [{**batch[i], 'id': n} for n, i in enumerate(forward)]
+            try:
+                upstream_responses = {
+                    response.get('id'): response for response in await self.__upstream(upstream_batch)
+                }
+            except Exception as e:
+                logger.opt(exception=e).error(f'upstream request of {self.__chain} failed')
+                upstream_responses = {}
+
+            for n, i in enumerate(forward):
+                response = upstream_responses.get(n) or jsonrpc_fail(None, -32603, 'upstream request failed')
+                responses[i] = {key: value for key, value in response.items() if key != 'id'}
+
+                # note: errors and nulls (e.g. blocks that aren't there yet) could be different the next time
+                key = keys[i]
+                if key is not None and responses[i].get('result') is not None:
+                    await asyncio.to_thread(self.__cache.put, key, responses[i]['result'])
+        finally:
+            # Waiters are woken up even if we've been cancelled halfway through
+            for i, future in fetching.items():
+                del self.__inflight[cast('str', keys[i])]
+                if i in responses:
+                    future.set_result(responses[i])
+                else:
+                    future.set_exception(RuntimeError('upstream request was cancelled'))
+        return responses
+
+
+@dataclass
+class Context:
+    # note: initialized within the lifespan
+    session: aiohttp.ClientSession = None  # type: ignore[assignment]
+    gateways: dict[str, ForkGateway] = None  # type: ignore[assignment]
+
+    def setup(self) -> None:
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60, connect=5))
+        cache = ForkCache(Path(FORK_GATEWAY_CACHE_DIR) if FORK_GATEWAY_CACHE_DIR else None)
+        self.gateways = {
+            chain: ForkGateway(chain, cache, self.__upstream(url))
+            for chain, url in parse_members(FORK_GATEWAY_UPSTREAMS).items()
+        }
+
+    def __upstream(self, url: str) -> Upstream:
+        async def send(batch: list[dict]) -> list[dict]:
+            async with self.session.post(url, json=batch) as resp:
+                body = await resp.json(content_type=None)
+            if not isinstance(body, list):
+                msg = f'unexpected upstream response: {body}'
+                raise TypeError(msg)
+            return body
+
+        return send
+
+    async def shutdown(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+
+context = Context()
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncGenerator[None]:
+    context.setup()
+    yield
+    await context.shutdown()
+
+
+app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+
+
+@app.get('/stats')
+async def stats() -> dict[str, ForkGatewayStats]:
+    return {chain: gateway.stats for chain, gateway in context.gateways.items()}
+
+
+@app.get('/{chain}/prestate/{block}')
+async def prestate(chain: str, block: str) -> dict:
+    # note: every worker is recording on its own, run a single one while recording
+    gateway = context.gateways.get(chain)
+    if gateway is None:
+        return {'ok': False, 'message': 'unknown chain'}
+
+    try:
+        block_number = int(block, 0)
+    except ValueError:
+        return {'ok': False, 'message': 'invalid block number'}
+    return {'ok': True, 'data': gateway.recorder.prestate(block_number)}
+
+
+@app.post('/{chain}')
+async def rpc(chain: str, request: Request) -> dict | list:
+    gateway = context.gateways.get(chain)
+    if gateway is None:
+        return jsonrpc_fail(None, -32602, 'unknown chain')
+
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return jsonrpc_fail(None, -32600, 'expected json body')
+    if not isinstance(body, dict | list):
+        return jsonrpc_fail(None, -32600, 'expected json object')
+
+    return await gateway.handle(body)
@@ -1,21 +1,41 @@
 import os
+from typing import TYPE_CHECKING, cast
 
-from .backends import Backend, DockerBackend, KubernetesBackend
-from .databases import Database, RedisDatabase, SQLiteDatabase
+from .backends import (
+    Backend,
+    DockerBackend,
+    FederatedKubernetesBackend,
+    KubernetesBackend,
+    MultiHostDockerBackend,
+    ProcessBackend,
+)
+from .databases import Database, MemoryDatabase, RedisDatabase, SQLiteDatabase
+from .utils import parse_members
+
+
+if TYPE_CHECKING:
+    from .databases.redis_encoding import RedisEncoding
 
 
 class BackendLoaderError(Exception):
     """Custom exception for errors in backend loading."""
 
 
-def load_database() -> Database:
+def load_database(*, prefer_replicas: bool = False) -> Database:
     dbtype = os.getenv('DATABASE', 'redis')
     if dbtype == 'sqlite':
         dbpath = os.getenv('SQLITE_PATH', ':memory:')
         return SQLiteDatabase(dbpath)
     if dbtype == 'redis':
         url = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0')
-        return RedisDatabase(url)
+        return RedisDatabase(
+            url,
+            encoding=cast('RedisEncoding', os.getenv('REDIS_ENCODING', 'json')),
+            prefer_replicas=prefer_replicas,
+        )
+    if dbtype == 'memory':
+        # Without a snapshot path, every worker process gets its own private database
+        return MemoryDatabase(os.getenv('MEMORY_DB_PATH') or None)
 
     msg = f'Invalid database type: {dbtype}'
     raise BackendLoaderError(msg) from None
@@ -25,9 +45,19 @@ def load_backend(database: Database) -> Backend:
     backend_type = os.getenv('BACKEND', 'docker')
     if backend_type == 'docker':
         return DockerBackend(database=database)
+    if backend_type == 'docker-multihost':
+        # name=url pairs, e.g. `a=ssh://deploy@10.0.0.2,b=tcp://10.0.0.3:2376`
+        hosts = parse_members(os.getenv('DOCKER_HOSTS', ''))
+        return MultiHostDockerBackend.from_urls(database, hosts)
     if backend_type == 'kubernetes':
         config_file = os.getenv('KUBECONFIG', 'incluster')
         return KubernetesBackend(database, config_file)
+    if backend_type == 'kubernetes-federated':
+        # name=kubeconfig pairs, e.g. `eu=/etc/kube/eu.yaml,us=/etc/kube/us.yaml`
+        clusters = parse_members(os.getenv('KUBERNETES_CLUSTERS', ''))
+        return FederatedKubernetesBackend.from_kubeconfigs(database, clusters)
+    if backend_type == 'process':
+        return ProcessBackend(database)
 
     msg = f'Invalid backend type: {backend_type}'
     raise BackendLoaderError(msg) from None
@@ -0,0 +1,267 @@
+import atexit
+import json
+import os
+import tempfile
+import time
+from bisect import bisect_left
+from collections.abc import Iterator
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Any
+
+from .tracing import tracer
+
+
+# Upper bounds of the latency buckets in seconds, from a single docker api call up to a slow kubernetes scheduling
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Every worker keeps its metrics in a file in here, so that a scrape of any worker covers all the workers of the server
+METRICS_DIR = Path(os.getenv('METRICS_DIR', Path(tempfile.gettempdir()) / 'paradigmctf-metrics'))
+# Workers are saving their metrics to their file this often, and right before they render a scrape
+METRICS_SAVE_INTERVAL = float(os.getenv('METRICS_SAVE_INTERVAL', '5'))
+
+# Phases that the launchers are allowed to report, anything else would be an unbounded label value
+LAUNCHER_PHASES = ('orchestrator_launch', 'load_prestate', 'deploy', 'update_metadata')
+
+
+@dataclass
+class _Series:
+    # Per-bucket counts, the last one is the +Inf bucket
+    counts: list[int]
+    total: float = 0.0
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """Cumulative histogram that is rendered in the prometheus text exposition format."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.__documentation = documentation
+        self.__labels = labels
+        self.__buckets = buckets
+
+        self.__lock = Lock()
+        self.__series: dict[tuple[str, ...], _Series] = {}
+        _METRICS.append(self)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        with self.__lock:
+            series = self.__series.get(label_values)
+            if series is None:
+                series = self.__series[label_values] = _Series([0] * (len(self.__buckets) + 1))
+            series.counts[bisect_left(self.__buckets, value)] += 1
+            series.total += value
+        _changed.set()
+
+    def dump(self) -> list[list[Any]]:
+        with self.__lock:
+            return [
+                [list(label_values), list(series.counts), series.total]
+                for label_values, series in self.__series.items()
+            ]
+
+    def render(self, dumps: list[list[list[Any]]] | None = None) -> list[str]:
+        # Renders the sum of the dumps of every worker, or the series of this worker only when there are none
+        merged: dict[tuple[str, ...], _Series] = {}
+        for label_values, counts, total in (
+            entry for dump in (dumps if dumps is not None else [self.dump()]) for entry in dump
+        ):
+            if len(counts) != len(self.__buckets) + 1:
+                continue
+            series = merged.setdefault(tuple(label_values), _Series([0] * len(counts)))
+            series.counts = [a + b for a, b in zip(series.counts, counts, strict=True)]
+            series.total += total
+
+        lines = [f'# HELP {self.name} {self.__documentation}', f'# TYPE {self.name} histogram']
+        for label_values, series in sorted(merged.items()):
+            labels = [f'{label}="{_escape(value)}"' for label, value in zip(self.__labels, label_values, strict=True)]
+            cumulative = 0
+            for bound, count in zip((*map(repr, self.__buckets), '+Inf'), series.counts, strict=True):
+                cumulative += count
+                bucket_labels = ','.join([*labels, f'le="{bound}"'])
+                lines.append(f'{self.name}_bucket{{{bucket_labels}}} {cumulative}')
+
+            suffix = f'{{{",".join(labels)}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {series.total}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """Current value of something within the workers, e.g. a backlog, summed over the workers that are alive."""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.__documentation = documentation
+        self.__labels = labels
+
+        self.__lock = Lock()
+        self.__values: dict[tuple[str, ...], float] = {}
+        _METRICS.append(self)
+
+    def set(self, value: float, *label_values: str) -> None:
+        with self.__lock:
+            self.__values[label_values] = value
+        _changed.set()
+
+    def dump(self) -> list[list[Any]]:
+        with self.__lock:
+            return [[list(label_values), value] for label_values, value in self.__values.items()]
+
+    def render(self, dumps: list[list[list[Any]]] | None = None) -> list[str]:
+        merged: dict[tuple[str, ...], float] = {}
+        for label_values, value in (
+            entry for dump in (dumps if dumps is not None else [self.dump()]) for entry in dump
+        ):
+            merged[tuple(label_values)] = merged.get(tuple(label_values), 0.0) + value
+
+        lines = [f'# HELP {self.name} {self.__documentation}', f'# TYPE {self.name} gauge']
+        for label_values, value in sorted(merged.items()):
+            labels = [f'{label}="{_escape(value)}"' for label, value in zip(self.__labels, label_values, strict=True)]
+            suffix = f'{{{",".join(labels)}}}' if labels else ''
+            lines.append(f'{self.name}{suffix} {value}')
+        return lines
+
+
+_METRICS: list[Histogram | Gauge] = []
+_save_lock = Lock()
+# Set whenever a metric changes, the saver only rewrites the file of the worker if anything has changed since
+_changed = Event()
+_saving = Event()
+
+LAUNCH_SECONDS = Histogram(
+    'paradigmctf_launch_seconds', 'Time spent launching an instance within the backend.', ('outcome',)
+)
+LAUNCH_PHASE_SECONDS = Histogram(
+    'paradigmctf_launch_phase_seconds', 'Time spent within each of the instance launch phases.', ('phase',)
+)
+PRUNE_SECONDS = Histogram(
+    'paradigmctf_prune_seconds', 'Time spent deleting an expired instance by the pruner.', ('outcome',)
+)
+PRUNER_BACKLOG = Gauge('paradigmctf_pruner_backlog', 'Expired instances that are waiting for a pruner worker.')
+PRUNER_IN_FLIGHT = Gauge('paradigmctf_pruner_in_flight', 'Expired instances that are being deleted right now.')
+
+# Phases of the launch that the current context is running, `None` outside of launches
+_timings: ContextVar[dict[str, float] | None] = ContextVar('launch_timings', default=None)
+_timings_lock = Lock()
+
+
+def _server_prefix() -> str:
+    # note: the workers of a server are the children of the same process, a restarted server gets a new set of files
+    return f'{os.getppid()}-'
+
+
+def setup_metrics() -> None:
+    # Only the servers are saving their metrics for the other workers, other processes are keeping them in memory
+    if _saving.is_set():
+        return
+
+    _saving.set()
+    Thread(target=_saver_thread, name='Metrics Saver', daemon=True).start()
+    atexit.register(_save_worker_metrics)
+
+
+def _saver_thread() -> None:
+    while True:
+        time.sleep(METRICS_SAVE_INTERVAL)
+        if _changed.is_set():
+            _save_worker_metrics()
+
+
+def _save_worker_metrics() -> None:
+    path = METRICS_DIR / f'{_server_prefix()}{os.getpid()}.json'
+    with _save_lock:
+        _changed.clear()
+        dumps = {metric.name: metric.dump() for metric in _METRICS}
+        with suppress(OSError):
+            METRICS_DIR.mkdir(parents=True, exist_ok=True)
+            # Written to a temporary file first, so that the other workers won't ever read a partial snapshot
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(dumps))
+            tmp_path.replace(path)
+
+
+def _is_worker_alive(pid: str) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _load_server_metrics() -> dict[str, list[list[list[Any]]]]:
+    dumps: dict[str, list[list[list[Any]]]] = {}
+    for path in METRICS_DIR.glob('*.json'):
+        # note: files of the workers that have exited are removed, prometheus sees it as a reset of the counters
+        if not _is_worker_alive(path.stem.rpartition('-')[2]):
+            with suppress(OSError):
+                path.unlink()
+            continue
+
+        if not path.name.startswith(_server_prefix()):
+            continue
+
+        try:
+            worker_dumps = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+
+        for name, dump in worker_dumps.items():
+            dumps.setdefault(name, []).append(dump)
+    return dumps
+
+
+def render_metrics() -> str:
+    # note: metrics that no worker has saved yet are rendered from this worker, i.e. empty
+    _save_worker_metrics()
+    dumps = _load_server_metrics()
+    lines = [line for metric in _METRICS for line in metric.render(dumps.get(metric.name))]
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def collect_timings() -> Iterator[dict[str, float]]:
+    # note: threads are getting the timings only if they're started within a copy of the current context
+    timings: dict[str, float] = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def record_phase(phase: str, seconds: float) -> None:
+    LAUNCH_PHASE_SECONDS.observe(seconds, phase)
+
+    timings = _timings.get()
+    if timings is None:
+        return
+
+    # Phases that are repeated for every chain or container are adding up
+    with _timings_lock:
+        timings[phase] = round(timings.get(phase, 0.0) + seconds, 6)
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    # note: every timed phase is traced as well, so that a single launch can be followed through the phases
+    started_at = time.perf_counter()
+    try:
+        with tracer.span(phase):
+            yield
+    finally:
+        record_phase(phase, time.perf_counter() - started_at)
@@ -1,15 +1,24 @@
-from collections.abc import AsyncGenerator
-from contextlib import asynccontextmanager
-from dataclasses import dataclass
+import asyncio
+import json
+import math
+import time
+from collections.abc import AsyncGenerator, AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass, field
+from typing import cast
 
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from loguru import logger
 
+from .admission import AdmissionError, AdmissionQueue
 from .backends import Backend
 from .backends.backend import InstanceExistsError
 from .databases import Database
 from .loaders import load_backend, load_database
-from .types import CreateInstanceRequest, UserData
+from .metrics import LAUNCHER_PHASES, record_phase, render_metrics, setup_metrics
+from .tracing import trace_requests, tracer
+from .types import CreateInstanceRequest, UserData, get_request_images
 from .utils import worker
 
 
@@ -18,10 +27,14 @@ class Context:
     # note(es3n1n, 27.03.24): HACK: mypy won't know that we will initialize these within the lifespan
     database: Database = None  # type: ignore[assignment]
     backend: Backend = None  # type: ignore[assignment]
+    admission: AdmissionQueue = None  # type: ignore[assignment]
+    # Images that this worker has already registered for each challenge, so that they're written only once
+    images: dict[str, list[str]] = field(default_factory=dict)
 
     def setup(self) -> None:
         self.database = load_database()
         self.backend = load_backend(self.database)
+        self.admission = AdmissionQueue(self.database)
 
 
 context = Context()
@@ -30,19 +43,47 @@ context = Context()
 @asynccontextmanager
 async def lifespan(_: FastAPI) -> AsyncGenerator[None]:
     worker.setup('orchestrator')
+    tracer.setup('orchestrator')
+    setup_metrics()
     context.setup()
     yield
 
 
 app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+app.middleware('http')(trace_requests)
 
 
-@app.post('/instances')
-def create_instance(args: CreateInstanceRequest) -> dict[str, bool | str | UserData]:
+LaunchResult = dict[str, bool | str | UserData]
+
+
+async def _launch_instance(args: CreateInstanceRequest, queue: asyncio.Queue[int] | None = None) -> LaunchResult:
     logger.info(f'launching new instance: {args["instance_id"]}')
 
     try:
-        user_data = context.backend.launch_instance(args)
+        # note: joining a launch that this worker is running already doesn't take up an admission slot
+        joined = await asyncio.to_thread(context.backend.join_launch, args['instance_id'])
+        if joined is not None:
+            user_data = joined
+        else:
+            async with AsyncExitStack() as stack:
+                admission_started_at = time.perf_counter()
+                with tracer.span('admission'):
+                    await stack.enter_async_context(
+                        context.admission.admit(args, on_position=queue.put_nowait if queue is not None else None)
+                    )
+                admission_seconds = time.perf_counter() - admission_started_at
+                # note: only the launch itself takes up a thread, the admission is waited for on the event loop
+                user_data = await asyncio.to_thread(context.backend.launch_instance, args)
+
+            # note: launches that have joined another one elsewhere aren't launches of their own in the metrics
+            if not user_data.get('coalesced'):
+                record_phase('admission', admission_seconds)
+    except AdmissionError as e:
+        logger.warning(f'instance was not admitted: {args["instance_id"]}: {e}')
+        return {
+            'ok': False,
+            'message': str(e),
+        }
     except InstanceExistsError:
         logger.warning(f'instance already exists: {args["instance_id"]}')
         return {
@@ -56,11 +97,152 @@ def create_instance(args: CreateInstanceRequest) -> dict[str, bool | str | UserD
             'message': 'an internal error occurred',
         }
 
+    # note: the caller who has launched the instance is setting it up, the coalesced ones should wait for it instead
+    if user_data.pop('coalesced', False):
+        logger.info(f'joined the launch of the instance: {args["instance_id"]}')
+        return {
+            'ok': True,
+            'message': 'instance is being launched by another request',
+            'data': user_data,
+            'coalesced': True,
+        }
+
     logger.info(f'launched new instance: {args["instance_id"]}')
+    await asyncio.to_thread(_register_images, args['challenge_name'], get_request_images(args))
     return {
         'ok': True,
         'message': 'instance launched',
         'data': user_data,
+        'coalesced': False,
+    }
+
+
+def _register_images(challenge_name: str, images: list[str]) -> None:
+    if context.images.get(challenge_name) == images:
+        return
+
+    try:
+        context.database.register_images(challenge_name, images)
+    except Exception as e:
+        logger.opt(exception=e).warning(f'failed to register images of {challenge_name}')
+        return
+    context.images[challenge_name] = images
+
+
+# Streamed launches that are still running, they're referenced here so that they won't be garbage collected
+_launches: set[asyncio.Task[LaunchResult]] = set()
+
+
+def _stream_launch(args: CreateInstanceRequest) -> AsyncIterator[str]:
+    # Every line is a json object, these are the queue positions while the launch is waiting and then the result
+    positions: asyncio.Queue[int] = asyncio.Queue()
+
+    async def launch() -> LaunchResult:
+        # note: the request span ends once the headers are sent, the launch has its own span within the same trace
+        try:
+            with tracer.span('stream_launch', instance_id=args['instance_id']):
+                return await _launch_instance(args, positions)
+        finally:
+            positions.put_nowait(0)
+
+    # note: the launch is started right away within the context of the request, so that it continues its trace, and it
+    # keeps going even if the client disconnects
+    task = asyncio.create_task(launch())
+    _launches.add(task)
+    task.add_done_callback(_launches.discard)
+    return _stream_positions(positions, task)
+
+
+async def _stream_positions(positions: asyncio.Queue[int], launch: asyncio.Task[LaunchResult]) -> AsyncIterator[str]:
+    while position := await positions.get():
+        yield json.dumps({'position': position}) + '\n'
+    yield json.dumps(await launch) + '\n'
+
+
+@app.post('/instances', response_model=None)
+async def create_instance(args: CreateInstanceRequest, *, stream: bool = False) -> LaunchResult | StreamingResponse:
+    if stream:
+        return StreamingResponse(_stream_launch(args), media_type='application/x-ndjson')
+    return await _launch_instance(args)
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+def metrics() -> str:
+    # note: every worker saves its histograms to `METRICS_DIR`, whichever worker gets the scrape renders all of them
+    return render_metrics()
+
+
+@app.get('/launches/slowest')
+def slowest_launches(limit: int = 10) -> dict[str, bool | str | list[dict[str, str | dict[str, float]]]]:
+    # Instances that are still running are the recent launches, each of them carries the timings of its launch
+    launches: list[dict[str, str | dict[str, float]]] = [
+        {
+            'instance_id': instance['instance_id'],
+            'challenge_name': instance.get('challenge_name', ''),
+            'trace_id': instance.get('trace_id', ''),
+            'timings': {**instance['timings'], **_launcher_timings(instance)},
+        }
+        for instance in context.database.get_all_instances()
+        if 'timings' in instance
+    ]
+    launches.sort(key=lambda launch: cast('dict[str, float]', launch['timings']).get('total', 0.0), reverse=True)
+    return {'ok': True, 'message': 'fetched launches', 'data': launches[:limit]}
+
+
+def _launcher_timings(instance: UserData) -> dict[str, float]:
+    return {entry['phase']: float(entry['seconds']) for entry in instance['metadata'].get('launcher_timings', [])}
+
+
+@app.post('/instances/{instance_id}/timings')
+def report_timings(instance_id: str, timings: dict[str, float]) -> dict[str, bool | str]:
+    # Launchers are reporting the phases that happen after the instance is up, e.g. the challenge deploy
+    timings = {
+        phase: seconds
+        for phase, seconds in timings.items()
+        if phase in LAUNCHER_PHASES and math.isfinite(seconds) and seconds >= 0
+    }
+    for phase, seconds in timings.items():
+        record_phase(f'launcher_{phase}', seconds)
+
+    try:
+        context.database.update_metadata(
+            instance_id,
+            {
+                'launcher_timings': [
+                    {'phase': f'launcher_{phase}', 'seconds': f'{seconds:.6f}'} for phase, seconds in timings.items()
+                ]
+            },
+        )
+    except Exception:
+        return {'ok': False, 'message': 'instance does not exist'}
+
+    return {
+        'ok': True,
+        'message': 'timings reported',
+    }
+
+
+@app.get('/images')
+def get_images() -> dict[str, bool | str | dict[str, dict[str, list[str] | dict[str, bool]]]]:
+    images = context.backend.get_images()
+    status = context.backend.get_image_status(sorted(images))
+    return {
+        'ok': True,
+        'message': 'fetched images',
+        'data': {
+            image: {'challenges': challenges, 'present': status.get(image, {})} for image, challenges in images.items()
+        },
+    }
+
+
+@app.post('/images')
+def register_images(challenge_name: str, images: list[str]) -> dict[str, bool | str]:
+    # Challenges could be registered ahead of their first launch, so that even that one won't have to pull anything
+    context.database.register_images(challenge_name, sorted(set(images)))
+    context.images.pop(challenge_name, None)
+    return {
+        'ok': True,
+        'message': 'images registered',
     }
 
 
@@ -0,0 +1,245 @@
+import atexit
+import json
+import os
+import random
+import re
+import secrets
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from queue import Empty, SimpleQueue
+from threading import Lock, Thread
+from typing import TYPE_CHECKING, Any
+
+import requests
+from loguru import logger
+
+
+if TYPE_CHECKING:
+    from starlette.requests import Request
+    from starlette.responses import Response
+
+
+# Finished spans are appended to this file as json lines, e.g. `/var/log/paradigmctf/spans.jsonl`
+TRACING_EXPORT_PATH = os.getenv('TRACING_EXPORT_PATH')
+# Finished spans are sent to this OTLP/HTTP collector in the json encoding, e.g. `http://otel-collector:4318/v1/traces`
+TRACING_COLLECTOR_URL = os.getenv('TRACING_COLLECTOR_URL')
+# Share of the traces started by this service that are recorded, traces of the callers are recorded if they are
+TRACING_SAMPLE_RATIO = float(os.getenv('TRACING_SAMPLE_RATIO', '1'))
+TRACING_EXPORT_INTERVAL = float(os.getenv('TRACING_EXPORT_INTERVAL', '1'))
+
+TRACEPARENT_HEADER = 'traceparent'
+
+_TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+_MAX_BATCH_SIZE = 512
+
+AttributeValue = str | int | float | bool
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    sampled: bool
+    attributes: dict[str, AttributeValue] = field(default_factory=dict)
+    start_time: float = field(default_factory=time.time)
+    end_time: float | None = None
+    error: str | None = None
+
+    @property
+    def traceparent(self) -> str:
+        return f'00-{self.trace_id}-{self.span_id}-{"01" if self.sampled else "00"}'
+
+    def set_attribute(self, key: str, value: AttributeValue) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self, service_name: str) -> dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'service': service_name,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def _parse_traceparent(traceparent: str | None) -> tuple[str, str, bool] | None:
+    match = _TRACEPARENT_RE.match(traceparent.strip().lower()) if traceparent else None
+    if match is None or match[1] == '0' * 32 or match[2] == '0' * 16:
+        return None
+    return match[1], match[2], bool(int(match[3], 16) & 1)
+
+
+def _otlp_value(value: AttributeValue) -> dict[str, AttributeValue]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': value}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': value}
+
+
+def _otlp_span(span: dict[str, Any]) -> dict[str, Any]:
+    otlp_span = {
+        'traceId': span['trace_id'],
+        'spanId': span['span_id'],
+        'name': span['name'],
+        'kind': 1,
+        'startTimeUnixNano': str(int(span['start_time'] * 1e9)),
+        'endTimeUnixNano': str(int(span['end_time'] * 1e9)),
+        'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in span['attributes'].items()],
+        # note: 1 is ok and 2 is error in the OTLP status codes
+        'status': {'code': 2, 'message': span['error']} if span['error'] else {'code': 1},
+    }
+    if span['parent_id']:
+        otlp_span['parentSpanId'] = span['parent_id']
+    return otlp_span
+
+
+class _Exporter:
+    def __init__(self, path: str | None, collector_url: str | None) -> None:
+        self.__path = path
+        self.__collector_url = collector_url
+        self.__queue: SimpleQueue[dict[str, Any]] = SimpleQueue()
+        self.__lock = Lock()
+
+    def start(self) -> None:
+        Thread(target=self.__exporter_thread, name='Span Exporter', daemon=True).start()
+        atexit.register(self.flush)
+
+    def export(self, span: dict[str, Any]) -> None:
+        self.__queue.put(span)
+
+    def flush(self) -> None:
+        with self.__lock:
+            while spans := self.__take_batch():
+                try:
+                    self.__write(spans)
+                except Exception as e:
+                    logger.warning(f'failed to export {len(spans)} spans: {e}')
+
+    def __take_batch(self) -> list[dict[str, Any]]:
+        spans: list[dict[str, Any]] = []
+        while len(spans) < _MAX_BATCH_SIZE:
+            try:
+                spans.append(self.__queue.get_nowait())
+            except Empty:
+                break
+        return spans
+
+    def __exporter_thread(self) -> None:
+        while True:
+            time.sleep(TRACING_EXPORT_INTERVAL)
+            self.flush()
+
+    def __write(self, spans: list[dict[str, Any]]) -> None:
+        if self.__path is not None:
+            with open(self.__path, 'a') as f:  # noqa: PTH123
+                f.writelines(json.dumps(span) + '\n' for span in spans)
+
+        if self.__collector_url is None:
+            return
+
+        # The spans of a batch can come from a single service only, since every process has its own exporter
+        resource = {'attributes': [{'key': 'service.name', 'value': _otlp_value(spans[0]['service'])}]}
+        body = {
+            'resourceSpans': [
+                {
+                    'resource': resource,
+                    'scopeSpans': [{'scope': {'name': 'paradigmctf'}, 'spans': [_otlp_span(span) for span in spans]}],
+                }
+            ]
+        }
+        requests.post(self.__collector_url, json=body, timeout=5).raise_for_status()
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.service_name = 'paradigmctf'
+        self.__sample_ratio = TRACING_SAMPLE_RATIO
+        self.__exporter: _Exporter | None = None
+        self.__current: ContextVar[Span | None] = ContextVar('current_span', default=None)
+
+    def setup(
+        self,
+        service_name: str,
+        export_path: str | None = TRACING_EXPORT_PATH,
+        collector_url: str | None = TRACING_COLLECTOR_URL,
+        sample_ratio: float = TRACING_SAMPLE_RATIO,
+    ) -> None:
+        # Spans aren't exported anywhere until there's a file or a collector to export them to
+        self.service_name = service_name
+        self.__sample_ratio = sample_ratio
+        if self.__exporter is not None or (export_path is None and collector_url is None):
+            return
+
+        self.__exporter = _Exporter(export_path, collector_url)
+        self.__exporter.start()
+
+    @property
+    def enabled(self) -> bool:
+        return self.__exporter is not None
+
+    @property
+    def trace_id(self) -> str | None:
+        # Trace of the current span, as long as it's going to be exported
+        span = self.__current.get()
+        return span.trace_id if self.enabled and span is not None and span.sampled else None
+
+    @contextmanager
+    def span(self, name: str, traceparent: str | None = None, **attributes: AttributeValue) -> Iterator[Span]:
+        # The span continues the trace of the caller when it has sent one, or the trace of the current span otherwise
+        parent = self.__current.get()
+        if (remote := _parse_traceparent(traceparent)) is not None:
+            trace_id, parent_id, sampled = remote
+        elif parent is not None:
+            trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+        else:
+            trace_id, parent_id, sampled = secrets.token_hex(16), None, random.random() < self.__sample_ratio  # noqa: S311
+
+        span = Span(name, trace_id, secrets.token_hex(8), parent_id, sampled, dict(attributes))
+        token = self.__current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            self.__current.reset(token)
+            span.end_time = time.time()
+            if span.sampled and self.__exporter is not None:
+                self.__exporter.export(span.to_dict(self.service_name))
+
+    def inject(self, headers: dict[str, str] | None = None) -> dict[str, str]:
+        # Headers to pass the current trace on to another service, nothing is sent while the tracing is disabled
+        headers = {} if headers is None else headers
+        if self.enabled and (span := self.__current.get()) is not None:
+            headers[TRACEPARENT_HEADER] = span.traceparent
+        return headers
+
+    def flush(self) -> None:
+        if self.__exporter is not None:
+            self.__exporter.flush()
+
+
+tracer = Tracer()
+
+
+async def trace_requests(request: 'Request', call_next: Callable[['Request'], Awaitable['Response']]) -> 'Response':
+    # HTTP middleware that puts every request in a span, continuing the trace of the caller
+    with tracer.span(request.method, request.headers.get(TRACEPARENT_HEADER), path=request.url.path) as span:
+        response = await call_next(request)
+        # note: the route is only known once the request has been routed
+        if (route := request.scope.get('route')) is not None:
+            span.name = f'{request.method} {route.path}'
+        span.set_attribute('status_code', response.status_code)
+        return response
@@ -1,12 +1,12 @@
 import os
-from typing import NotRequired
+from typing import Literal, NotRequired, get_args
 
-from eth_account import Account
 from eth_account.account import LocalAccount
-from eth_account.hdaccount import key_from_seed, seed_from_mnemonic
 from typing_extensions import TypedDict
 from web3 import Web3
 
+from ctf_server.accounts import derive_account
+
 
 DEFAULT_IMAGE = 'ghcr.io/foundry-rs/foundry:latest'
 DEFAULT_DERIVATION_PATH = "m/44'/60'/0'/0/"
@@ -16,6 +16,16 @@ DEFAULT_MNEMONIC = 'test test test test test test test test test test test junk'
 
 PUBLIC_HOST = os.getenv('PUBLIC_HOST', 'http://127.0.0.1:8545').rstrip('/')
 
+# off - no state is persisted, a restarted anvil starts from scratch
+# interval - the state is dumped every `state_interval` seconds
+# exit - the state is dumped only when anvil is stopped
+# tmpfs - same as interval, but the data directory is memory backed
+AnvilPersistence = Literal['off', 'interval', 'exit', 'tmpfs']
+DEFAULT_PERSISTENCE: AnvilPersistence = 'interval'
+DEFAULT_STATE_INTERVAL = 5
+# Upper bound of the memory backed data directories, in bytes
+ANVIL_TMPFS_SIZE = int(os.getenv('ANVIL_TMPFS_SIZE', str(256 * 1024 * 1024)))
+
 
 class LaunchAnvilInstanceArgs(TypedDict):
     image: NotRequired[str | None]
@@ -32,15 +42,56 @@ class LaunchAnvilInstanceArgs(TypedDict):
     block_time: NotRequired[int | None]
     extra_allowed_methods: NotRequired[list[str] | None]
     gas_limit: NotRequired[int | None]
-
-
-def format_anvil_args(args: LaunchAnvilInstanceArgs, anvil_id: str, port: int = 8545) -> list[str]:
+    persistence: NotRequired[AnvilPersistence | None]
+    state_interval: NotRequired[int | None]
+    # True to keep no history at all, a number to keep at most that many states in memory
+    prune_history: NotRequired[bool | int | None]
+    max_persisted_states: NotRequired[int | None]
+    transaction_block_keeper: NotRequired[int | None]
+    no_storage_caching: NotRequired[bool | None]
+    # Memory limit of the anvil container, in bytes
+    memory_limit: NotRequired[int | None]
+
+
+_MiB = 1024 * 1024
+
+# Memory bounding presets for `get_anvil_instance(profile=...)`, explicitly passed arguments take precedence
+AnvilProfile = Literal['tiny', 'standard', 'fork-heavy']
+ANVIL_PROFILES: dict[AnvilProfile, LaunchAnvilInstanceArgs] = {
+    # Short lived challenges without forking, history beyond the latest state is never needed
+    'tiny': LaunchAnvilInstanceArgs(
+        prune_history=True,
+        transaction_block_keeper=64,
+        memory_limit=256 * _MiB,
+    ),
+    'standard': LaunchAnvilInstanceArgs(
+        max_persisted_states=64,
+        transaction_block_keeper=256,
+        memory_limit=1024 * _MiB,
+    ),
+    # note: the fork cache is what makes the forked chains fast, so it's kept while the in-memory history is bounded
+    'fork-heavy': LaunchAnvilInstanceArgs(
+        prune_history=128,
+        transaction_block_keeper=256,
+        memory_limit=4096 * _MiB,
+    ),
+}
+
+
+def format_anvil_args(
+    args: LaunchAnvilInstanceArgs,
+    anvil_id: str,
+    port: int = 8545,
+    *,
+    host: str = '0.0.0.0',
+    data_dir: str = '/data',
+) -> list[str]:
     cmd_args = []
-    cmd_args += ['--host', '0.0.0.0']
+    cmd_args += ['--host', host]
     cmd_args += ['--port', str(port)]
     cmd_args += ['--accounts', '0']
-    cmd_args += ['--state', f'/data/{anvil_id}-state.json']
-    cmd_args += ['--state-interval', '5']
+    cmd_args += _format_state_args(args, anvil_id, data_dir)
+    cmd_args += _format_memory_args(args)
 
     if args.get('fork_url') is not None:
         cmd_args += ['--fork-url', str(args['fork_url'])]
@@ -69,12 +120,47 @@ def format_anvil_args(args: LaunchAnvilInstanceArgs, anvil_id: str, port: int =
     return cmd_args
 
 
+def _format_state_args(args: LaunchAnvilInstanceArgs, anvil_id: str, data_dir: str) -> list[str]:
+    persistence = args.get('persistence') or DEFAULT_PERSISTENCE
+    if persistence not in get_args(AnvilPersistence):
+        msg = f'unknown persistence mode: {persistence}'
+        raise ValueError(msg)
+
+    cmd_args = []
+    if persistence != 'off':
+        cmd_args += ['--state', f'{data_dir}/{anvil_id}-state.json']
+    if persistence in ('interval', 'tmpfs'):
+        cmd_args += ['--state-interval', str(args.get('state_interval') or DEFAULT_STATE_INTERVAL)]
+    return cmd_args
+
+
+def _format_memory_args(args: LaunchAnvilInstanceArgs) -> list[str]:
+    cmd_args = []
+    prune_history = args.get('prune_history')
+    if prune_history is True:
+        cmd_args += ['--prune-history']
+    elif prune_history:
+        cmd_args += ['--prune-history', str(prune_history)]
+
+    if args.get('max_persisted_states') is not None:
+        cmd_args += ['--max-persisted-states', str(args['max_persisted_states'])]
+
+    if args.get('transaction_block_keeper') is not None:
+        cmd_args += ['--transaction-block-keeper', str(args['transaction_block_keeper'])]
+
+    if args.get('no_storage_caching'):
+        cmd_args += ['--no-storage-caching']
+    return cmd_args
+
+
 def format_anvil_env(_: LaunchAnvilInstanceArgs) -> dict[str, str]:
     return {}
 
 
 class DaemonInstanceArgs(TypedDict):
     image: str
+    # Command that is started instead of the image by the process backend
+    command: NotRequired[list[str] | None]
 
 
 class CreateInstanceRequest(TypedDict):
@@ -86,6 +172,12 @@ class CreateInstanceRequest(TypedDict):
     daemon_instances: NotRequired[dict[str, DaemonInstanceArgs]]
 
 
+def get_request_images(request: CreateInstanceRequest) -> list[str]:
+    images = {args.get('image') or DEFAULT_IMAGE for args in request.get('anvil_instances', {}).values()}
+    images.update(args['image'] for args in request.get('daemon_instances', {}).values())
+    return sorted(images)
+
+
 class InstanceInfo(TypedDict):
     id: str
     ip: NotRequired[str]
@@ -101,13 +193,21 @@ class UserData(TypedDict):
     anvil_instances: dict[str, InstanceInfo]
     daemon_instances: dict[str, InstanceInfo]
     metadata: dict
+    challenge_name: NotRequired[str]
+    # Seconds spent within each of the launch phases, see `ctf_server.metrics`
+    timings: NotRequired[dict[str, float]]
+    # Trace that the instance was launched within, see `ctf_server.tracing`
+    trace_id: NotRequired[str]
+    # Name of the cluster or host that the instance was placed on by a multi-cluster backend
+    placement: NotRequired[str]
+    # Kubernetes namespace that the pod of the instance was created in
+    namespace: NotRequired[str]
+    # Set on the launch results of the callers that were joined onto another launch of the same instance, not stored
+    coalesced: NotRequired[bool]
 
 
 def get_account(mnemonic: str, offset: int) -> LocalAccount:
-    seed = seed_from_mnemonic(mnemonic, '')
-    private_key = key_from_seed(seed, f'{DEFAULT_DERIVATION_PATH}{offset}')
-
-    return Account.from_key(private_key)
+    return derive_account(mnemonic, f'{DEFAULT_DERIVATION_PATH}{offset}')
 
 
 def get_player_account(mnemonic: str) -> LocalAccount:
@@ -3,6 +3,28 @@ import contextlib
 from filelock import FileLock, Timeout
 
 
+class MemberDefinitionError(Exception):
+    """Custom exception for invalid member definitions."""
+
+
+def parse_members(value: str) -> dict[str, str]:
+    # Comma separated name=value pairs, e.g. cluster kubeconfigs, docker host urls or upstream rpc urls
+    members: dict[str, str] = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        name, sep, member = item.strip().partition('=')
+        if not sep or not name or not member:
+            msg = f'invalid member definition: {item}'
+            raise MemberDefinitionError(msg)
+        members[name] = member
+
+    if not members:
+        msg = 'no members are configured'
+        raise MemberDefinitionError(msg)
+    return members
+
+
 class Worker:
     def __init__(self) -> None:
         self.lock: FileLock | None = None
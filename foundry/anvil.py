@@ -1,5 +1,7 @@
+from typing import Any
+
 from web3 import Web3
-from web3.types import RPCResponse
+from web3.types import RPCEndpoint, RPCResponse
 
 
 class AnvilError(Exception):
@@ -12,6 +14,27 @@ def check_error(resp: RPCResponse) -> None:
         raise AnvilError(msg)
 
 
+def check_batch_error(resp: list[RPCResponse] | RPCResponse) -> None:
+    # note: a malformed batch is answered with a single error object instead of a list
+    if not isinstance(resp, list):
+        check_error(resp)
+        return
+
+    for item in resp:
+        check_error(item)
+
+
+def anvil_batch(web3: Web3, requests: list[tuple[str, list[Any]]]) -> None:
+    if not requests:
+        return
+
+    check_batch_error(
+        web3.provider.make_batch_request(  # type: ignore[attr-defined]
+            [(RPCEndpoint(method), params) for method, params in requests],
+        )
+    )
+
+
 def anvil_auto_impersonate_account(web3: Web3, *, enabled: bool) -> None:
     check_error(
         web3.provider.make_request(
@@ -55,3 +78,28 @@ def anvil_set_balance(
             [addr, balance],
         )
     )
+
+
+def anvil_set_balances(
+    web3: Web3,
+    balances: dict[str, str],
+) -> None:
+    anvil_batch(web3, [('anvil_setBalance', [addr, balance]) for addr, balance in balances.items()])
+
+
+def anvil_load_prestate(web3: Web3, prestate: dict[str, dict[str, Any]], batch_size: int = 500) -> None:
+    # Accounts are in the prestate tracer format, e.g. {"0x..": {"balance": "0x..", "nonce": 1, "storage": {..}}}
+    requests: list[tuple[str, list[Any]]] = []
+    for addr, account in prestate.items():
+        if 'balance' in account:
+            requests.append(('anvil_setBalance', [addr, account['balance']]))
+        if 'nonce' in account:
+            requests.append(('anvil_setNonce', [addr, hex(account['nonce'])]))
+        if 'code' in account:
+            requests.append(('anvil_setCode', [addr, account['code']]))
+        requests.extend(
+            ('anvil_setStorageAt', [addr, slot, value]) for slot, value in account.get('storage', {}).items()
+        )
+
+    for offset in range(0, len(requests), batch_size):
+        anvil_batch(web3, requests[offset : offset + batch_size])
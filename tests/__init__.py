@@ -1,7 +1,13 @@
+import threading
+import time
 from pathlib import Path
+from typing import Any, cast
 
 from cheb3.utils import compile_file
 
+from ctf_server.backends.backend import Backend
+from ctf_server.databases import Database
+from ctf_server.types import CreateInstanceRequest, UserData
 from ctf_solvers.solver import SolverError, get_instance_info, get_pwn_flag, kill_instance, launch_instance
 from ctf_solvers.types import ChallengeInstanceInfo
 
@@ -44,3 +50,68 @@ class Instance:
 
 HELLO_PWN = Instance(port=31337)
 EXTRA_METHODS_PWN = Instance(port=31338)
+
+
+def user_data_for(instance_id: str, expires_in: float = 60, **fields: Any) -> UserData:  # noqa: ANN401
+    now = time.time()
+    user_data = {
+        'instance_id': instance_id,
+        'external_id': f'{instance_id}-external',
+        'created_at': now,
+        'expires_at': now + expires_in,
+        'anvil_instances': {},
+        'daemon_instances': {},
+        'metadata': {},
+    }
+    return cast('UserData', {**user_data, **fields})
+
+
+def request_for(instance_id: str, **fields: Any) -> CreateInstanceRequest:  # noqa: ANN401
+    request = {
+        'instance_id': instance_id,
+        'team_id': 'team',
+        'challenge_name': 'challenge',
+        'timeout': 60,
+        'anvil_instances': {},
+        'daemon_instances': {},
+    }
+    return cast('CreateInstanceRequest', {**request, **fields})
+
+
+class StubBackend(Backend):
+    # Launches are only recorded, they're held back until `release` is set
+    def __init__(self, database: Database) -> None:
+        super().__init__(database, background_tasks=False)
+        self.launched: list[str] = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def _launch_instance_impl(self, args: CreateInstanceRequest) -> UserData:
+        self.launched.append(args['instance_id'])
+        self.release.wait(5)
+        return user_data_for(args['instance_id'])
+
+    def _cleanup_instance(self, _: CreateInstanceRequest) -> None:
+        pass
+
+    def destroy_instance(self, _: UserData) -> None:
+        pass
+
+
+class StubMember:
+    # Member backend of a placement backend, the ones that `fail` are refusing every launch
+    def __init__(self, *, fail: bool = False) -> None:
+        self.fail = fail
+        self.launched: list[str] = []
+        self.destroyed: list[str] = []
+
+    def create_instance(self, args: CreateInstanceRequest) -> UserData:
+        if self.fail:
+            msg = 'out of capacity'
+            raise RuntimeError(msg)
+
+        self.launched.append(args['instance_id'])
+        return user_data_for(args['instance_id'], args['timeout'])
+
+    def destroy_instance(self, instance: UserData) -> None:
+        self.destroyed.append(instance['instance_id'])
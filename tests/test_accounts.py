@@ -0,0 +1,48 @@
+import pytest
+from eth_account import Account
+
+from ctf_server import accounts
+from ctf_server.accounts import derive_account, derive_accounts, derive_seed
+from ctf_server.types import DEFAULT_DERIVATION_PATH, DEFAULT_MNEMONIC, get_player_account
+
+
+Account.enable_unaudited_hdwallet_features()
+
+
+def test_derive_account_matches_eth_account() -> None:
+    for i in range(3):
+        path = f'{DEFAULT_DERIVATION_PATH}{i}'
+        expected = Account.from_mnemonic(DEFAULT_MNEMONIC, account_path=path)
+        assert derive_account(DEFAULT_MNEMONIC, path).address == expected.address
+
+
+def test_derive_accounts_order() -> None:
+    accounts = derive_accounts(DEFAULT_MNEMONIC, DEFAULT_DERIVATION_PATH, 4)
+    assert [acc.address for acc in accounts] == [
+        derive_account(DEFAULT_MNEMONIC, f'{DEFAULT_DERIVATION_PATH}{i}').address for i in range(4)
+    ]
+    assert get_player_account(DEFAULT_MNEMONIC).address == accounts[0].address
+
+
+def test_seed_is_derived_once() -> None:
+    derive_seed.cache_clear()
+    derive_account.cache_clear()
+
+    derive_accounts(DEFAULT_MNEMONIC, DEFAULT_DERIVATION_PATH, 5)
+    info = derive_seed.cache_info()
+    assert info.misses == 1
+    assert info.hits == 4  # noqa: PLR2004
+
+
+def test_mnemonic_pool_per_derivation_path(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(accounts, 'MNEMONIC_POOL_SIZE', 1)
+    monkeypatch.setattr(accounts, '_pools', {})
+
+    other_path = "m/44'/60'/1'/0/"
+    accounts.take_mnemonic(DEFAULT_DERIVATION_PATH)
+    accounts.take_mnemonic(other_path)
+    pool = accounts._pools[DEFAULT_DERIVATION_PATH]  # noqa: SLF001
+    accounts.take_mnemonic(DEFAULT_DERIVATION_PATH)
+
+    assert accounts._pools.keys() == {DEFAULT_DERIVATION_PATH, other_path}  # noqa: SLF001
+    assert accounts._pools[DEFAULT_DERIVATION_PATH] is pool  # noqa: SLF001
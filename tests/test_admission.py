@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from ctf_server.admission import AdmissionError, AdmissionQueue
+from ctf_server.databases import MemoryDatabase
+from ctf_server.types import CreateInstanceRequest
+from tests import request_for, user_data_for
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return 'asyncio'
+
+
+def _request(team_id: str, challenge_name: str = 'challenge') -> CreateInstanceRequest:
+    return request_for(f'{challenge_name}-{team_id}', team_id=team_id, challenge_name=challenge_name)
+
+
+def _register(database: MemoryDatabase, instance_id: str, challenge_name: str) -> None:
+    database.register_instance(instance_id, user_data_for(instance_id, challenge_name=challenge_name))
+
+
+@pytest.mark.anyio
+async def test_teams_take_turns() -> None:
+    queue = AdmissionQueue(MemoryDatabase(), max_concurrent=1)
+    admitted: list[str] = []
+    positions: dict[str, int] = {}
+    release = asyncio.Event()
+
+    async def launch(name: str, team_id: str) -> None:
+        def on_position(position: int) -> None:
+            positions[name] = position
+
+        async with queue.admit(_request(team_id), on_position):
+            admitted.append(name)
+            await release.wait()
+
+    launches = [asyncio.create_task(launch('holder', 'x'))]
+    await asyncio.sleep(0.05)
+    assert admitted == ['holder']
+
+    for name, team_id in (('a1', 'a'), ('a2', 'a'), ('b1', 'b')):
+        launches.append(asyncio.create_task(launch(name, team_id)))
+        await asyncio.sleep(0.05)
+
+    assert positions == {'a1': 1, 'a2': 3, 'b1': 2}
+
+    release.set()
+    await asyncio.wait_for(asyncio.gather(*launches), 5)
+    assert admitted == ['holder', 'a1', 'b1', 'a2']
+
+
+@pytest.mark.anyio
+async def test_instance_caps() -> None:
+    database = MemoryDatabase()
+    _register(database, 'full-a', 'full')
+    queue = AdmissionQueue(database, max_instances=3, max_instances_per_challenge=1, timeout=0.1)
+
+    # The full challenge doesn't hold up the others
+    with pytest.raises(AdmissionError):
+        async with queue.admit(_request('a', 'full')):
+            pass
+    async with queue.admit(_request('a', 'other')):
+        pass
+
+    # The launched instance is counted before the next sample
+    with pytest.raises(AdmissionError):
+        async with queue.admit(_request('b', 'other')):
+            pass
+    async with queue.admit(_request('b', 'another')):
+        pass
+    with pytest.raises(AdmissionError):
+        async with queue.admit(_request('c', 'yet-another')):
+            pass
+
+
+def test_count_instances_per_challenge() -> None:
+    database = MemoryDatabase()
+    _register(database, 'a', 'first')
+    _register(database, 'b', 'first')
+    _register(database, 'c', 'second')
+
+    assert database.count_instances() == 3  # noqa: PLR2004
+    assert database.count_instances_per_challenge() == {'first': 2, 'second': 1}
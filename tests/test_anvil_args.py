@@ -0,0 +1,38 @@
+import pytest
+
+from ctf_server.types import format_anvil_args
+
+
+def _tail_args(**kwargs: object) -> list[str]:
+    # note: everything after the host, port and accounts flags is controlled by the persistence mode here
+    return format_anvil_args(kwargs, 'main')[6:]  # type: ignore[arg-type]
+
+
+def test_persistence() -> None:
+    assert _tail_args() == ['--state', '/data/main-state.json', '--state-interval', '5']
+    assert _tail_args(persistence='interval', state_interval=30) == [
+        '--state',
+        '/data/main-state.json',
+        '--state-interval',
+        '30',
+    ]
+    assert _tail_args(persistence='exit') == ['--state', '/data/main-state.json']
+    assert _tail_args(persistence='off') == []
+
+    with pytest.raises(ValueError, match='unknown persistence mode'):
+        format_anvil_args({'persistence': 'sometimes'}, 'main')  # type: ignore[typeddict-item]
+
+
+def test_memory_bounds() -> None:
+    assert _tail_args(persistence='off', prune_history=True, transaction_block_keeper=64) == [
+        '--prune-history',
+        '--transaction-block-keeper',
+        '64',
+    ]
+    assert _tail_args(persistence='off', prune_history=128, max_persisted_states=8, no_storage_caching=True) == [
+        '--prune-history',
+        '128',
+        '--max-persisted-states',
+        '8',
+        '--no-storage-caching',
+    ]
@@ -0,0 +1,77 @@
+import time
+
+from ctf_server.backends import DockerBackend
+from ctf_server.backends.docker_backend import LABEL_CREATED_AT, LABEL_INSTANCE
+from ctf_server.databases import MemoryDatabase
+from tests import user_data_for
+
+
+GiB = 2**30
+
+
+class _Resource:
+    def __init__(self, client: '_Client', name: str, labels: dict[str, str]) -> None:
+        self.__client = client
+        self.id = name
+        self.name = name
+        self.labels = labels
+        self.attrs: dict[str, object] = {'Labels': labels}
+
+    def kill(self) -> None:
+        pass
+
+    def remove(self) -> None:
+        self.__client.removed.append(self.name)
+
+
+class _Collection:
+    def __init__(self, resources: list[_Resource]) -> None:
+        self.resources = resources
+
+    def list(self, *, filters: dict[str, str], **_: object) -> list[_Resource]:
+        key, _sep, value = filters['label'].partition('=')
+        return [r for r in self.resources if key in r.labels and (not value or r.labels[key] == value)]
+
+
+class _Client:
+    def __init__(self) -> None:
+        self.removed: list[str] = []
+        self.containers = _Collection([])
+        self.volumes = _Collection([])
+
+    def add(self, instance_id: str, age: float, memory_limit: int = 0) -> None:
+        labels = {LABEL_INSTANCE: instance_id, LABEL_CREATED_AT: str(time.time() - age)}
+        container = _Resource(self, f'{instance_id}-main', labels)
+        container.attrs['HostConfig'] = {'Memory': memory_limit}
+        self.containers.resources.append(container)
+        self.volumes.resources.append(_Resource(self, instance_id, labels))
+
+    def info(self) -> dict[str, int]:
+        return {'ContainersRunning': len(self.containers.resources) + 1, 'MemTotal': 16 * GiB}
+
+
+def test_reconcile() -> None:
+    database = MemoryDatabase()
+    database.register_instance('registered', user_data_for('registered'))
+
+    client = _Client()
+    client.add('registered', age=3600)
+    client.add('orphan', age=3600)
+    client.add('launching', age=1)
+
+    backend = DockerBackend(database, client, background_tasks=False)  # type: ignore[arg-type]
+    backend.reconcile()
+    assert sorted(client.removed) == ['orphan', 'orphan-main']
+
+    backend.kill_instance('registered')
+    assert sorted(client.removed) == ['orphan', 'orphan-main', 'registered', 'registered-main']
+
+
+def test_host_load() -> None:
+    client = _Client()
+    client.add('limited', age=1, memory_limit=4 * GiB)
+    client.add('unlimited', age=1)
+
+    # Memory limits of the instances are reserved already, other containers are only counted
+    backend = DockerBackend(MemoryDatabase(), client, background_tasks=False)  # type: ignore[arg-type]
+    assert backend.get_host_load() == (3, 12 * GiB)
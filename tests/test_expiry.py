@@ -0,0 +1,84 @@
+import time
+from pathlib import Path
+from threading import Event
+
+import pytest
+
+from ctf_server.backends import expiry
+from ctf_server.backends.expiry import ExpiryScheduler
+from ctf_server.databases import SQLiteDatabase
+from tests import user_data_for
+
+
+def _scheduler(database: SQLiteDatabase) -> tuple[ExpiryScheduler, list[list[str]], Event]:
+    claimed: list[list[str]] = []
+    fired = Event()
+
+    def on_expired() -> None:
+        ids = database.claim_expired_instances(16, 300)
+        if ids:
+            claimed.append(ids)
+            fired.set()
+
+    scheduler = ExpiryScheduler(database, on_expired, 'test scheduler')
+    scheduler.start()
+    return scheduler, claimed, fired
+
+
+def test_fires_on_expiry() -> None:
+    database = SQLiteDatabase(':memory:')
+    _, claimed, fired = _scheduler(database)
+
+    started_at = time.monotonic()
+    database.register_instance('a', user_data_for('a', 0.3))
+    assert fired.wait(2)
+    assert time.monotonic() - started_at < 1
+    assert claimed == [['a']]
+
+
+def test_seeded_from_database() -> None:
+    database = SQLiteDatabase(':memory:')
+    database.register_instance('a', user_data_for('a', 0.2))
+    _, claimed, fired = _scheduler(database)
+
+    assert fired.wait(2)
+    assert claimed == [['a']]
+
+
+def test_unregister_cancels() -> None:
+    database = SQLiteDatabase(':memory:')
+    scheduler, claimed, fired = _scheduler(database)
+
+    database.register_instance('a', user_data_for('a', 0.3))
+    assert scheduler.pending == 1
+    database.unregister_instance('a')
+    assert scheduler.pending == 0
+    assert not fired.wait(0.6)
+    assert claimed == []
+
+
+def test_resyncs_changes_of_other_workers(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # SQLite only notifies the listeners of its own process, the scheduler has to resync to see the other workers
+    monkeypatch.setattr(expiry, 'EXPIRY_LOCAL_RESYNC_INTERVAL', 0.3)
+    database = SQLiteDatabase(str(tmp_path / 'db.sqlite'))
+    other_worker = SQLiteDatabase(str(tmp_path / 'db.sqlite'))
+    _, claimed, fired = _scheduler(database)
+
+    time.sleep(0.1)
+    other_worker.register_instance('a', user_data_for('a', 0.1))
+    assert fired.wait(2)
+    assert claimed == [['a']]
+
+
+def test_reschedule_before_expiry() -> None:
+    database = SQLiteDatabase(':memory:')
+    scheduler, _, _ = _scheduler(database)
+    time.sleep(0.1)
+
+    # The stale entry of `b` expires along with `a`, it's still scheduled at its new expiry
+    expires_at = time.time() + 0.3
+    scheduler.schedule('a', expires_at)
+    scheduler.schedule('b', expires_at)
+    scheduler.schedule('b', expires_at + 60)
+    time.sleep(0.6)
+    assert scheduler.pending == 1
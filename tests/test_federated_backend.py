@@ -0,0 +1,81 @@
+import threading
+import time
+from decimal import Decimal
+
+import pytest
+
+from ctf_server.backends import FederatedKubernetesBackend, federated_backend
+from ctf_server.backends.kubernetes_profiles import Resources
+from ctf_server.databases import MemoryDatabase
+from ctf_server.types import CreateInstanceRequest
+from tests import StubMember, request_for
+
+
+GiB = Decimal(2**30)
+
+
+class _Member(StubMember):
+    def __init__(self, free: Resources | None, *, fail: bool = False) -> None:
+        super().__init__(fail=fail)
+        self.free = free
+        self.reachable = threading.Event()
+        self.reachable.set()
+
+    def get_free_resources(self) -> Resources:
+        self.reachable.wait()
+        if self.free is None:
+            msg = 'unreachable'
+            raise ConnectionError(msg)
+        return self.free
+
+    def get_instance_requests(self, _: CreateInstanceRequest) -> Resources:
+        return Resources(cpu=Decimal(1), memory=2 * GiB)
+
+
+def test_placement() -> None:
+    members = {
+        'small': _Member(Resources(cpu=Decimal(8), memory=3 * GiB)),
+        'large': _Member(Resources(cpu=Decimal(2), memory=4 * GiB)),
+        'down': _Member(None),
+    }
+    backend = FederatedKubernetesBackend(MemoryDatabase(), members)  # type: ignore[arg-type]
+
+    assert backend.launch_instance(request_for('a')).get('placement') == 'large'
+    # The launch above has been reserved in the cached capacity, leaving `large` with 2GiB of free memory
+    assert backend.launch_instance(request_for('b')).get('placement') == 'small'
+
+    backend.kill_instance('a')
+    assert members['large'].destroyed == ['a']
+    assert members['small'].destroyed == []
+
+
+def test_spill_over() -> None:
+    members = {
+        'full': _Member(Resources(cpu=Decimal(8), memory=8 * GiB), fail=True),
+        'other': _Member(Resources(cpu=Decimal(1), memory=GiB)),
+    }
+    backend = FederatedKubernetesBackend(MemoryDatabase(), members)  # type: ignore[arg-type]
+
+    assert backend.launch_instance(request_for('a')).get('placement') == 'other'
+    assert members['other'].launched == ['a']
+
+
+def test_slow_refresh_does_not_block_launches(monkeypatch: pytest.MonkeyPatch) -> None:
+    member = _Member(Resources(cpu=Decimal(8), memory=8 * GiB))
+    members = {'slow': member}
+    backend = FederatedKubernetesBackend(MemoryDatabase(), members)  # type: ignore[arg-type]
+    backend.launch_instance(request_for('a'))
+
+    monkeypatch.setattr(federated_backend, 'CLUSTER_CAPACITY_REFRESH_INTERVAL', 0)
+    member.reachable.clear()
+    refreshing = threading.Thread(target=backend.launch_instance, args=(request_for('b'),))
+    refreshing.start()
+
+    # The cached capacity is used while another launch is still waiting for the cluster
+    time.sleep(0.1)
+    assert backend.launch_instance(request_for('c')).get('placement') == 'slow'
+    assert member.launched == ['a', 'c']
+
+    member.reachable.set()
+    refreshing.join(5)
+    assert member.launched == ['a', 'c', 'b']
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING
+
+import pytest
+
+from ctf_server.fork_gateway import ForkCache, ForkGateway, cache_key
+
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return 'asyncio'
+
+
+class _Upstream:
+    def __init__(self) -> None:
+        self.batches: list[list[dict]] = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self, batch: list[dict]) -> list[dict]:
+        self.batches.append(batch)
+        await self.release.wait()
+        return [{'jsonrpc': '2.0', 'id': request['id'], 'result': f'0x{len(self.batches):x}'} for request in batch]
+
+
+def _rpc(method: str, params: list, id_: int = 1) -> dict:
+    return {'jsonrpc': '2.0', 'id': id_, 'method': method, 'params': params}
+
+
+def _storage(slot: str, block: str = '0x10', id_: int = 1) -> dict:
+    return _rpc('eth_getStorageAt', ['0x' + 'AB' * 20, slot, block], id_)
+
+
+def test_cache_key() -> None:
+    assert cache_key('mainnet', _storage('0x0')) is not None
+    assert cache_key('mainnet', _storage('0x0')) == cache_key('mainnet', _storage('0x0', id_=2))
+    assert cache_key('mainnet', _storage('0x0')) != cache_key('sepolia', _storage('0x0'))
+    assert cache_key('mainnet', _storage('0x0', block='latest')) is None
+    assert cache_key('mainnet', _rpc('eth_getBalance', ['0x' + 'ab' * 20, {'blockHash': '0x01'}])) is not None
+    assert cache_key('mainnet', _rpc('eth_blockNumber', [])) is None
+
+
+@pytest.mark.anyio
+async def test_cache(tmp_path: Path) -> None:
+    upstream = _Upstream()
+    gateway = ForkGateway('mainnet', ForkCache(tmp_path), upstream)
+
+    assert await gateway.handle(_storage('0x0', id_=7)) == {'jsonrpc': '2.0', 'id': 7, 'result': '0x1'}
+    assert await gateway.handle(_storage('0x0', id_=8)) == {'jsonrpc': '2.0', 'id': 8, 'result': '0x1'}
+    # Uncacheable requests are always passed through
+    assert await gateway.handle(_storage('0x0', block='latest')) == {'jsonrpc': '2.0', 'id': 1, 'result': '0x2'}
+    assert len(upstream.batches) == 2  # noqa: PLR2004
+
+    # Another worker is served from the disk
+    other = ForkGateway('mainnet', ForkCache(tmp_path), _Upstream())
+    assert await other.handle(_storage('0x0')) == {'jsonrpc': '2.0', 'id': 1, 'result': '0x1'}
+    assert other.stats.hits == 1
+
+
+@pytest.mark.anyio
+async def test_single_flight() -> None:
+    upstream = _Upstream()
+    upstream.release.clear()
+    gateway = ForkGateway('mainnet', ForkCache(None), upstream)
+
+    first = asyncio.create_task(gateway.handle([_storage('0x0', id_=1), _storage('0x1', id_=2)]))
+    await asyncio.sleep(0.1)
+    second = asyncio.create_task(gateway.handle([_storage('0x1', id_=3), _storage('0x2', id_=4)]))
+    await asyncio.sleep(0.1)
+    upstream.release.set()
+
+    assert [r['id'] for r in await first] == [1, 2]
+    assert [r['id'] for r in await second] == [3, 4]
+    # The slot that was already being fetched wasn't requested again
+    assert [len(batch) for batch in upstream.batches] == [2, 1]
+    assert gateway.stats.coalesced == 1
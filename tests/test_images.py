@@ -0,0 +1,72 @@
+from docker.errors import NotFound
+
+from ctf_server.backends import DockerBackend
+from ctf_server.backends.backend import PREPULL_IMAGES
+from ctf_server.backends.kubernetes_backend import KUBERNETES_PREPULL_TOOLS_IMAGE, _image_prepull_daemon_set
+from ctf_server.databases import MemoryDatabase
+from ctf_server.types import DEFAULT_IMAGE, CreateInstanceRequest, get_request_images
+
+
+class _Images:
+    def __init__(self, present: set[str]) -> None:
+        self.present = present
+        self.pulled: list[str] = []
+
+    def get(self, image: str) -> str:
+        if image not in self.present:
+            raise NotFound(image)
+        return image
+
+    def pull(self, image: str) -> None:
+        self.pulled.append(image)
+        self.present.add(image)
+
+
+class _Client:
+    def __init__(self, present: set[str]) -> None:
+        self.images = _Images(present)
+
+
+def test_request_images() -> None:
+    request = CreateInstanceRequest(
+        challenge_name='challenge',
+        team_id='team',
+        instance_id='instance',
+        timeout=60,
+        anvil_instances={'main': {}, 'l2': {'image': 'anvil:custom'}},
+        daemon_instances={'bot': {'image': 'bot:latest'}},
+    )
+    assert get_request_images(request) == sorted(['anvil:custom', 'bot:latest', DEFAULT_IMAGE])
+
+
+def test_prepull() -> None:
+    database = MemoryDatabase()
+    database.register_images('first', ['bot:latest', DEFAULT_IMAGE])
+    database.register_images('second', ['bot:latest'])
+
+    client = _Client({DEFAULT_IMAGE})
+    backend = DockerBackend(database, client, background_tasks=False)  # type: ignore[arg-type]
+    assert backend.get_images() == {
+        **{image: [] for image in PREPULL_IMAGES},
+        DEFAULT_IMAGE: ['first'],
+        'bot:latest': ['first', 'second'],
+    }
+    assert backend.get_image_status(['bot:latest']) == {'bot:latest': {'local': False}}
+
+    backend.prepull_images()
+    # Images that are already there aren't pulled again
+    assert client.images.pulled == ['bot:latest']
+    assert backend.get_image_status(['bot:latest']) == {'bot:latest': {'local': True}}
+
+
+def test_prepull_daemon_set_needs_nothing_from_the_images() -> None:
+    manifest = _image_prepull_daemon_set('ctf', ['anvil:latest', 'distroless:latest'])
+    spec = manifest['spec']['template']['spec']
+    tools, *images = spec['initContainers']
+
+    # Only the tools image has to have anything in it, the others are running the binary that it has copied
+    assert tools['image'] == KUBERNETES_PREPULL_TOOLS_IMAGE
+    assert [container['image'] for container in images] == ['anvil:latest', 'distroless:latest']
+    assert {container['command'][0] for container in images} == {tools['command'][-1]}
+    assert all(container['volumeMounts'] == tools['volumeMounts'] for container in images)
+    assert spec['volumes'] == [{'name': tools['volumeMounts'][0]['name'], 'emptyDir': {}}]
@@ -0,0 +1,87 @@
+import socket
+import time
+
+import pytest
+from kubernetes.client import V1ContainerStatus, V1Pod, V1PodStatus
+
+from ctf_server.backends import backend
+from ctf_server.backends.backend import Backend
+from ctf_server.backends.kubernetes_backend import PodFailedError, _is_pod_ready
+from ctf_server.databases import MemoryDatabase
+from ctf_server.types import CreateInstanceRequest, UserData
+
+
+def _pod(phase: str, ready: dict[str, bool]) -> V1Pod:
+    return V1Pod(
+        status=V1PodStatus(
+            phase=phase,
+            container_statuses=[
+                V1ContainerStatus(name=name, ready=is_ready, image='anvil', image_id='anvil', restart_count=0)
+                for name, is_ready in ready.items()
+            ],
+        )
+    )
+
+
+def test_pod_is_ready_once_every_anvil_is() -> None:
+    check = _is_pod_ready(['main', 'l2'])
+
+    assert not check(None)
+    assert not check(V1Pod())
+    assert not check(_pod('Pending', {}))
+    assert not check(_pod('Running', {'main': True, 'l2': False}))
+    # Daemons aren't probed, so they don't have to be ready
+    assert check(_pod('Running', {'main': True, 'l2': True, 'daemon': False}))
+
+
+@pytest.mark.parametrize('phase', ['Failed', 'Succeeded'])
+def test_terminated_pod_fails_the_launch(phase: str) -> None:
+    with pytest.raises(PodFailedError, match=phase):
+        _is_pod_ready(['main'])(_pod(phase, {'main': False}))
+
+
+class _UnreachableBackend(Backend):
+    def __init__(self) -> None:
+        super().__init__(MemoryDatabase(), background_tasks=False)
+        self.cleaned_up = False
+
+    def _launch_instance_impl(self, args: CreateInstanceRequest) -> UserData:
+        # note: nothing is listening on the port once the socket is closed, so the node never comes up
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+
+        self._prepare_nodes(
+            args.get('anvil_instances', {}),
+            {'main': {'id': 'main', 'ip': '127.0.0.1', 'port': port}},
+            time.monotonic() + backend.INSTANCE_START_TIMEOUT,
+        )
+        msg = 'unreachable'
+        raise AssertionError(msg)
+
+    def _cleanup_instance(self, _: CreateInstanceRequest) -> None:
+        self.cleaned_up = True
+
+    def destroy_instance(self, _: UserData) -> None:
+        pass
+
+
+def test_nodes_are_prepared_within_the_start_timeout(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(backend, 'INSTANCE_START_TIMEOUT', 0.5)
+    unreachable = _UnreachableBackend()
+
+    started_at = time.monotonic()
+    with pytest.raises(TimeoutError, match='did not come up in time'):
+        unreachable.launch_instance(
+            CreateInstanceRequest(
+                instance_id='a',
+                team_id='team',
+                challenge_name='challenge',
+                timeout=60,
+                anvil_instances={'main': {}},
+                daemon_instances={},
+            )
+        )
+
+    assert 0.5 <= time.monotonic() - started_at < 5  # noqa: PLR2004
+    assert unreachable.cleaned_up
@@ -0,0 +1,57 @@
+import json
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+from ctf_server.backends.kubernetes_profiles import (
+    KubernetesProfileError,
+    get_profile,
+    load_profiles,
+    pod_spec_overrides,
+    shard_namespace,
+)
+
+
+def test_challenge_profiles_override_default(tmp_path: Path) -> None:
+    path = tmp_path / 'profiles.json'
+    path.write_text(
+        json.dumps(
+            {
+                'default': {'resources': {'requests': {'cpu': '100m'}}, 'spread_topology_keys': ['zone']},
+                'heavy': {'resources': {'requests': {'cpu': '2'}}, 'node_selector': {'pool': 'fast'}},
+            }
+        )
+    )
+    profiles = load_profiles(str(path))
+
+    heavy = get_profile(profiles, 'heavy')
+    assert heavy['resources'] == {'requests': {'cpu': '2'}}
+    assert heavy['spread_topology_keys'] == ['zone']
+    assert get_profile(profiles, 'unknown') == profiles['default']
+
+    spec = pod_spec_overrides(heavy, {'app': 'anvil'})
+    assert spec['nodeSelector'] == {'pool': 'fast'}
+    assert [c['topologyKey'] for c in spec['topologySpreadConstraints']] == ['zone']
+
+
+def test_builtin_default_profile() -> None:
+    spec = pod_spec_overrides(get_profile(load_profiles(''), 'any'), {'app': 'anvil'})
+    assert {c['whenUnsatisfiable'] for c in spec['topologySpreadConstraints']} == {'ScheduleAnyway'}
+    assert 'nodeSelector' not in spec
+
+
+def test_unknown_keys(tmp_path: Path) -> None:
+    path = tmp_path / 'profiles.json'
+    path.write_text(json.dumps({'default': {'cpu': '1'}}))
+    with pytest.raises(KubernetesProfileError):
+        load_profiles(str(path))
+
+
+def test_namespace_sharding() -> None:
+    namespaces = ['a', 'b', 'c']
+    assert shard_namespace('instance', namespaces) == shard_namespace('instance', list(namespaces))
+
+    counts = Counter(shard_namespace(f'instance-{i}', namespaces) for i in range(3000))
+    assert set(counts) == set(namespaces)
+    assert min(counts.values()) > 800  # noqa: PLR2004
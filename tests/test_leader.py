@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING
+
+from ctf_server.backends.leader import LeaderElector
+from ctf_server.databases import MemoryDatabase
+
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+TTL = 0.3
+
+
+class _Database(MemoryDatabase):
+    def __init__(self, snapshot_path: str) -> None:
+        super().__init__(snapshot_path)
+        self.down = False
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        if self.down:
+            msg = 'database is unreachable'
+            raise ConnectionError(msg)
+        return super().acquire_lease(name, owner, ttl)
+
+
+def test_failover(tmp_path: Path) -> None:
+    # Both of the databases are sharing the same snapshot, just like the workers on a single host are
+    first_database = _Database(str(tmp_path / 'db'))
+    first = LeaderElector(first_database, 'test', TTL)
+    second = LeaderElector(_Database(str(tmp_path / 'db')), 'test', TTL)
+    elected: list[str] = []
+    second.add_listener(lambda: elected.append('second'))
+
+    first.start()
+    time.sleep(TTL / 2)
+    second.start()
+    time.sleep(TTL)
+    assert first.is_leader
+    assert not second.is_leader
+
+    first_database.down = True
+    time.sleep(TTL * 3)
+    assert not first.is_leader
+    assert second.is_leader
+    assert elected == ['second']
@@ -0,0 +1,96 @@
+import time
+from pathlib import Path
+
+import pytest
+
+from ctf_server.databases import MemoryDatabase
+from ctf_server.databases.memorydb import MemoryDatabaseError
+from ctf_server.types import UserData
+from tests import user_data_for
+
+
+def _user_data(instance_id: str, expires_in: float = 60) -> UserData:
+    return user_data_for(
+        instance_id, expires_in, anvil_instances={'main': {'id': 'main', 'ip': '127.0.0.1', 'port': 8545}}
+    )
+
+
+def test_lookups() -> None:
+    database = MemoryDatabase()
+    database.register_instance('a', _user_data('a'))
+
+    instance = database.get_instance('a')
+    assert instance is not None
+    assert instance['anvil_instances']['main']['port'] == 8545  # noqa: PLR2004
+    assert database.get_instance_by_external_id('a-external') == instance
+    assert database.get_instances(['a', 'b']) == [instance, None]
+    assert database.get_all_instances() == [instance]
+
+    with pytest.raises(MemoryDatabaseError):
+        database.register_instance('a', _user_data('a'))
+
+
+def test_returned_instances_are_copies() -> None:
+    database = MemoryDatabase()
+    database.register_instance('a', _user_data('a'))
+
+    instance = database.get_instance('a')
+    assert instance is not None
+    instance['anvil_instances'].clear()
+
+    assert database.get_instance('a') != instance
+
+
+def test_metadata() -> None:
+    database = MemoryDatabase()
+    database.register_instance('a', _user_data('a'))
+    database.update_metadata('a', {'mnemonic': 'test'})
+    database.update_metadata('a', {'challenge_contracts': [{'name': 'Hello', 'address': '0x00'}]})
+
+    instance = database.get_instance('a')
+    assert instance is not None
+    assert instance['metadata'] == {'mnemonic': 'test', 'challenge_contracts': [{'name': 'Hello', 'address': '0x00'}]}
+
+    with pytest.raises(MemoryDatabaseError):
+        database.update_metadata('b', {'mnemonic': 'test'})
+
+
+def test_unregister() -> None:
+    database = MemoryDatabase()
+    database.register_instance('a', _user_data('a'))
+
+    assert database.unregister_instance('a') is not None
+    assert database.unregister_instance('a') is None
+    assert database.get_instance('a') is None
+    assert database.get_instance_by_external_id('a-external') is None
+    assert database.get_expiries() == {}
+
+
+def test_expiries() -> None:
+    database = MemoryDatabase()
+    database.register_instance('expired', _user_data('expired', -1))
+    database.register_instance('alive', _user_data('alive'))
+
+    assert [instance['instance_id'] for instance in database.get_expired_instances()] == ['expired']
+    assert database.claim_expired_instances(10, 300) == ['expired']
+    # Claimed instances are rescheduled for the lease duration
+    assert database.claim_expired_instances(10, 300) == []
+    assert database.get_expiries()['expired'] > time.time()
+
+
+def test_snapshot_is_shared(tmp_path: Path) -> None:
+    path = str(tmp_path / 'instances.db')
+    first = MemoryDatabase(path)
+    second = MemoryDatabase(path)
+
+    first.register_instance('a', _user_data('a'))
+    assert second.get_instance_by_external_id('a-external') is not None
+
+    # Big enough to make the snapshot file grow
+    for i in range(200):
+        second.register_instance(f'b{i}', _user_data(f'b{i}'))
+    assert len(first.get_all_instances()) == 201  # noqa: PLR2004
+
+    second.unregister_instance('a')
+    assert first.get_instance('a') is None
+    assert MemoryDatabase(path).get_instance('b0') is not None
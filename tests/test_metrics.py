@@ -0,0 +1,93 @@
+import contextvars
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from ctf_server import metrics
+from ctf_server.databases import MemoryDatabase
+from ctf_server.metrics import Histogram, collect_timings, record_phase, render_metrics, timed
+from ctf_server.types import CreateInstanceRequest, UserData
+from tests import StubBackend, request_for
+
+
+# Above the largest pid that linux could assign
+EXITED_PID = 2**22 + 1
+
+
+class _Backend(StubBackend):
+    def _launch_instance_impl(self, args: CreateInstanceRequest) -> UserData:
+        record_phase('create_container', 0.5)
+        return super()._launch_instance_impl(args)
+
+
+def test_histogram_render() -> None:
+    histogram = Histogram('test_seconds', 'Test histogram.', ('phase',), buckets=(0.1, 1.0))
+    histogram.observe(0.05, 'a')
+    histogram.observe(0.5, 'a')
+    histogram.observe(5.0, 'a')
+
+    assert histogram.render() == [
+        '# HELP test_seconds Test histogram.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{phase="a",le="0.1"} 1',
+        'test_seconds_bucket{phase="a",le="1.0"} 2',
+        'test_seconds_bucket{phase="a",le="+Inf"} 3',
+        'test_seconds_sum{phase="a"} 5.55',
+        'test_seconds_count{phase="a"} 3',
+    ]
+
+
+def test_repeated_phases_add_up() -> None:
+    with collect_timings() as timings:
+        record_phase('pull', 1.0)
+        with ThreadPoolExecutor() as pool:
+            # Threads only see the timings when they're running within a copy of the context
+            for _ in range(3):
+                pool.submit(contextvars.copy_context().run, record_phase, 'spawn', 0.25).result()
+            pool.submit(record_phase, 'lost', 1.0).result()
+        with timed('sleep'):
+            pass
+
+    assert timings.keys() == {'pull', 'spawn', 'sleep'}
+    assert timings['spawn'] == 0.75  # noqa: PLR2004
+
+    # Outside of launches the phases are only observed by the histogram
+    record_phase('pull', 1.0)
+    assert timings['pull'] == 1.0
+
+
+def test_launch_timings() -> None:
+    backend = _Backend(MemoryDatabase())
+    instance = backend.launch_instance(request_for('a'))
+
+    timings = instance.get('timings', {})
+    assert timings['create_container'] == 0.5  # noqa: PLR2004
+    assert timings['total'] >= 0
+
+
+def test_metrics_are_summed_over_workers(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(metrics, 'METRICS_DIR', tmp_path)
+    histogram = Histogram('test_workers_seconds', 'Test histogram.', ('phase',), buckets=(1.0,))
+    histogram.observe(0.5, 'deploy')
+    # The worker saves its metrics in the background or once it's scraped, never on the observation itself
+    assert not any(tmp_path.iterdir())
+
+    # Another worker of the same server, a worker of a server that has been restarted since, and one that has exited
+    other_worker = {'test_workers_seconds': [[['deploy'], [1, 1], 2.5]]}
+    (tmp_path / f'{os.getppid()}-1.json').write_text(json.dumps(other_worker))
+    (tmp_path / 'restarted-1.json').write_text(json.dumps(other_worker))
+    (tmp_path / f'{os.getppid()}-{EXITED_PID}.json').write_text(json.dumps(other_worker))
+
+    rendered = render_metrics()
+    assert 'test_workers_seconds_bucket{phase="deploy",le="1.0"} 2' in rendered
+    assert 'test_workers_seconds_count{phase="deploy"} 3' in rendered
+    assert not (tmp_path / f'{os.getppid()}-{EXITED_PID}.json').exists()
+
+
+def test_label_values_are_escaped() -> None:
+    histogram = Histogram('test_escaped_seconds', 'Test histogram.', ('phase',), buckets=())
+    histogram.observe(1.0, 'a"b\\c')
+    assert 'test_escaped_seconds_count{phase="a\\"b\\\\c"} 1' in histogram.render()
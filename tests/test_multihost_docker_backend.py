@@ -0,0 +1,121 @@
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+from docker.errors import NotFound
+
+from ctf_server.backends import DockerBackend, MultiHostDockerBackend
+from ctf_server.backends.docker_backend import INSTANCES_NETWORK_NAME
+from ctf_server.databases import MemoryDatabase
+from ctf_server.types import CreateInstanceRequest
+from tests import StubMember, request_for
+
+
+GiB = 2**30
+
+
+class _Member(StubMember):
+    def __init__(self, running: int, memory: int) -> None:
+        super().__init__()
+        self.running = running
+        self.memory = memory
+
+    def get_host_load(self) -> tuple[int, int]:
+        return self.running, self.memory
+
+
+def _request(instance_id: str) -> CreateInstanceRequest:
+    return request_for(instance_id, anvil_instances={'main': {}, 'l2': {}})
+
+
+def test_least_loaded() -> None:
+    members = {
+        'a': _Member(running=4, memory=16 * GiB),
+        'b': _Member(running=3, memory=8 * GiB),
+        'c': _Member(running=3, memory=32 * GiB),
+    }
+    backend = MultiHostDockerBackend(MemoryDatabase(), members)  # type: ignore[arg-type]
+
+    assert backend.launch_instance(_request('x')).get('placement') == 'c'
+    # Both chains of the previous launch are counted, `c` is running 5 containers now
+    assert backend.launch_instance(_request('y')).get('placement') == 'b'
+
+    backend.kill_instance('x')
+    assert members['c'].destroyed == ['x']
+
+
+class _Container:
+    def __init__(self, name: str, ports: dict[str, object] | None) -> None:
+        self.id = name
+        self.attrs = {'NetworkSettings': {'Ports': {'8545/tcp': [{'HostPort': '32768'}]} if ports else {}}}
+
+
+class _Containers:
+    def __init__(self) -> None:
+        self.runs: list[dict[str, Any]] = []
+        self.__containers: dict[str, _Container] = {}
+
+    def run(self, **kwargs: Any) -> _Container:  # noqa: ANN401
+        self.runs.append(kwargs)
+        container = self.__containers[kwargs['name']] = _Container(kwargs['name'], kwargs['ports'])
+        return container
+
+    def get(self, container_id: str) -> _Container:
+        return self.__containers[container_id]
+
+
+class _Networks:
+    def __init__(self) -> None:
+        self.created: list[str] = []
+
+    def get(self, name: str) -> None:
+        if name not in self.created:
+            raise NotFound(name)
+
+    def create(self, name: str, **_: object) -> None:
+        self.created.append(name)
+
+
+class _RemoteHost:
+    def __init__(self) -> None:
+        self.containers = _Containers()
+        self.networks = _Networks()
+        self.volumes = SimpleNamespace(create=lambda name, **_: SimpleNamespace(id=name))
+
+
+class _DockerBackend(DockerBackend):
+    def _prepare_nodes(self, *_: object) -> None:
+        pass
+
+
+def test_remote_member_launch() -> None:
+    host = _RemoteHost()
+    backend = _DockerBackend(
+        MemoryDatabase(),
+        host,  # type: ignore[arg-type]
+        publish_address='10.0.0.2',
+        publish_bind='10.0.0.2',
+        background_tasks=False,
+    )
+
+    for instance_id in ('x', 'y'):
+        instance = backend.launch_instance(_request(instance_id))
+        assert instance['anvil_instances']['main']['ip'] == '10.0.0.2'
+        assert instance['anvil_instances']['main']['port'] == 32768  # noqa: PLR2004
+
+    # The network is created once, and the anvils are only reachable through the private address of the host
+    assert host.networks.created == [INSTANCES_NETWORK_NAME]
+    assert {run['network'] for run in host.containers.runs} == {INSTANCES_NETWORK_NAME}
+    assert {run['ports']['8545/tcp'] for run in host.containers.runs} == {('10.0.0.2', None)}
+
+
+@pytest.mark.parametrize('bind', [None, '0.0.0.0', '1.1.1.1', 'docker-1'])
+def test_public_binds_are_refused(bind: str | None) -> None:
+    with pytest.raises(ValueError, match='private ip address'):
+        DockerBackend(
+            MemoryDatabase(),
+            _RemoteHost(),  # type: ignore[arg-type]
+            publish_address='10.0.0.2',
+            publish_bind=bind,
+            background_tasks=False,
+        )
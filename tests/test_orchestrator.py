@@ -0,0 +1,99 @@
+import asyncio
+
+import httpx
+import pytest
+
+from ctf_server import orchestrator
+from ctf_server.admission import AdmissionQueue
+from ctf_server.databases import MemoryDatabase
+from ctf_server.metrics import LAUNCH_PHASE_SECONDS
+from tests import StubBackend, request_for
+
+
+# More than the threads that anyio serves the sync endpoints with
+WAITING_LAUNCHES = 50
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return 'asyncio'
+
+
+@pytest.fixture
+def backend(monkeypatch: pytest.MonkeyPatch) -> StubBackend:
+    database = MemoryDatabase()
+    backend = StubBackend(database)
+    backend.release.clear()
+    monkeypatch.setattr(orchestrator.context, 'database', database)
+    monkeypatch.setattr(orchestrator.context, 'backend', backend)
+    monkeypatch.setattr(orchestrator.context, 'admission', AdmissionQueue(database, max_concurrent=1))
+    return backend
+
+
+@pytest.mark.anyio
+async def test_waiting_launches_dont_block_other_requests(backend: StubBackend) -> None:
+    transport = httpx.ASGITransport(app=orchestrator.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://orchestrator', timeout=10) as client:
+        launches = [
+            asyncio.create_task(client.post('/instances', json=request_for(f'team-{i}', team_id=f'team-{i}')))
+            for i in range(WAITING_LAUNCHES)
+        ]
+        await asyncio.sleep(0.2)
+
+        # A single launch is admitted at a time, the others are waiting in the admission queue
+        resp = await asyncio.wait_for(client.get('/instances/team-0'), 2)
+        assert resp.json() == {'ok': False, 'message': 'instance does not exist'}
+
+        backend.release.set()
+        results = [resp.json() for resp in await asyncio.gather(*launches)]
+        assert all(result['ok'] for result in results)
+
+
+@pytest.mark.anyio
+async def test_streamed_launch_reports_positions(backend: StubBackend) -> None:
+    backend.release.set()
+    transport = httpx.ASGITransport(app=orchestrator.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://orchestrator', timeout=10) as client:
+        resp = await client.post('/instances', params={'stream': True}, json=request_for('a'))
+
+    lines = resp.text.splitlines()
+    assert lines[-1].startswith('{"ok": true')
+
+
+@pytest.mark.anyio
+async def test_coalesced_launches_are_marked(backend: StubBackend, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(orchestrator.context, 'admission', AdmissionQueue(orchestrator.context.database))
+    transport = httpx.ASGITransport(app=orchestrator.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://orchestrator', timeout=10) as client:
+        launches = [asyncio.create_task(client.post('/instances', json=request_for('a'))) for _ in range(2)]
+        await asyncio.sleep(0.2)
+        backend.release.set()
+        results = [resp.json() for resp in await asyncio.gather(*launches)]
+
+    # Only the first caller deploys the challenge, the other one is told to wait for it
+    assert backend.launched == ['a']
+    assert sorted(result['coalesced'] for result in results) == [False, True]
+    assert {result['data']['external_id'] for result in results} == {'a-external'}
+    assert all('coalesced' not in result['data'] for result in results)
+
+
+def _admissions() -> int:
+    return sum(sum(counts) for labels, counts, _ in LAUNCH_PHASE_SECONDS.dump() if labels == ['admission'])
+
+
+@pytest.mark.anyio
+async def test_coalesced_launches_skip_admission(backend: StubBackend) -> None:
+    admissions = _admissions()
+    transport = httpx.ASGITransport(app=orchestrator.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://orchestrator', timeout=10) as client:
+        first = asyncio.create_task(client.post('/instances', json=request_for('a')))
+        await asyncio.sleep(0.2)
+        # A single launch is admitted at a time, the one that joins the running launch isn't waiting for a slot
+        second = asyncio.create_task(client.post('/instances', json=request_for('a')))
+        await asyncio.sleep(0.2)
+        backend.release.set()
+        launched, joined = await asyncio.gather(first, second)
+
+    assert launched.json()['coalesced'] is False
+    assert joined.json()['coalesced'] is True
+    assert _admissions() == admissions + 1
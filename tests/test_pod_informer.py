@@ -0,0 +1,93 @@
+import json
+import queue
+from collections.abc import Iterator
+from typing import Any
+
+from kubernetes.client.models import V1ListMeta, V1ObjectMeta, V1Pod, V1PodList, V1PodStatus
+
+from ctf_server.backends.informer import PodInformer
+
+
+def _pod(name: str, phase: str) -> dict[str, Any]:
+    return {'metadata': {'name': name, 'resourceVersion': '1'}, 'status': {'phase': phase}}
+
+
+def _is_running(pod: V1Pod | None) -> bool:
+    return pod is not None and pod.status is not None and pod.status.phase == 'Running'
+
+
+def _is_deleted(pod: V1Pod | None) -> bool:
+    return pod is None
+
+
+class _Response:
+    status = 200
+
+    def __init__(self, events: list[dict[str, Any]]) -> None:
+        self.__events = events
+
+    def stream(self, **_: object) -> Iterator[bytes]:
+        for event in self.__events:
+            yield json.dumps(event).encode() + b'\n'
+
+    def close(self) -> None:
+        pass
+
+    def release_conn(self) -> None:
+        pass
+
+
+class _CoreV1:
+    def __init__(self, pods: list[str]) -> None:
+        self.pods = pods
+        self.lists = 0
+        self.watches: queue.Queue[list[dict[str, Any]]] = queue.Queue()
+
+    def list_namespaced_pod(self, *, watch: bool = False, **_: object) -> V1PodList | _Response:
+        """:rtype: V1PodList"""
+        if watch:
+            return _Response(self.watches.get())
+
+        self.lists += 1
+        return V1PodList(
+            metadata=V1ListMeta(resource_version=str(self.lists)),
+            items=[V1Pod(metadata=V1ObjectMeta(name=name), status=V1PodStatus(phase='Running')) for name in self.pods],
+        )
+
+
+def test_waiters() -> None:
+    core_v1 = _CoreV1(['a'])
+    informer = PodInformer(core_v1, 'test informer')  # type: ignore[arg-type]
+    informer.start()
+
+    with informer.expect('a', _is_running) as running:
+        assert running.result(5) is not None
+
+    with informer.expect('b', _is_running) as running:
+        core_v1.watches.put([{'type': 'ADDED', 'object': _pod('b', 'Pending')}])
+        core_v1.watches.put([{'type': 'MODIFIED', 'object': _pod('b', 'Running')}])
+        pod = running.result(5)
+        assert pod is not None
+        assert pod.metadata is not None
+        assert pod.metadata.name == 'b'
+
+    with informer.expect('a', _is_deleted) as deleted:
+        core_v1.watches.put([{'type': 'DELETED', 'object': _pod('a', 'Running')}])
+        assert deleted.result(5) is None
+
+
+def test_relist_after_gone() -> None:
+    core_v1 = _CoreV1(['a', 'b'])
+    informer = PodInformer(core_v1, 'test informer')  # type: ignore[arg-type]
+    informer.start()
+
+    with informer.expect('a', _is_running) as running:
+        running.result(5)
+
+    # The deletion is missed, but the relist after the expired resource version should notice it
+    with informer.expect('b', _is_deleted) as deleted:
+        core_v1.pods = ['a']
+        core_v1.watches.put([{'type': 'ERROR', 'object': {'code': 410, 'reason': 'Gone', 'message': 'too old'}}])
+        assert deleted.result(5) is None
+
+    assert core_v1.lists == 2  # noqa: PLR2004
@@ -0,0 +1,41 @@
+from ctf_launchers.prewarm import Prestate, merge_prestate
+from ctf_server.fork_gateway import PrestateRecorder
+
+
+_ADDR = '0x' + 'ab' * 20
+_CREATED = '0x' + 'cd' * 20
+
+
+def test_merge_prestate() -> None:
+    prestate: Prestate = {}
+    merge_prestate(prestate, {_ADDR: {'balance': '0x1', 'storage': {'0x01': '0x0a'}}, _CREATED: {'balance': '0x0'}})
+    merge_prestate(
+        prestate,
+        {
+            _ADDR.upper(): {'balance': '0x2', 'nonce': 3, 'storage': {'0x01': '0x0b', '0x02': '0x0c'}},
+            _CREATED: {'balance': '0x5', 'code': '0x6000', 'storage': {'0x01': '0x01'}},
+        },
+    )
+
+    # Accounts are taken from the first trace, later ones are only adding the storage slots that weren't touched yet.
+    # Accounts that didn't exist before the first trace are left empty
+    assert prestate == {_ADDR: {'balance': '0x1', 'storage': {'0x01': '0x0a', '0x02': '0x0c'}}, _CREATED: {}}
+
+
+def _rpc(method: str, params: list) -> dict:
+    return {'jsonrpc': '2.0', 'id': 1, 'method': method, 'params': params}
+
+
+def test_recorder() -> None:
+    recorder = PrestateRecorder(blocks=1)
+    recorder.record(_rpc('eth_getStorageAt', [_ADDR, '0x1', '0x10']), '0x' + '00' * 31 + '05')
+    recorder.record(_rpc('eth_getTransactionCount', [_ADDR, '0x10']), '0x7')
+    recorder.record(_rpc('eth_getCode', [_ADDR, 'latest']), '0x6000')
+    recorder.record(_rpc('eth_blockNumber', []), '0x10')
+
+    assert recorder.prestate(16) == {_ADDR: {'nonce': 7, 'storage': {'0x1': '0x' + '00' * 31 + '05'}}}
+
+    # Only the most recently used blocks are kept
+    recorder.record(_rpc('eth_getBalance', [_ADDR, '0x11']), '0x1')
+    assert recorder.prestate(16) == {}
+    assert recorder.prestate(17) == {_ADDR: {'balance': '0x1'}}
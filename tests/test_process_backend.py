@@ -0,0 +1,66 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from ctf_server.backends import ProcessBackend
+from ctf_server.backends.backend import InstanceExistsError
+from ctf_server.databases import MemoryDatabase
+from ctf_server.types import CreateInstanceRequest
+from tests import request_for
+
+
+def _request(instance_id: str) -> CreateInstanceRequest:
+    return request_for(instance_id, daemon_instances={'daemon': {'image': 'unused', 'command': ['sleep', '60']}})
+
+
+def _is_running(pgid: int) -> bool:
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_lifecycle(tmp_path: Path) -> None:
+    backend = ProcessBackend(MemoryDatabase(), tmp_path, '20000-20010', background_tasks=False)
+
+    instance = backend.launch_instance(_request('a'))
+    assert instance['daemon_instances'] == {'daemon': {'id': 'daemon'}}
+
+    pgid = int((tmp_path / 'a' / 'daemon.pgid').read_text())
+    assert _is_running(pgid)
+
+    backend.kill_instance('a')
+    assert not (tmp_path / 'a').exists()
+    assert not _is_running(pgid)
+
+
+def test_relaunch_keeps_the_running_instance(tmp_path: Path) -> None:
+    backend = ProcessBackend(MemoryDatabase(), tmp_path, '20000-20010', background_tasks=False)
+    backend.launch_instance(_request('a'))
+    pgid = int((tmp_path / 'a' / 'daemon.pgid').read_text())
+
+    # The instance directory is already there, e.g. when another worker has launched it
+    with pytest.raises(InstanceExistsError):
+        backend.create_instance(_request('a'))
+    assert _is_running(pgid)
+
+    backend.kill_instance('a')
+    assert not _is_running(pgid)
+
+
+def test_orphaned_instance_is_replaced(tmp_path: Path) -> None:
+    backend = ProcessBackend(MemoryDatabase(), tmp_path, '20000-20010', background_tasks=False)
+    backend.launch_instance(_request('a'))
+    orphaned_pgid = int((tmp_path / 'a' / 'daemon.pgid').read_text())
+
+    # The orchestrator has restarted, and the instance directory is all that's left of the instance
+    restarted = ProcessBackend(MemoryDatabase(), tmp_path, '20000-20010', background_tasks=False)
+    restarted.launch_instance(_request('a'))
+    pgid = int((tmp_path / 'a' / 'daemon.pgid').read_text())
+    assert not _is_running(orphaned_pgid)
+    assert _is_running(pgid)
+
+    restarted.kill_instance('a')
+    assert not _is_running(pgid)
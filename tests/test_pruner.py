@@ -0,0 +1,141 @@
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from ctf_server import metrics
+from ctf_server.backends.pruner import InstancePruner, PrunerStats
+from ctf_server.databases import MemoryDatabase
+from ctf_server.metrics import render_metrics
+from ctf_server.types import UserData
+from tests import user_data_for
+
+
+WORKERS = 2
+
+
+class _Killer:
+    def __init__(self, database: MemoryDatabase) -> None:
+        self.database = database
+        self.release = threading.Event()
+        self.release.set()
+        self.failing: set[str] = set()
+        self.killed: list[str] = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, instance_id: str) -> UserData | None:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            self.release.wait()
+            if instance_id in self.failing:
+                msg = f'failed to kill {instance_id}'
+                raise RuntimeError(msg)
+            self.killed.append(instance_id)
+            return self.database.unregister_instance(instance_id)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def _register(database: MemoryDatabase, instance_id: str, expires_at: float) -> None:
+    database.register_instance(instance_id, user_data_for(instance_id, expires_at - time.time()))
+
+
+def _wait_for(pruner: InstancePruner, done: int) -> PrunerStats:
+    deadline = time.monotonic() + 5
+    while (stats := pruner.stats).pruned + stats.failed < done:
+        assert time.monotonic() < deadline, stats
+        time.sleep(0.01)
+    return stats
+
+
+def test_prunes_expired_instances_concurrently() -> None:
+    database = MemoryDatabase()
+    for i in range(6):
+        _register(database, f'expired-{i}', time.time() - 1)
+    _register(database, 'running', time.time() + 60)
+
+    killer = _Killer(database)
+    killer.release.clear()
+    pruner = InstancePruner(database, killer, 'Test Pruner', workers=WORKERS)
+    pruner.prune()
+
+    time.sleep(0.1)
+    stats = pruner.stats
+    assert stats.in_flight == WORKERS
+    assert stats.backlog == 6 - WORKERS
+
+    killer.release.set()
+    stats = _wait_for(pruner, 6)
+    assert killer.max_running == WORKERS
+    assert sorted(killer.killed) == [f'expired-{i}' for i in range(6)]
+    assert stats == PrunerStats(
+        pruned=6,
+        last_latency=stats.last_latency,
+        max_latency=stats.max_latency,
+        total_latency=stats.total_latency,
+    )
+    assert database.get_instance('running') is not None
+
+
+def test_failed_prunes_are_retried() -> None:
+    database = MemoryDatabase()
+    _register(database, 'broken', time.time() - 1)
+
+    killer = _Killer(database)
+    killer.failing.add('broken')
+    pruner = InstancePruner(database, killer, 'Test Pruner', workers=WORKERS)
+    pruner.prune()
+    stats = _wait_for(pruner, 1)
+    assert (stats.pruned, stats.failed) == (0, 1)
+    # The claim holds the instance back until its lease expires, then it's submitted again
+    assert database.claim_expired_instances(10, 60) == []
+
+    killer.failing.clear()
+    pruner.submit('broken')
+    stats = _wait_for(pruner, 2)
+    assert (stats.pruned, stats.failed) == (1, 1)
+    assert database.get_instance('broken') is None
+
+
+def test_pending_instances_are_submitted_once() -> None:
+    database = MemoryDatabase()
+    killer = _Killer(database)
+    killer.release.clear()
+    pruner = InstancePruner(database, killer, 'Test Pruner', workers=WORKERS)
+
+    for _ in range(3):
+        pruner.submit('instance')
+    killer.release.set()
+
+    stats = _wait_for(pruner, 1)
+    time.sleep(0.1)
+    assert pruner.stats.pruned == stats.pruned == 1
+    assert killer.killed == ['instance']
+
+
+def test_pruner_metrics(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(metrics, 'METRICS_DIR', tmp_path)
+    database = MemoryDatabase()
+    killer = _Killer(database)
+    killer.release.clear()
+    pruner = InstancePruner(database, killer, 'Test Pruner', workers=1)
+
+    pruner.submit('first')
+    pruner.submit('second')
+    time.sleep(0.1)
+    rendered = render_metrics()
+    assert 'paradigmctf_pruner_backlog 1' in rendered
+    assert 'paradigmctf_pruner_in_flight 1' in rendered
+
+    killer.release.set()
+    _wait_for(pruner, 2)
+    rendered = render_metrics()
+    assert 'paradigmctf_pruner_backlog 0' in rendered
+    assert 'paradigmctf_pruner_in_flight 0' in rendered
+    assert 'paradigmctf_prune_seconds_count{outcome="ok"}' in rendered
@@ -0,0 +1,156 @@
+import json
+
+import fakeredis
+import pytest
+from redis.client import Pipeline
+from redis.cluster import ClusterPipeline, RedisCluster
+
+from ctf_server.databases import RedisDatabase, migrate_redis, redisdb
+from ctf_server.types import UserData
+from tests import user_data_for
+
+
+class _FakeClusterPipeline(Pipeline):
+    # note: cluster pipelines are refusing the commands that can't be routed to a single slot
+    publish = ClusterPipeline.publish
+
+
+class _FakeCluster(fakeredis.FakeRedis):
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> Pipeline:  # noqa: FBT001, FBT002
+        return _FakeClusterPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+RedisCluster.register(_FakeCluster)
+
+
+def _user_data(instance_id: str, expires_in: float) -> UserData:
+    return user_data_for(
+        instance_id, expires_in, anvil_instances={'main': {'id': 'main', 'ip': '10.0.0.1', 'port': 8545}}
+    )
+
+
+@pytest.fixture
+def database(monkeypatch: pytest.MonkeyPatch) -> RedisDatabase:
+    # note: fakeredis doesn't report the type of RedisJSON keys to the scripts, the hash encoding is used instead
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redisdb, '_connect', lambda *_, **__: client)
+    return RedisDatabase('redis://fake', encoding='hash')
+
+
+def test_get_instances(database: RedisDatabase) -> None:
+    database.register_instance('a', _user_data('a', 60))
+    database.register_instance('b', _user_data('b', 60))
+    database.update_metadata('a', {'mnemonic': 'test'})
+
+    a, missing, b = database.get_instances(['a', 'missing', 'b'])
+    assert missing is None
+    assert a is not None
+    assert a['metadata'] == {'mnemonic': 'test'}
+    assert a['anvil_instances']['main']['port'] == 8545  # noqa: PLR2004
+    assert b is not None
+    assert b['metadata'] == {}
+
+    assert database.get_instance('a') == a
+    assert database.get_instance('missing') is None
+
+
+def test_get_instance_by_external_id(database: RedisDatabase) -> None:
+    database.register_instance('a', _user_data('a', 60))
+    database.update_metadata('a', {'mnemonic': 'test'})
+
+    instance = database.get_instance_by_external_id('a-external')
+    assert instance is not None
+    assert instance['instance_id'] == 'a'
+    assert instance['metadata'] == {'mnemonic': 'test'}
+    assert database.get_instance_by_external_id('missing') is None
+
+
+def test_expiry_reads(database: RedisDatabase) -> None:
+    database.register_instance('expired', _user_data('expired', -60))
+    database.register_instance('running', _user_data('running', 60))
+
+    assert sorted(instance['instance_id'] for instance in database.get_all_instances()) == ['expired', 'running']
+    assert [instance['instance_id'] for instance in database.get_expired_instances()] == ['expired']
+    assert database.get_expiries().keys() == {'expired', 'running'}
+    assert database.count_instances() == 2  # noqa: PLR2004
+    assert database.claim_expired_instances(10, 60) == ['expired']
+    assert database.get_expired_instances() == []
+
+
+def test_unregister(database: RedisDatabase) -> None:
+    database.register_instance('a', _user_data('a', 60))
+    database.update_metadata('a', {'mnemonic': 'test'})
+
+    instance = database.unregister_instance('a')
+    assert instance is not None
+    assert instance['instance_id'] == 'a'
+    assert database.unregister_instance('a') is None
+    assert database.get_instance('a') is None
+    assert database.get_instance_by_external_id('a-external') is None
+    assert database.get_all_instances() == []
+
+
+def test_migrate_json_to_hash(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redisdb, '_connect', lambda *_, **__: client)
+    json_database = RedisDatabase('redis://fake', encoding='json')
+    json_database.register_instance('a', _user_data('a', 60))
+    json_database.register_instance('b', _user_data('b', 60))
+    json_database.update_metadata('a', {'mnemonic': 'test'})
+
+    migrate_redis.main(['--url', 'redis://fake', '--encoding', 'hash'])
+
+    hash_database = RedisDatabase('redis://fake', encoding='hash')
+    instance = hash_database.get_instance('a')
+    assert instance is not None
+    assert instance['metadata'] == {'mnemonic': 'test'}
+    assert instance['anvil_instances']['main']['port'] == 8545  # noqa: PLR2004
+    assert hash_database.get_instance_by_external_id('b-external') is not None
+    assert hash_database.get_instance('b') is not None
+
+
+def test_migration_skips_unregistered_instances(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redisdb, '_connect', lambda *_, **__: client)
+    json_database = RedisDatabase('redis://fake', encoding='json')
+    json_database.register_instance('a', _user_data('a', 60))
+    json_database.register_instance('b', _user_data('b', 60))
+
+    # The instance is unregistered after the migration has read it, but before it's rewritten
+    multi = Pipeline.multi
+
+    def unregister_then_multi(pipeline: Pipeline) -> None:
+        client.delete('instance/b')
+        multi(pipeline)
+
+    monkeypatch.setattr(Pipeline, 'multi', unregister_then_multi)
+    migrate_redis.main(['--url', 'redis://fake', '--encoding', 'hash'])
+
+    hash_database = RedisDatabase('redis://fake', encoding='hash')
+    assert hash_database.get_instance('a') is not None
+    assert hash_database.get_instance('b') is None
+
+
+def test_cluster_register_and_unregister(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = _FakeCluster(decode_responses=True)
+    monkeypatch.setattr(redisdb, '_connect', lambda *_, **__: client)
+    database = RedisDatabase('redis+cluster://fake', encoding='hash')
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe('expiry-events')
+
+    database.register_instance('a', _user_data('a', 60))
+    instance = database.get_instance('a')
+    assert instance is not None
+    assert database.get_instance_by_external_id('a-external') == instance
+
+    assert database.unregister_instance('a') == instance
+    assert database.get_instance('a') is None
+    assert database.get_all_instances() == []
+
+    # note: the subscription confirmation is consumed as a None message as well
+    messages = [pubsub.get_message(timeout=0.1) for _ in range(3)]
+    events = [json.loads(message['data']) for message in messages if message is not None]
+    assert events == [
+        {'instance_id': 'a', 'expires_at': instance['expires_at']},
+        {'instance_id': 'a', 'expires_at': None},
+    ]
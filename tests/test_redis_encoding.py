@@ -0,0 +1,41 @@
+from ctf_server.databases.redis_encoding import decode_instance_hash, encode_instance_hash
+from ctf_server.types import UserData
+
+
+def _user_data() -> UserData:
+    return UserData(
+        instance_id='a',
+        external_id='a-external',
+        created_at=1700000000.123456,
+        expires_at=1700003600.654321,
+        anvil_instances={
+            'main': {'id': 'main', 'ip': '10.0.0.1', 'port': 8545},
+            'l2/op': {'id': 'l2/op', 'ip': '10.0.0.2', 'port': 8546, 'extra': {'chain_id': 10}},  # type: ignore[typeddict-unknown-key]
+        },
+        daemon_instances={'solver': {'id': 'solver'}},
+        metadata={},
+    )
+
+
+def test_round_trip() -> None:
+    instance = _user_data()
+    fields = encode_instance_hash(instance)
+
+    assert all(isinstance(value, str) for value in fields.values())
+    assert fields['anvil/main/port'] == '8545'
+    assert decode_instance_hash(fields) == instance
+
+
+def test_metadata_is_not_encoded() -> None:
+    instance = _user_data()
+    instance['metadata'] = {'mnemonic': 'test'}
+
+    assert not any(key.startswith('metadata') for key in encode_instance_hash(instance))
+    assert decode_instance_hash(encode_instance_hash(instance))['metadata'] == {}
+
+
+def test_unknown_fields() -> None:
+    instance = _user_data()
+    instance['placement'] = {'cluster': 'a'}  # type: ignore[typeddict-item]
+
+    assert decode_instance_hash(encode_instance_hash(instance))['placement'] == {'cluster': 'a'}  # type: ignore[typeddict-item]
@@ -0,0 +1,72 @@
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import pytest
+
+from ctf_server.backends.backend import InstanceExistsError
+from ctf_server.databases import MemoryDatabase
+from tests import StubBackend, request_for, user_data_for
+
+
+if TYPE_CHECKING:
+    from ctf_server.types import UserData
+
+
+def test_concurrent_launches_are_coalesced() -> None:
+    backend = StubBackend(MemoryDatabase())
+    backend.release.clear()
+    results: list[UserData] = []
+
+    threads = [
+        threading.Thread(target=lambda: results.append(backend.launch_instance(request_for('a')))) for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    backend.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert backend.launched == ['a']
+    assert [result['external_id'] for result in results] == ['a-external'] * 3
+    # Only the first caller is told that it has launched the instance
+    assert sorted(result.get('coalesced', False) for result in results) == [False, True, True]
+
+    # Launches that are not overlapping are still rejected
+    with pytest.raises(InstanceExistsError):
+        backend.launch_instance(request_for('a'))
+
+
+def test_waits_for_launch_elsewhere() -> None:
+    database = MemoryDatabase()
+    backend = StubBackend(database)
+    assert database.acquire_lease('launch/a', 'elsewhere', 60)
+
+    def finish_elsewhere() -> None:
+        time.sleep(0.2)
+        database.register_instance('a', user_data_for('a'))
+        database.release_lease('launch/a', 'elsewhere')
+
+    thread = threading.Thread(target=finish_elsewhere)
+    thread.start()
+    instance = backend.launch_instance(request_for('a'))
+    assert instance['external_id'] == 'a-external'
+    assert instance.get('coalesced')
+    thread.join()
+    assert backend.launched == []
+
+
+def test_leases() -> None:
+    database = MemoryDatabase()
+    assert database.acquire_lease('lease', 'first', 60)
+    assert not database.acquire_lease('lease', 'second', 60)
+    # The owner is extending it
+    assert database.acquire_lease('lease', 'first', 60)
+
+    database.release_lease('lease', 'second')
+    assert not database.acquire_lease('lease', 'second', 60)
+    database.release_lease('lease', 'first')
+    assert database.acquire_lease('lease', 'second', 0)
+    # Expired ones are taken over
+    assert database.acquire_lease('lease', 'first', 60)
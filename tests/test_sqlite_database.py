@@ -0,0 +1,79 @@
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from ctf_server.databases import SQLiteDatabase
+from tests import user_data_for
+
+
+# Schema of the databases that were created before the indexed columns and the metadata table were added
+_BASELINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS anvil_instances
+(
+    instance_id VARCHAR PRIMARY KEY,
+    rpc_id VARCHAR,
+    instance_data JSON
+);"""
+
+
+def test_migrates_baseline_schema(tmp_path: Path) -> None:
+    path = str(tmp_path / 'db.sqlite')
+    conn = sqlite3.connect(path)
+    conn.execute(_BASELINE_SCHEMA)
+    instance = user_data_for('a', -60)
+    conn.execute('INSERT INTO anvil_instances(instance_id, instance_data) VALUES (?, ?)', ('a', json.dumps(instance)))
+    conn.commit()
+    conn.close()
+
+    database = SQLiteDatabase(path)
+    assert database.get_instance_by_external_id('a-external') == instance
+    assert database.get_expiries() == {'a': instance['expires_at']}
+    assert database.claim_expired_instances(10, 60) == ['a']
+
+    database.update_metadata('a', {'mnemonic': 'test'})
+    migrated = database.get_instance('a')
+    assert migrated is not None
+    assert migrated['metadata'] == {'mnemonic': 'test'}
+
+    # Opening the migrated database again is a no-op
+    assert SQLiteDatabase(path).get_instance('a') == migrated
+
+
+def test_metadata(tmp_path: Path) -> None:
+    database = SQLiteDatabase(str(tmp_path / 'db.sqlite'))
+    database.register_instance('a', user_data_for('a', 60))
+
+    database.update_metadata('a', {'mnemonic': 'test', 'challenge_contracts': [{'name': 'Setup', 'address': '0x1'}]})
+    database.update_metadata('a', {'mnemonic': 'updated'})
+    instance = database.get_instance('a')
+    assert instance is not None
+    assert instance['metadata'] == {
+        'mnemonic': 'updated',
+        'challenge_contracts': [{'name': 'Setup', 'address': '0x1'}],
+    }
+    assert database.get_instance_by_external_id('a-external') == instance
+
+    # Metadata of the unknown instances is ignored, it used to be before the metadata table was added too
+    database.update_metadata('missing', {'mnemonic': 'test'})
+    assert database.get_instance('missing') is None
+
+
+def test_metadata_is_deleted_with_instance(tmp_path: Path) -> None:
+    database = SQLiteDatabase(str(tmp_path / 'db.sqlite'))
+    database.register_instance('a', user_data_for('a', 60))
+    database.update_metadata('a', {'mnemonic': 'test'})
+
+    assert database.unregister_instance('a') is not None
+    database.register_instance('a', user_data_for('a', 60))
+    instance = database.get_instance('a')
+    assert instance is not None
+    assert instance['metadata'] == {}
+
+
+def test_connections_are_shared_between_threads(tmp_path: Path) -> None:
+    for database in (SQLiteDatabase(str(tmp_path / 'db.sqlite')), SQLiteDatabase(':memory:')):
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(lambda i, db=database: db.register_instance(f'i{i}', user_data_for(f'i{i}', 60)), range(16)))
+            counts = set(pool.map(lambda _, db=database: db.count_instances(), range(4)))
+        assert counts == {16}
@@ -0,0 +1,74 @@
+import json
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from ctf_server.tracing import TRACEPARENT_HEADER, Tracer, trace_requests, tracer
+
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+def test_disabled_tracer_doesnt_propagate() -> None:
+    disabled = Tracer()
+    with disabled.span('launch'):
+        assert disabled.inject() == {}
+        assert disabled.trace_id is None
+
+
+def test_spans_are_exported(tmp_path: Path) -> None:
+    path = tmp_path / 'spans.jsonl'
+    local = Tracer()
+    local.setup('test', export_path=str(path), collector_url=None)
+
+    with local.span('launch', f'00-{TRACE_ID}-{PARENT_ID}-01', team_id='team') as parent:
+        assert local.inject() == {TRACEPARENT_HEADER: parent.traceparent}
+        with local.span('deploy'):
+            pass
+
+    # Spans that the caller hasn't sampled aren't exported
+    with local.span('ignored', f'00-{TRACE_ID}-{PARENT_ID}-00'):
+        pass
+
+    local.flush()
+    spans = {span['name']: span for span in map(json.loads, path.read_text().splitlines())}
+    assert spans.keys() == {'launch', 'deploy'}
+    assert spans['launch']['trace_id'] == spans['deploy']['trace_id'] == TRACE_ID
+    assert spans['launch']['parent_id'] == PARENT_ID
+    assert spans['deploy']['parent_id'] == spans['launch']['span_id']
+    assert spans['launch']['attributes'] == {'team_id': 'team'}
+    assert spans['launch']['service'] == 'test'
+
+
+def test_requests_continue_the_trace() -> None:
+    app = FastAPI()
+    app.middleware('http')(trace_requests)
+    traces: list[str | None] = []
+
+    @app.get('/instances/{instance_id}')
+    def get_instance(instance_id: str) -> str:
+        with tracer.span('lookup') as span:
+            traces.append(span.trace_id)
+        return instance_id
+
+    client = TestClient(app)
+    assert client.get('/instances/a', headers={TRACEPARENT_HEADER: f'00-{TRACE_ID}-{PARENT_ID}-01'}).is_success
+    assert client.get('/instances/b', headers={TRACEPARENT_HEADER: 'invalid'}).is_success
+    assert traces[0] == TRACE_ID
+    assert traces[1] != TRACE_ID
+
+
+def test_unsampled_service_only_continues_traces(tmp_path: Path) -> None:
+    path = tmp_path / 'spans.jsonl'
+    local = Tracer()
+    local.setup('test', export_path=str(path), collector_url=None, sample_ratio=0)
+
+    with local.span('root'):
+        assert local.trace_id is None
+    with local.span('continued', f'00-{TRACE_ID}-{PARENT_ID}-01'):
+        pass
+
+    local.flush()
+    assert [span['name'] for span in map(json.loads, path.read_text().splitlines())] == ['continued']
@@ -0,0 +1,11 @@
+import pytest
+
+from ctf_server.utils import MemberDefinitionError, parse_members
+
+
+def test_parse_members() -> None:
+    assert parse_members('eu=/etc/eu.yaml, us=incluster') == {'eu': '/etc/eu.yaml', 'us': 'incluster'}
+    with pytest.raises(MemberDefinitionError):
+        parse_members('eu')
+    with pytest.raises(MemberDefinitionError):
+        parse_members('')